@@ -0,0 +1,1380 @@
+# SPDX-License-Identifier:  MIT
+# vim: set ts=4 sw=4 et :
+#
+# lcclient.py - a python library for using a LabControl server
+#
+# This module has the implementation of the operations of the 'lc'
+# command line tool, for use by test programs and frameworks written
+# in python, without starting an 'lc' process for each operation.
+#
+# Operations return python data (or None), and raise error_class
+# on failures.  The message of the exception is the same message that
+# lc shows for the failure.
+#
+# ex:
+#   import lcclient
+#   client = lcclient.Client()
+#   client.reserve("bbb")
+#   rcode, output = client.run("bbb", "uname -a")
+#   print(client.power("bbb", "status"))
+#   client.release("bbb")
+#
+# Note: to keep the startup time of lc short, modules that are only
+# needed by some operations (like 'requests') are imported when they
+# are used, instead of here.
+#
+
+import os
+import sys
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# this is from the REST API standard
+RSLT_OK = "success"
+
+# local config file is hidden (starts with a dot), and
+# is in the user home directory
+config_filename = ".lc.conf"
+system_config_filepath = "/etc/lc.conf"
+
+# default number of seconds that lab data (like the resources connected
+# to a board) is cached
+DEFAULT_CACHE_TTL = 600
+# cached lab data is checked against the lab generation of the server,
+# if no response has shown the generation for this many seconds
+CACHE_CHECK_INTERVAL = 10
+
+# request bodies smaller than this are not compressed
+GZIP_MIN_SIZE = 1024
+
+CONNECTION_ERROR_MSG = "Could not connect to server.  Check that server is running\n" \
+        "and that you have the right server in your configuration file."
+
+
+class error_class(Exception):
+    pass
+
+class connection_error_class(error_class):
+    def __init__(self, message=CONNECTION_ERROR_MSG):
+        error_class.__init__(self, message)
+
+# return the exceptions that indicate a failure to connect to the server
+def connection_errors():
+    errors = (connection_error_class, )
+    if "requests" in sys.modules:
+        errors += (sys.modules["requests"].ConnectionError, )
+    return errors
+
+
+# returns the path of the configuration file to use
+def find_config_filepath():
+    # check for config in user's home directory
+    # if present, this supercedes the system-wide config
+    home = os.environ.get("HOME", "")
+    config_filepath = home + os.sep + config_filename
+
+    if not home or not os.path.exists(config_filepath):
+        config_filepath = system_config_filepath
+    return config_filepath
+
+
+class config_class:
+    def __init__(self, config_filepath):
+        # read configuration data from a file
+        try:
+            data = open(config_filepath, "r").read()
+        except:
+            raise error_class("ERROR: could not read LabControl configuration data from %s" % config_filepath)
+
+        # problems found in the configuration file (the library does
+        # not print them - a program like lc can report them)
+        self.warnings = []
+        self.config_filepath = config_filepath
+        conf_map = self.parse_conf(data)
+
+        # set values from conf_map
+        self.host = conf_map.get("host", "localhost")
+        self.user = conf_map.get("user", "lc_user")
+        self.auth_token = conf_map.get("token", "abcd01234")
+        self.server = conf_map.get("server", "localhost:8000")
+        self.default_board = conf_map.get("default_board", "")
+        # number of seconds to cache lab data (0 to disable the cache)
+        try:
+            self.cache_ttl = int(conf_map.get("cache_ttl", DEFAULT_CACHE_TTL))
+        except ValueError:
+            self.cache_ttl = DEFAULT_CACHE_TTL
+        self.API_URL_BASE = "http://%s/lcserver.py/" % self.server
+
+    # fuego configuration file syntax:
+    # ------------------------
+    # empty lines and lines starting with # are ignored
+    # single-line attribute:
+    # name=value
+    # multi-line attribute:
+    # name="""value line 1
+    # line 2, etc."""
+
+    # returns a map with key/value pairs for each item.
+    def parse_conf(self, data):
+        attr_map = {}
+        lines = data.split('\n')
+        line_no = 0
+        in_block = 0
+        block = ""
+        for line in lines:
+            line_no += 1
+            if in_block:
+                # try to find end of block
+                if line.rstrip().endswith('"""'):
+                    # remove quotes and end block
+                    line = line.rstrip()
+                    block += line[:-3]
+                    attr_map[attr] = block
+                    in_block = 0
+                    continue
+                else:
+                    block += line + '\n'
+                    continue
+
+            # ignore comments
+            if line.startswith("#"):
+                continue
+
+            # ignore empty lines
+            line = line.strip()
+            if not line:
+                continue
+
+            # if we're outside a block, look for name=value lines
+
+            # line should have an equals in it
+            # (either single line name=value, or multi-line block start)
+            if line.find("=") == -1:
+                self.warnings.append("Missing '=' at line %d in configuration file %s" % (line_no, self.config_filepath))
+                continue
+
+            (attr, value) = line.split('=', 1)
+            attr = attr.strip()
+            value = value.strip()
+            if value.find('"""') == -1:
+                # if a single-line, just record the attribute
+                if value.startswith('"') and value.endswith('"'):
+                    # remove single-quotes
+                    # (if value needs quotes, enclose in triple-quotes)
+                    value = value[1:-1]
+                attr_map[attr] = value
+            else:
+                # if the start of a multi-line block...
+                vstart = value.find('"""')
+                block = value[vstart+3:] + '\n'
+                in_block = 1
+                # sanity check for block terminator on same line
+                # if this line has triple-quotes, then the
+                # block begins and ends on the same line.
+                if block.endswith('"""\n'):
+                    block = block[:block.index('"""')]
+                    attr_map[attr] = block
+                    in_block = 0
+                # NOTE: there's a weird corner case with a line like:
+                # 'my_attr=""" foo bar """ more stuff '
+                # this will not terminate the block
+
+        # check for dangling material
+        if in_block:
+            self.warnings.append('Syntax error in configuration file %s: missing """ at end of multiline value for item "%s", at end of file' % (self.config_filepath, attr))
+            attr_map[attr] = block
+
+        return attr_map
+
+    def save(self):
+        # note: This overwrites any comments in the file
+        # It would be nicer to scan the file and replace lines as they appear
+        # and to save other config items found in config_class
+        # (excepting generated ones)
+        fd = open(self.config_filepath, "w+")
+        fd.write("server=%s\n" % self.server)
+        fd.write("host=%s\n" % self.host)
+        fd.write("user=%s\n" % self.user)
+        fd.write("token=%s\n" % self.auth_token)
+        if self.default_board:
+            fd.write("default_board=%s\n" % self.default_board)
+        if self.cache_ttl != DEFAULT_CACHE_TTL:
+            fd.write("cache_ttl=%d\n" % self.cache_ttl)
+        fd.close()
+
+
+# a response from http_session_class, with the parts of the
+# requests.Response API that lc uses
+class http_response_class:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.text = content.decode("utf8", "replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+# a minimal http client, for simple GET and POST requests
+# This avoids the cost of importing the 'requests' module, for most
+# operations.  Requests that stream data (or that need a proxy) are
+# passed to a requests.Session.
+#
+# A single session should be used for all requests, so that the
+# connection to the server is kept alive between requests.
+#
+# Responses are requested with gzip encoding.  Request bodies are
+# gzip-encoded only if gzip_bodies is set, since older servers do not
+# accept compressed bodies.
+class http_session_class:
+    def __init__(self):
+        # map of "host:port" to a kept-alive connection
+        self.conns = {}
+        self.requests_session = None
+        self.gzip_bodies = False
+
+    def get_requests_session(self):
+        if not self.requests_session:
+            import requests
+            self.requests_session = requests.Session()
+        return self.requests_session
+
+    def use_requests(self, data, stream):
+        if stream or hasattr(data, "read"):
+            return True
+        for var in ["http_proxy", "HTTP_PROXY"]:
+            if os.environ.get(var, ""):
+                return True
+        return False
+
+    def get(self, url, headers={}, stream=False):
+        if self.use_requests(None, stream):
+            try:
+                return self.get_requests_session().get(url, headers=headers,
+                        stream=stream)
+            except connection_errors():
+                raise connection_error_class()
+        return self.request("GET", url, headers, None)
+
+    def post(self, url, headers={}, data=""):
+        if self.gzip_bodies:
+            headers, data = self.gzip_body(headers, data)
+        if self.use_requests(data, False):
+            try:
+                return self.get_requests_session().post(url, headers=headers,
+                        data=data)
+            except connection_errors():
+                raise connection_error_class()
+        return self.request("POST", url, headers, data or "")
+
+    # return headers and data for a gzip-encoded request body
+    # The data from a file is compressed into a temporary file, which is
+    # then streamed to the server.
+    def gzip_body(self, headers, data):
+        import zlib
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if hasattr(data, "read"):
+            import tempfile
+
+            try:
+                size = os.fstat(data.fileno()).st_size - data.tell()
+            except (AttributeError, IOError, OSError):
+                return (headers, data)
+            if size < GZIP_MIN_SIZE:
+                return (headers, data)
+
+            body = tempfile.TemporaryFile()
+            while True:
+                chunk = data.read(65536)
+                if not chunk:
+                    break
+                body.write(compressor.compress(chunk))
+            body.write(compressor.flush())
+            body.seek(0)
+        else:
+            if not isinstance(data, bytes):
+                data = data.encode("utf8")
+            if len(data) < GZIP_MIN_SIZE:
+                return (headers, data)
+            body = compressor.compress(data) + compressor.flush()
+
+        headers = dict(headers)
+        headers["Content-Encoding"] = "gzip"
+        return (headers, body)
+
+    def request(self, method, url, headers, data):
+        import socket
+        try:
+            import httplib
+            from urlparse import urlsplit
+        except ImportError:
+            import http.client as httplib
+            from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        # with python 2, a unicode path (e.g. with an id from a json
+        # response) makes httplib fail to add a binary (gzipped) body
+        if not isinstance(path, str):
+            path = path.encode("utf8")
+
+        headers = dict(headers)
+        headers.setdefault("Accept-Encoding", "gzip")
+
+        # retry once if a kept-alive connection was closed by the server
+        for attempt in [1, 2]:
+            conn = self.conns.get(parts.netloc, None)
+            reused = conn is not None
+            if not conn:
+                conn = httplib.HTTPConnection(parts.netloc)
+                self.conns[parts.netloc] = conn
+            try:
+                conn.request(method, path, data, headers)
+                resp = conn.getresponse()
+                content = resp.read()
+                break
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                del self.conns[parts.netloc]
+                if not reused:
+                    raise connection_error_class()
+
+        headers = dict((name.lower(), value) for (name, value) in resp.getheaders())
+        if headers.get("content-encoding", "") in ["gzip", "x-gzip"]:
+            import zlib
+            try:
+                content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+            except zlib.error:
+                raise error_class("Could not decompress gzip response from server")
+        return http_response_class(resp.status, headers, content)
+
+
+def quote(s):
+    try:
+        from urllib import quote as url_quote
+    except ImportError:
+        from urllib.parse import quote as url_quote
+    return url_quote(s)
+
+# returns the sha256 checksum of a local file
+def file_checksum(filepath):
+    import hashlib
+
+    hasher = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+# parse a stream of server-sent events (text/event-stream) from a
+# streaming response, and yield (event, data) for each event
+# The response is read in small chunks, so that each event is
+# returned as soon as it arrives.
+def read_events(resp):
+    event = "message"
+    data_lines = []
+    for line in resp.iter_lines(chunk_size=1):
+        line = line.decode("utf8", "replace")
+        if not line:
+            if data_lines:
+                yield (event, "\n".join(data_lines))
+            event = "message"
+            data_lines = []
+        elif line.startswith(":"):
+            # a comment
+            continue
+        else:
+            field, _, value = line.partition(":")
+            if value.startswith(" "):
+                value = value[1:]
+            if field == "event":
+                event = value
+            elif field == "data":
+                data_lines.append(value)
+
+
+# a cache of lab data from a server, kept in a file in the user's
+# cache directory
+# The cache holds data that changes only when the lab configuration
+# changes (like the list of boards, and the resources connected to them).
+# It is keyed by the server, and is cleared when the lab generation
+# number from the server changes.  Entries also expire after a time
+# (cache_ttl, in seconds).
+#
+# A cache hit makes no request of its own, so the client checks the
+# generation with a conditional request (api/v0.2/generation) before
+# using a cached entry, unless a response has shown the generation in
+# the last CACHE_CHECK_INTERVAL seconds.  A new lc process therefore
+# makes one cheap request before it uses the cache.
+class cache_class:
+    def __init__(self, server, ttl):
+        self.ttl = ttl
+        cache_dir = os.environ.get("XDG_CACHE_HOME", "")
+        if not cache_dir:
+            cache_dir = os.path.expanduser("~") + os.sep + ".cache"
+        name = "".join([c if c.isalnum() or c in ".-" else "_" for c in server])
+        self.path = cache_dir + os.sep + "lc" + os.sep + "cache-%s.json" % name
+        self.data = None
+        # the last lab generation number seen from the server
+        self.generation = None
+
+    def load(self):
+        if self.data is None:
+            try:
+                self.data = json.load(open(self.path))
+            except (IOError, ValueError):
+                self.data = {}
+            self.data.setdefault("generation", self.generation)
+            self.data.setdefault("entries", {})
+        return self.data
+
+    def save(self):
+        # write to a temp file and rename it, so that other lc processes
+        # never see a partially-written cache file
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = "%s.%d" % (self.path, os.getpid())
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(self.data))
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            # the cache is only an optimization
+            pass
+
+    def get(self, key):
+        if self.ttl <= 0:
+            return None
+        import time
+
+        entry = self.load()["entries"].get(key, None)
+        if not entry or time.time() - entry["time"] > self.ttl:
+            return None
+        return entry["value"]
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+        import time
+
+        self.load()["entries"][key] = { "time": time.time(), "value": value }
+        self.save()
+
+    # clear the cache if the lab generation number changed
+    def set_generation(self, generation):
+        self.generation = generation
+        if self.ttl <= 0:
+            return
+        if self.data is None and not os.path.exists(self.path):
+            return
+        data = self.load()
+        if data["generation"] != generation:
+            self.data = { "generation": generation, "entries": {} }
+            self.save()
+
+    def clear(self):
+        self.data = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+TRANSFER_METHODS = ["ssh", "serial"]
+POWER_OPERATIONS = ["status", "on", "off", "reboot"]
+CAPTURE_OPERATIONS = ["start", "stop", "get-data", "delete"]
+# number of times to resume following a capture, after losing the
+# connection to the server
+FOLLOW_RETRIES = 5
+# time to wait for events in each request, when watching events
+EVENT_WAIT = 60
+
+class client_class:
+    """
+    A client for a LabControl server.
+
+    conf is a config_class object.  If it is not specified, the
+    configuration is read from config_filepath (or from the default
+    configuration file, if that is not specified either).
+
+    session is an http_session_class object, which can be shared by
+    several clients.
+    """
+    def __init__(self, conf=None, config_filepath=None, session=None):
+        if not conf:
+            conf = config_class(config_filepath or find_config_filepath())
+        self.conf = conf
+        self.session = session or http_session_class()
+        self.cache = cache_class(conf.server, conf.cache_ttl)
+        # when a response last showed the lab generation
+        self.generation_time = 0
+
+    # all requests are made with http_get() and http_post(), so that
+    # the cache is checked against the lab generation of each response
+    def http_get(self, url, headers={}, stream=False):
+        resp = self.session.get(url, headers=headers, stream=stream)
+        self.check_headers(resp)
+        return resp
+
+    def http_post(self, url, headers={}, data=""):
+        if not self.session.gzip_bodies and self.cache.get("accept-encoding"):
+            self.session.gzip_bodies = True
+        resp = self.session.post(url, headers=headers, data=data)
+        self.check_headers(resp)
+        return resp
+
+    # do a GET request that is validated with the ETag of a cached
+    # response, if there is one
+    # If the server says the cached response is current (with a 304),
+    # a response with the cached content is returned.
+    def http_get_cached(self, url):
+        key = "etag/" + url
+        entry = self.cache.get(key)
+        headers = self.auth_headers()
+        if entry:
+            headers["If-None-Match"] = entry["etag"]
+
+        resp = self.http_get(url, headers=headers)
+        if resp.status_code == 304 and entry:
+            return http_response_class(200, resp.headers,
+                    entry["content"].encode("utf8"))
+
+        etag = resp.headers.get("etag", None)
+        if resp.status_code == 200 and etag:
+            self.cache.put(key, { "etag": etag, "content": resp.text })
+        return resp
+
+    def check_headers(self, resp):
+        import time
+
+        generation = resp.headers.get("x-lab-generation", None)
+        if generation is not None:
+            self.cache.set_generation(generation)
+            self.generation_time = time.time()
+
+        # the server accepts gzip-encoded request bodies
+        # This is remembered in the cache, so that a single lab operation
+        # (like put-data) can use it.
+        if "gzip" in resp.headers.get("accept-encoding", ""):
+            self.session.gzip_bodies = True
+            if not self.cache.get("accept-encoding"):
+                self.cache.put("accept-encoding", "gzip")
+
+    # return the cached value for key, or None
+    # The lab generation is checked first, if it has not been seen
+    # recently, so that lab data is not used after the lab changed.
+    def cache_get(self, key):
+        import time
+
+        if self.cache.get(key) is None:
+            return None
+        if time.time() - self.generation_time > CACHE_CHECK_INTERVAL:
+            headers = self.auth_headers()
+            generation = self.cache.load()["generation"]
+            if generation is not None:
+                headers["If-None-Match"] = '"generation-%s"' % generation
+            try:
+                self.http_get(self.url("generation"), headers=headers)
+            except connection_errors():
+                # the cache is only an optimization - the operation
+                # will report the problem
+                pass
+        return self.cache.get(key)
+
+    def url(self, api_path):
+        return self.conf.API_URL_BASE + "api/v0.2/" + api_path
+
+    def auth_headers(self):
+        return { "Authorization": "token " + self.conf.auth_token }
+
+    # check the status and result of a response, and return the
+    # response data
+    # http_error_msg is used if the http status is not 200, and
+    # fail_msg is used (followed by the reason from the server) if
+    # the result is not success
+    def check_response(self, resp, http_error_msg, fail_msg,
+            unknown_reason="for unknown reasons"):
+        if resp.status_code != 200:
+            raise error_class(http_error_msg)
+
+        try:
+            resp_data = resp.json()
+        except ValueError:
+            raise error_class("Could not parse response data as json. data=%s" % resp.text)
+
+        try:
+            result = resp_data["result"]
+        except:
+            raise error_class("Malformed response from server. Missing 'result'. resp=%s" % resp_data)
+
+        if result != RSLT_OK:
+            try:
+                reason = resp_data["message"]
+            except:
+                reason = unknown_reason
+            raise error_class(fail_msg + reason)
+
+        return resp_data
+
+    # return the 'data' item of a response
+    def get_data(self, resp_data, missing_msg=None):
+        try:
+            return resp_data["data"]
+        except:
+            raise error_class(missing_msg or \
+                    "Malformed response from server. Missing 'data'. resp=%s" % resp_data)
+
+    def get_list(self, api_path, name):
+        resp = self.http_get(self.url(api_path),
+                headers=self.auth_headers())
+        if resp.status_code != 200:
+            raise error_class("Cannot read %s from server" % name)
+
+        resp_data = resp.json()
+        if type(resp_data) != type([]):
+            try:
+                reason = resp_data["message"]
+            except:
+                reason = "for unknown reasons"
+            raise error_class("Could not get %s from server: %s" % (name, reason))
+
+        return resp_data
+
+    def login(self, user, password):
+        """
+        Get an authentication token from the server, for the user.
+        The token and user are set in the configuration (but the
+        configuration is not saved).  Returns the token.
+        """
+        url = self.url("token")
+        headers = { "Content-Type": "application/json" }
+        jdata = json.dumps({ "username": user, "password": password })
+
+        resp = self.http_post(url, headers=headers, data=jdata)
+        resp_data = self.check_response(resp,
+                "Cannot login to server '%s'" % self.conf.server,
+                "Login failure: ",
+                "for unknown reason (response missing reason)")
+
+        try:
+            token = resp_data["data"]["token"]
+        except:
+            raise error_class("Malformed response from server. Missing 'token'. resp=%s" % resp_data)
+
+        self.conf.user = user
+        self.conf.auth_token = token
+        return token
+
+    def list_objects(self, obj_type):
+        """
+        Return a list of the names of objects on the server.
+        obj_type is one of 'boards', 'devices', or 'resources'.
+        """
+        if obj_type not in ["boards", "devices", "resources"]:
+            raise error_class(("Invalid object type '%s'\n" % obj_type) + \
+                    "Please specify one of: 'boards', 'devices', or 'resources'.")
+
+        server_obj_type = obj_type
+        if obj_type == "boards":
+            server_obj_type = "devices"
+
+        key = "list/" + server_obj_type
+        obj_list = self.cache_get(key)
+        if obj_list is None:
+            obj_list = self.get_list(server_obj_type, server_obj_type)
+            self.cache.put(key, obj_list)
+        return obj_list
+
+    def list_my_boards(self):
+        """
+        Return a list of the boards reserved by the user.
+        """
+        return self.get_list("devices/mine", "boards")
+
+    def events(self, since=None, timeout=0):
+        """
+        Return events from the event log of the server, after the
+        sequence number 'since'.  If there are no events, the server
+        waits up to 'timeout' seconds for one.
+
+        Returns a map with "events" (a list of event maps, each with a
+        "seq", "type" and "time"), "last_seq" (the sequence number of
+        the last event) and "missed" (True if some events after 'since'
+        are no longer in the log).  If since is None, no events are
+        returned, only "last_seq".
+        """
+        url = self.url("events")
+        if since is not None:
+            url += "?since=%d&timeout=%s" % (since, timeout)
+        resp = self.http_get(url, headers=self.auth_headers())
+        resp_data = self.check_response(resp,
+                "Cannot read events from server",
+                "Could not read events. From server:\n ")
+        return self.get_data(resp_data, "Missing event data from server.")
+
+    def watch_events(self, since=None):
+        """
+        Yield events from the server as they happen, starting after
+        sequence number 'since' (or with the next new event, if since
+        is None).  This does not return.
+        """
+        if since is None:
+            since = self.events()["last_seq"]
+        while True:
+            data = self.events(since, EVENT_WAIT)
+            if data["last_seq"] < since:
+                # the event log on the server was reset
+                since = data["last_seq"]
+            for event in data["events"]:
+                since = event["seq"]
+                yield event
+
+    def agent_ops(self, host, timeout=0, capture_dir=None):
+        """
+        Return the list of operations waiting for the agent of a lab
+        host.  If there are none, the server waits up to 'timeout'
+        seconds for one.  Each operation is a map with an "id" and
+        an "op", and the arguments for the operation.  'capture_dir'
+        is the directory for capture logs on the host.
+        """
+        url = self.url("agents/%s/ops?timeout=%s" % (host, timeout))
+        if capture_dir:
+            url += "&capture_dir=%s" % quote(capture_dir)
+        resp = self.http_get(url, headers=self.auth_headers())
+        resp_data = self.check_response(resp,
+                "Cannot read agent operations from server",
+                "Could not read agent operations. From server:\n ")
+        return self.get_data(resp_data, "Missing agent operations from server.")
+
+    def agent_result(self, host, op_id, result):
+        """
+        Send the result of an agent operation to the server.  result is
+        a map, with "result" and other values for the operation.
+        """
+        url = self.url("agents/%s/result/%s" % (host, op_id))
+        headers = self.auth_headers()
+        headers["Content-Type"] = "application/json"
+        resp = self.http_post(url, headers=headers, data=json.dumps(result))
+        self.check_response(resp,
+                "Cannot send agent result to server",
+                "Could not send result of operation %s. From server:\n " % op_id)
+
+    def board_status(self, board):
+        """
+        Return the data for a board (including "AssignedTo").
+        """
+        resp = self.http_get_cached(self.url("devices/" + board))
+        if resp.status_code != 200:
+            raise error_class("Cannot read board %s from server" % board)
+
+        try:
+            resp_data = resp.json()
+        except:
+            raise error_class("Could not parse data from server")
+
+        try:
+            result = resp_data["result"]
+        except:
+            raise error_class("Can not determine result from server")
+
+        if result != RSLT_OK:
+            raise error_class(resp_data.get("message",
+                    "Unknown failure from server"))
+
+        return resp_data
+
+    def reserve(self, board, cmd="reserve", wait=False, timeout=0,
+            duration=None):
+        """
+        Reserve a board for the user.  If wait is True and the board is
+        reserved by another user, wait for the board to be released
+        (for up to timeout seconds, or with no limit if timeout is 0).
+        Waiting users get the board in the order they started waiting.
+
+        If duration is specified, the reservation is a lease that
+        expires after duration seconds, unless it is renewed.
+        """
+        url = self.url("devices/%s/assign" % board)
+        params = []
+        if wait:
+            params.append("wait=1&timeout=%s" % timeout)
+        if duration:
+            params.append("duration=%s" % duration)
+        if params:
+            url += "?" + "&".join(params)
+        resp = self.http_get(url, headers=self.auth_headers())
+        self.check_response(resp,
+                "Cannot perform %s operation on server" % cmd, "")
+
+    def renew(self, board, duration=None):
+        """
+        Renew the lease of a board reserved by the user, for duration
+        seconds (or for the duration of the original lease).  Returns
+        the number of seconds until the lease expires.
+        """
+        url = self.url("devices/%s/renew" % board)
+        if duration:
+            url += "?duration=%s" % duration
+        resp = self.http_get(url, headers=self.auth_headers())
+        resp_data = self.check_response(resp,
+                "Cannot perform renew operation on server",
+                "Could not renew lease of board %s. From server:\n " % board)
+        return self.get_data(resp_data, "Missing lease data from server.")["seconds"]
+
+    def board_queue(self, board):
+        """
+        Return a map with the user a board is assigned to ("assigned_to"),
+        and the users waiting for it ("waiting", a list of maps with
+        "user" and "waiting_seconds"), in order.
+        """
+        resp = self.http_get(self.url("devices/%s/queue" % board),
+                headers=self.auth_headers())
+        resp_data = self.check_response(resp,
+                "Cannot read queue for board %s from server" % board,
+                "Could not get queue for board %s. From server:\n " % board)
+        return self.get_data(resp_data, "Missing queue data from server.")
+
+    def release(self, board, force=False):
+        """
+        Release a board reserved by the user (or by any user, if force
+        is True).
+        """
+        url = self.url("devices/%s/release" % board)
+        if force:
+            url += "/force"
+
+        resp = self.http_get(url, headers=self.auth_headers())
+        self.check_response(resp, "Cannot perform release operation on server",
+                "", "Could not do 'assign' operation, for unknown reasons")
+
+    def power(self, board, operation):
+        """
+        Do a power operation on a board.  operation is one of
+        'status', 'on', 'off', or 'reboot'.  For 'status', returns the
+        power status ("ON", "OFF" or "UNKNOWN").
+        """
+        if operation not in POWER_OPERATIONS:
+            raise error_class("Invalid power operation specified.\n" + \
+                "Please specify one of 'status', 'on', 'off', or 'reboot'.")
+
+        url = self.url("devices/%s/power/%s" % (board, operation))
+        resp = self.http_get(url, headers=self.auth_headers())
+        resp_data = self.check_response(resp,
+                "Cannot perform power %s operation on server" % operation,
+                "Could not do operation 'power %s'. " % operation)
+
+        if operation == "status":
+            return resp_data["data"]
+        return None
+
+    def run(self, board, command):
+        """
+        Run a command on a board.  Returns a tuple with the return code
+        of the command, and a list of lines of output.
+        """
+        result = self.run_result(board, command)
+        lines = result["data"]
+        if result.get("stdout_truncated"):
+            output = b"".join(self.run_output(board, result["output_id"]))
+            lines = output.decode("utf8", "replace").splitlines(True)
+        return (result["return_code"], lines)
+
+    def run_result(self, board, command):
+        """
+        Run a command on a board.  Returns a map with the "return_code"
+        of the command, and the lines of its output, in "data" (stdout)
+        and "errors" (stderr).  If the output of a stream is too large,
+        "stdout_truncated" (or "stderr_truncated") is True, and "data"
+        (or "errors") has the lines at the start of the output, and
+        "data_tail" (or "errors_tail") has the lines at the end.  All of
+        the output can be read with run_output(), using "output_id".
+        """
+        url = self.url("devices/%s/run/" % board)
+        jdata = json.dumps({ "command": command, "device_ip": "*",
+                "username": "*" })
+        headers = self.auth_headers()
+        headers["Content-type"] = "application/json"
+
+        resp = self.http_post(url, headers=headers, data=jdata)
+        resp_data = self.check_response(resp,
+                "Cannot perform 'run' operation on server",
+                "Could not do operation 'run'. ")
+
+        return resp_data["data"]
+
+    def run_output(self, board, output_id, stream="stdout", offset=0,
+            length=None):
+        """
+        Read the output of a command run with run_result(), starting at
+        offset bytes into the output of stream ("stdout" or "stderr"),
+        up to length bytes (or to the end).  This is a generator that
+        yields the output (as bytes) as it is received.
+        """
+        url = self.url("devices/%s/run-output/%s/%s?offset=%d" % (board,
+                output_id, stream, offset))
+        if length is not None:
+            url += "&length=%d" % length
+
+        resp = self.http_get(url, headers=self.auth_headers(), stream=True)
+        content_type = resp.headers.get("content-type", "")
+        if resp.status_code != 200 or \
+                not content_type.startswith("application/octet-stream"):
+            try:
+                reason = resp.json()["message"]
+            except:
+                reason = "for unknown reasons"
+            raise error_class("Could not read run output. From server:\n %s" % reason)
+
+        try:
+            for chunk in resp.iter_content(65536):
+                yield chunk
+        except connection_errors():
+            raise connection_error_class()
+
+    def get_resource(self, board, res_type, feature=None):
+        """
+        Return the name of the resource of type res_type connected to
+        a board, matching the feature string if specified.
+        """
+        key = "get_resource/%s/%s/%s" % (board, res_type, feature or "")
+        resource = self.cache_get(key)
+        if resource is not None:
+            return resource
+
+        url = self.url("devices/%s/get_resource/%s" % (board, res_type))
+        if feature:
+            # make feature string suitable to append to url
+            url += "/" + quote(feature).replace("/", "%2F")
+
+        resp = self.http_get(url, headers=self.auth_headers())
+        try:
+            resp_data = self.check_response(resp,
+                    "Cannot perform 'get_resource' operation on server", "")
+        except error_class as e:
+            reason = str(e)
+            if reason.startswith("Error: "):
+                reason = reason[6:]
+            raise error_class(reason)
+
+        resource = self.get_data(resp_data)
+        self.cache.put(key, resource)
+        return resource
+
+    def set_config(self, resource, res_type, config_data):
+        """
+        Set the configuration of a resource.  config_data is a map of
+        configuration attributes (or a json string).
+        """
+        if isinstance(config_data, dict):
+            config_data = json.dumps(config_data)
+
+        operation = "set-config"
+        url = self.url("resources/%s/%s/set-config" % (resource, res_type))
+
+        resp = self.http_post(url, headers=self.auth_headers(),
+                data=config_data)
+        self.check_response(resp,
+                "Cannot perform %s %s operation on server" % (res_type, operation),
+                "Could not do operation '%s %s'. From server:\n " % \
+                        (res_type, operation))
+
+    def capture(self, resource, res_type, operation, token=None,
+            start_time=None, end_time=None):
+        """
+        Do a capture operation with a resource.  res_type is 'serial'
+        or 'power_measurement', and operation is one of 'start',
+        'stop', 'get-data' or 'delete'.  token is required for
+        operations other than 'start'.
+
+        'start' returns the token for the capture, and 'get-data'
+        returns the captured data.  For 'get-data', start_time and
+        end_time select the lines with timestamps in that range.
+        """
+        if operation not in CAPTURE_OPERATIONS:
+            raise error_class("Invalid %s operation specified.\n" % res_type + \
+                "Please specify one of 'start', 'stop', 'get-data', or 'delete'.")
+
+        url_op  = { "start": "start_capture", "stop": "stop_capture",
+                "get-data": "get-data", "delete": "delete" }[operation]
+
+        url = self.url("resources/%s/%s/%s" % (resource, res_type, url_op))
+        if operation != "start":
+            if not token:
+                raise error_class("No token provided for '%s' operation.\n" % operation)
+            url += "/%s" % token
+        if operation == "get-data":
+            params = []
+            if start_time is not None:
+                params.append("start_time=%r" % float(start_time))
+            if end_time is not None:
+                params.append("end_time=%r" % float(end_time))
+            if params:
+                url += "?" + "&".join(params)
+
+        # FIXTHIS - capture operations should be a 'post' according to the spec
+        resp = self.http_get(url, headers=self.auth_headers())
+        resp_data = self.check_response(resp,
+                "Cannot perform %s %s operation on server" % (res_type, operation),
+                "Could not do operation '%s %s'. From server:\n " % \
+                        (res_type, operation))
+
+        if operation == "start":
+            return self.get_data(resp_data,
+                    "Missing data capture token from server.")
+        if operation == "get-data":
+            return self.get_data(resp_data, "Missing captured data from server.")
+        return None
+
+    def power_stats(self, resource, token, percentiles=None):
+        """
+        Return the statistics of a power measurement capture (which may
+        still be running), as a map with the "energy" (in joules),
+        "duration" (in seconds), number of "samples", "mean_power",
+        "peak_power" and "min_power" (in watts), the power at each of
+        the requested "percentiles" (a map from the percentile to the
+        power), and whether the capture is "running".
+        """
+        url = self.url("resources/%s/power_measurement/stats/%s" % (resource, token))
+        if percentiles:
+            url += "?percentiles=%s" % ",".join([str(p) for p in percentiles])
+        resp = self.http_get(url, headers=self.auth_headers())
+        resp_data = self.check_response(resp,
+                "Cannot perform power_measurement stats operation on server",
+                "Could not do operation 'power_measurement stats'. From server:\n ")
+        return self.get_data(resp_data, "Missing power measurement stats from server.")
+
+    def capture_usage(self, resource=None):
+        """
+        Return the disk usage of the capture logs on the server (for all
+        resources, or only for the indicated resource).
+
+        Returns a map with the total "size" and "quota" (in bytes), the
+        usage for each resource in "resources", and a list of the
+        "captures", with the "token", "resource", "size" and state of
+        each one.
+        """
+        url = self.url("captures")
+        if resource:
+            url += "?resource=%s" % quote(resource)
+        resp = self.http_get(url, headers=self.auth_headers())
+        resp_data = self.check_response(resp,
+                "Cannot read capture usage from server",
+                "Could not read capture usage. From server:\n ")
+        return self.get_data(resp_data, "Missing capture usage from server.")
+
+    def import_objects(self, data, replace=False):
+        """
+        Add (or replace) many boards and resources at once.  data is the
+        text of a json document with "boards" and "resources" lists (like
+        the one from export_objects()), or of NDJSON lines with a
+        "board" or "resource" object on each line.  Either all of the
+        objects are saved, or none are.  If replace is True, objects
+        that are already registered are replaced.
+
+        Returns a map with the number of objects "added", "replaced" and
+        "unchanged".
+        """
+        url = self.url("import")
+        if replace:
+            url += "?replace=1"
+        headers = self.auth_headers()
+        headers["Content-type"] = "application/json"
+
+        resp = self.http_post(url, headers=headers, data=data)
+        resp_data = self.check_response(resp,
+                "Cannot import objects to server",
+                "Could not import objects. From server:\n ")
+        return self.get_data(resp_data, "Missing import counts from server.")
+
+    def export_objects(self):
+        """
+        Return a map with the "boards" and "resources" lists of all the
+        objects registered with the server (as used by import_objects()).
+        """
+        resp = self.http_get(self.url("export"), headers=self.auth_headers())
+        resp_data = self.check_response(resp,
+                "Cannot export objects from server",
+                "Could not export objects. From server:\n ")
+        return self.get_data(resp_data, "Missing export data from server.")
+
+    def follow(self, resource, token, offset=0, res_type="serial",
+            heartbeat=None):
+        """
+        Follow a capture, starting at offset bytes into the captured
+        data.  This is a generator, that yields the captured data (as
+        bytes) as it arrives from the server.  It finishes when the
+        capture is stopped and all of its data has been received.
+
+        If the connection to the server is lost, following is resumed
+        at the offset of the last data received.
+        """
+        import base64
+        import time
+
+        url = self.url("resources/%s/%s/follow/%s" % (resource, res_type, token))
+        failures = 0
+        while True:
+            follow_url = url + "?offset=%d" % offset
+            if heartbeat:
+                follow_url += "&heartbeat=%s" % heartbeat
+            headers = self.auth_headers()
+            headers["Accept"] = "text/event-stream"
+
+            try:
+                resp = self.http_get(follow_url, headers=headers, stream=True)
+                if resp.status_code != 200:
+                    raise error_class("Cannot perform %s follow operation on server" % res_type)
+
+                content_type = resp.headers.get("content-type", "")
+                if not content_type.startswith("text/event-stream"):
+                    # an api response indicates an error
+                    try:
+                        reason = resp.json()["message"]
+                    except:
+                        reason = "for unknown reasons"
+                    raise error_class("Could not do operation '%s follow'. From server:\n %s" % (res_type, reason))
+
+                try:
+                    for (event, data) in read_events(resp):
+                        if event == "data":
+                            chunk = base64.b64decode(data)
+                            offset += len(chunk)
+                            failures = 0
+                            yield chunk
+                        elif event == "end":
+                            return
+                        elif event == "error":
+                            try:
+                                reason = json.loads(data)["message"]
+                            except:
+                                reason = "for unknown reasons"
+                            raise error_class("Could not do operation '%s follow'. From server:\n %s" % (res_type, reason))
+                finally:
+                    resp.close()
+            except connection_errors():
+                pass
+
+            # the stream ended without an 'end' event, so resume it
+            failures += 1
+            if failures > FOLLOW_RETRIES:
+                raise connection_error_class()
+            time.sleep(1)
+
+    def expect(self, resource, token, pattern, timeout=None, offset=0,
+            res_type="serial"):
+        """
+        Wait for the regular expression pattern to match the data of a
+        capture, starting at offset bytes into the captured data, for up
+        to timeout seconds (or the server's default timeout).
+
+        Returns a map with "matched" (True or False) and "offset" (where
+        a following expect can resume).  For a match, the map also has
+        "match", "start", "end", "groups", "time" and "line_time".
+        """
+        url = self.url("resources/%s/%s/expect/%s" % (resource, res_type, token))
+        url += "?pattern=%s&offset=%d" % (quote(pattern), offset)
+        if timeout is not None:
+            url += "&timeout=%s" % timeout
+        resp = self.http_get(url, headers=self.auth_headers())
+        resp_data = self.check_response(resp,
+                "Cannot perform %s expect operation on server" % res_type,
+                "Could not do operation '%s expect'. From server:\n " % res_type)
+        return self.get_data(resp_data, "Missing expect result from server.")
+
+    def transmit_test(self, resource, rates, sender=None, size=None):
+        """
+        Test serial transmission to a resource, at each of the baud
+        rates in the list rates.  The data is sent by the resource sender
+        (default: the same resource, for a port with a loopback
+        connection), and size is the number of bytes of test data.
+
+        Returns a list with a map of results for each rate (see
+        transmit_test in lcserver.py).
+        """
+        url = self.url("resources/%s/serial/transmit-test" % resource)
+        url += "?rates=%s" % ",".join([str(rate) for rate in rates])
+        if sender:
+            url += "&sender=%s" % quote(sender)
+        if size:
+            url += "&size=%d" % size
+        resp = self.http_get(url, headers=self.auth_headers())
+        resp_data = self.check_response(resp,
+                "Cannot perform serial transmit-test operation on server",
+                "Could not do operation 'serial transmit-test'. From server:\n ")
+        return self.get_data(resp_data, "Missing transmit test results from server.")
+
+    def put_data(self, resource, data, res_type="serial"):
+        """
+        Put data to a resource.  data is a string, or a file object.
+        Data in a regular file is streamed to the server.  Returns
+        transfer statistics ("bytes", "seconds", and "bytes_per_second"),
+        if the server provides them.
+        """
+        if hasattr(data, "read"):
+            import stat
+            if not stat.S_ISREG(os.fstat(data.fileno()).st_mode):
+                # the server needs the content length, so read data from a
+                # pipe into memory
+                data = data.read()
+
+        url = self.url("resources/%s/%s/put-data" % (resource, res_type))
+        resp = self.http_post(url, headers=self.auth_headers(), data=data)
+        resp_data = self.check_response(resp,
+                "Cannot perform %s put-data operation on server" % res_type,
+                "Could not do operation '%s put-data'. From server:\n " % res_type)
+
+        return resp_data.get("data", None)
+
+    # return the url for a file transfer operation on a board
+    # operation is one of 'upload', 'download' or 'checksum'
+    def transfer_url(self, board, operation, method, path):
+        if method not in TRANSFER_METHODS:
+            raise error_class("Invalid transfer method '%s'. Please specify one of 'ssh' or 'serial'." % method)
+
+        path_q = quote(path)
+        if operation == "checksum":
+            api_path = "checksum/%s?path=%s" % (method, path_q)
+        elif method == "ssh":
+            op = { "upload": "upld", "download": "downld" }[operation]
+            api_path = "%s/ssh?path=%s" % (op, path_q)
+        else:
+            api_path = "%s/serial?path=%s" % (operation, path_q)
+
+        return self.url("devices/%s/%s" % (board, api_path))
+
+    def remote_checksum(self, board, path, method="ssh"):
+        """
+        Return the sha256 checksum of a file on a board, or None if the
+        board can not provide it.
+        """
+        url = self.transfer_url(board, "checksum", method, path)
+        resp = self.http_get(url, headers=self.auth_headers())
+        try:
+            resp_data = resp.json()
+        except:
+            resp_data = {}
+        if resp_data.get("result", "") == RSLT_OK:
+            return resp_data["data"]["sha256"]
+        return None
+
+    def upload(self, board, src, dest, method="ssh"):
+        """
+        Upload the local file src to the path dest on a board.
+        Returns a map with the "bytes" and "sha256" of the data.
+        """
+        try:
+            data = open(src, "rb")
+        except IOError:
+            raise error_class("Could not open file '%s' for upload" % src)
+
+        checksum = file_checksum(src)
+
+        url = self.transfer_url(board, "upload", method, dest)
+        headers = self.auth_headers()
+        headers["Content-Type"] = "application/octet-stream"
+
+        # the file object is streamed to the server
+        try:
+            resp = self.http_post(url, headers=headers, data=data)
+        finally:
+            data.close()
+        resp_data = self.check_response(resp,
+                "Cannot perform upload operation on server",
+                "Could not do operation 'upload'. From server:\n ")
+
+        server_checksum = resp_data["data"]["sha256"]
+        if server_checksum != checksum:
+            raise error_class("Checksum mismatch for upload of '%s'\n" % src + \
+                    "local=%s, server=%s" % (checksum, server_checksum))
+
+        return { "bytes": resp_data["data"]["bytes"], "sha256": checksum }
+
+    def download(self, board, src, dest, method="ssh", resume=False,
+            verify=True):
+        """
+        Download the file at path src on a board, to the local file dest.
+        If resume is True, data already in dest is kept, and only the
+        rest of the file is downloaded.
+
+        The server can't report a download command that fails after the
+        data has started, so the checksum of the file is compared with
+        the checksum of the file on the board.  If verify is True, the
+        download fails if the board can't provide the checksum.
+
+        Returns a map with the "bytes" and "sha256" of the file, and
+        "verified", which indicates whether the checksum was compared
+        with the checksum of the file on the board.
+        """
+        offset = 0
+        if resume and os.path.exists(dest):
+            offset = os.path.getsize(dest)
+
+        import hashlib
+        hasher = hashlib.sha256()
+        if offset:
+            mode = "r+b"
+            # include data already downloaded in the checksum
+            with open(dest, "rb") as f:
+                while True:
+                    chunk = f.read(65536)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+        else:
+            mode = "wb"
+
+        url = self.transfer_url(board, "download", method, src)
+        headers = self.auth_headers()
+        if offset:
+            url += "&offset=%d" % offset
+            headers["Range"] = "bytes=%d-" % offset
+
+        resp = self.http_get(url, headers=headers, stream=True)
+        if resp.status_code != 200:
+            raise error_class("Cannot perform download operation on server")
+
+        content_type = resp.headers.get("content-type", "")
+        if not content_type.startswith("application/octet-stream"):
+            # an api response indicates an error
+            try:
+                reason = resp.json()["message"]
+            except:
+                reason = "for unknown reasons"
+            raise error_class("Could not do operation 'download'. From server:\n %s" % reason)
+
+        count = 0
+        try:
+            with open(dest, mode) as f:
+                f.seek(offset)
+                for chunk in resp.iter_content(65536):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    count += len(chunk)
+                f.truncate()
+        except connection_errors():
+            raise connection_error_class()
+
+        checksum = hasher.hexdigest()
+
+        # compare with checksum of the file on the board, if available
+        board_checksum = self.remote_checksum(board, src, method)
+        if board_checksum and board_checksum != checksum:
+            raise error_class("Checksum mismatch for download of '%s'\n" % src + \
+                    "local=%s, board=%s" % (checksum, board_checksum))
+        if not board_checksum and verify:
+            raise error_class("Could not verify download of '%s' (%d bytes)\n" % (src, offset + count) + \
+                    "The board did not provide a checksum, so the data may be incomplete.")
+
+        return { "bytes": offset + count, "sha256": checksum,
+                "verified": board_checksum is not None }
+
+Client = client_class
@@ -67,7 +67,6 @@ except ImportError:
 #import yaml
 import copy
 import shlex
-import subprocess
 import signal
 import threading   # used for Timer objects
 
@@ -78,14 +77,6 @@ debug_api_response = False
 # uncomment this to dump response data to the log file
 #debug_api_response = True
 
-# Keep track of which getstatusoutput I'm using
-using_commands_gso = False
-try:
-    from subprocess import getstatusoutput
-except:
-    from commands import getstatusoutput
-    using_commands_gso = True
-
 VERSION=(0,6,0)
 
 # precedence of installation locations:
@@ -101,6 +92,9 @@ if not os.path.exists(base_dir):
 RSLT_FAIL="fail"
 RSLT_OK="success"
 
+# API responses smaller than this are not compressed
+GZIP_MIN_SIZE = 1024
+
 # this is used for debugging only
 def log_this(msg):
     with open(base_dir+"/lcserver.log" ,"a") as f:
@@ -113,6 +107,15 @@ def dlog_this(msg):
         with open(base_dir+"/lcserver.log" ,"a") as f:
             f.write("[%s] %s\n" % (get_timestamp(), msg))
 
+# record a performance metric (e.g. command spawn latency)
+# metrics go to a separate file, so they can be processed by other tools
+def log_metric(name, value, units="", detail=""):
+    with open(base_dir+"/lcserver-metrics.log" ,"a") as f:
+        line = "[%s] %s=%f%s" % (get_timestamp(), name, value, units)
+        if detail:
+            line += " " + detail
+        f.write(line + "\n")
+
 # define an instance to hold config vars
 class config_class:
     def __init__(self):
@@ -133,6 +136,29 @@ else:
 config.files_url_base = "/lc-data"
 config.files_dir = base_dir + "/files"
 config.page_dir = base_dir + "/pages"
+config.cache_dir = base_dir + "/cache"
+
+# capture logs are kept in the capture directory, which can be set with
+# LC_CAPTURE_DIR (for example, to put them on a larger disk)
+config.capture_dir = os.environ.get("LC_CAPTURE_DIR", base_dir + "/captures")
+# maximum size of all capture logs, in bytes (see "Capture retention")
+try:
+    config.capture_quota = int(os.environ.get("LC_CAPTURE_QUOTA",
+            str(1024*1024*1024)))
+except ValueError:
+    config.capture_quota = 1024*1024*1024
+
+# the output of commands run on boards is kept in the run output
+# directory, which can be set with LC_RUN_OUTPUT_DIR
+config.run_output_dir = os.environ.get("LC_RUN_OUTPUT_DIR",
+        base_dir + "/run-output")
+# maximum number of bytes of each output stream (stdout and stderr) of a
+# run command that is returned in the response (see "Run output")
+try:
+    config.run_output_limit = int(os.environ.get("LC_RUN_OUTPUT_LIMIT",
+            str(64*1024)))
+except ValueError:
+    config.run_output_limit = 64*1024
 
 class req_class:
     def __init__(self, config, form):
@@ -146,6 +172,18 @@ class req_class:
         self.api_path = ""
         self.obj_path = ""
         self.user = None
+        # for streamed requests, the body is read from body_stream
+        # (instead of being parsed into the form)
+        self.body_stream = None
+        self.body_length = 0
+        self.body_bytes = 0
+        # content encoding of a streamed body ("gzip" or "")
+        self.body_encoding = ""
+        # raw_body is output after the html, without a trailing newline
+        self.raw_body = None
+        # for streamed responses (see start_stream)
+        self.streamed = False
+        self.compressor = None
 
     def set_page_name(self, page_name):
         page_name = re.sub(" ","_",page_name)
@@ -157,13 +195,9 @@ class req_class:
             raise AttributeError, "Missing attribute"
         return self.config.page_dir+os.sep+self.page_name
 
+    # returns the text of a page template (see get_template)
     def read_page(self, page_name=""):
-        if not page_name:
-            page_filename = self.page_filename()
-        else:
-                page_filename = self.config.page_dir+os.sep+page_name
-
-        return open(page_filename).read()
+        return get_template(page_name or self.page_name).text
 
     def make_url(self, page_name):
         page_name = re.sub(" ","_",page_name)
@@ -207,6 +241,57 @@ class req_class:
     def html_error(self, msg):
         return "<font color=red>" + msg + "</font><BR>"
 
+    # return the request body, in chunks
+    # For streamed requests (see is_streaming_request()), the body is read
+    # directly from the client, and is never held in memory or in a file.
+    # body_bytes has the number of bytes read so far.
+    # A gzip-encoded streamed body is decompressed as it is read, and
+    # body_bytes counts the decompressed bytes.
+    def body_chunks(self, chunk_size=65536):
+        self.body_bytes = 0
+        if self.body_stream:
+            if self.body_encoding == "gzip":
+                import zlib
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                decompressor = None
+            remaining = self.body_length
+            while remaining > 0:
+                chunk = self.body_stream.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                    if not chunk:
+                        continue
+                self.body_bytes += len(chunk)
+                yield chunk
+            if decompressor:
+                chunk = decompressor.flush()
+                if chunk:
+                    self.body_bytes += len(chunk)
+                    yield chunk
+            return
+
+        body_file = self.form.file
+        if not body_file and self.form.list and "file" in self.form:
+            # multipart form upload (e.g. from 'curl --form file=@...')
+            body_file = self.form["file"].file
+        if not body_file:
+            data = self.form.value
+            self.body_bytes = len(data)
+            yield data
+            return
+
+        body_file.seek(0)
+        while True:
+            chunk = body_file.read(chunk_size)
+            if not chunk:
+                break
+            self.body_bytes += len(chunk)
+            yield chunk
+
     def send_response(self, result, data):
         self.html.append("Content-type: text/plain\n\n%s\n" % result)
         self.html.append(data)
@@ -215,26 +300,161 @@ class req_class:
     def send_api_response(self, result, data = {}):
         data["result"] = result
 
-        json_data = json.dumps(data, sort_keys=True, indent=4,
-            separators=(',', ': '))
+        json_data = api_json(data)
 
         if debug_api_response:
             log_this("response json_data=%s" % json_data)
 
-        self.html.append("Content-type: text/plain\n\n")
-        self.html.append(json_data)
+        self.send_api_data(json_data)
 
     def send_api_response_msg(self, result, msg):
         self.send_api_response(result, { "message": msg })
 
     def send_api_list_response(self, data):
+        self.send_api_chunks(json_list_chunks(data))
+
+    # output the json data for an API response
+    # Large responses are gzip-compressed, if the client accepts that.
+    def send_api_data(self, json_data, etag=None):
+        headers = "Content-type: text/plain\n" + self.api_headers()
+        headers += "Vary: Accept-Encoding\n"
+        if etag:
+            headers += "ETag: %s\n" % etag
+        if len(json_data) >= GZIP_MIN_SIZE and self.accepts_gzip():
+            self.html.append(headers + "Content-Encoding: gzip\n")
+            self.raw_body = gzip_data(json_data)
+            return
 
-        json_data = json.dumps(data, sort_keys=True, indent=4,
-            separators=(',', ': '))
-
-        self.html.append("Content-type: text/plain\n\n")
+        self.html.append(headers)
         self.html.append(json_data)
 
+    # Streamed responses
+    # start_stream() sends the headers (after any html that was produced
+    # before it), and write() sends data to the client as it is produced,
+    # so that a large response is never held in memory, and the client
+    # gets the start of it right away.  If gzip is True, the data is
+    # compressed as it is written.  end_stream() finishes the response.
+    def start_stream(self, headers, gzip=False):
+        import zlib
+
+        self.flush_html()
+        if gzip:
+            headers += "Content-Encoding: gzip\n"
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED,
+                    16 + zlib.MAX_WBITS)
+        sys.stdout.write(headers + "\n")
+        self.streamed = True
+
+    def write(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data)
+        if data:
+            sys.stdout.write(data)
+
+    def end_stream(self):
+        if self.compressor:
+            sys.stdout.write(self.compressor.flush())
+            self.compressor = None
+        sys.stdout.flush()
+
+    # send the html produced so far to the client
+    def flush_html(self):
+        for line in self.html:
+            print(line)
+        self.html = []
+        sys.stdout.flush()
+
+    # send an API response from chunks of its json text
+    # A small response is sent like other responses (see send_api_data),
+    # and a larger one is streamed.
+    def send_api_chunks(self, chunks, etag=None):
+        chunks = iter(chunks)
+        pending = []
+        size = 0
+        for chunk in chunks:
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= GZIP_MIN_SIZE:
+                break
+        else:
+            self.send_api_data("".join(pending), etag)
+            return
+
+        headers = "Content-type: text/plain\n" + self.api_headers()
+        headers += "Vary: Accept-Encoding\n"
+        if etag:
+            headers += "ETag: %s\n" % etag
+        self.start_stream(headers, self.accepts_gzip())
+        for chunk in pending:
+            self.write(chunk)
+        for chunk in chunks:
+            self.write(chunk)
+        if not self.compressor:
+            # end the text like print() does for buffered responses
+            self.write("\n")
+        self.end_stream()
+
+    # send an API response with the result, and a string value (like
+    # captured data) that is made from chunks, as they are produced
+    def send_api_string_response(self, result, name, chunks):
+        import codecs
+
+        marker = "STREAMED-VALUE"
+        head, tail = api_json({ name: marker, "result": result }).split(
+                json.dumps(marker))
+
+        def json_chunks():
+            # a chunk may end in the middle of a utf-8 character
+            decoder = codecs.getincrementaldecoder("utf8")("replace")
+            yield head + '"'
+            for chunk in chunks:
+                text = decoder.decode(chunk)
+                if text:
+                    yield json.dumps(text)[1:-1]
+            yield json.dumps(decoder.decode("", True))[1:-1] + '"' + tail
+
+        self.send_api_chunks(json_chunks())
+
+    # return extra headers for API responses
+    # Accept-Encoding tells clients that request bodies may be gzip-encoded
+    def api_headers(self):
+        return "X-Lab-Generation: %d\nAccept-Encoding: gzip\n" % \
+                get_lab_generation(self)
+
+    # returns True if the client already has the version of the
+    # response with this etag (from the If-None-Match header)
+    def etag_matches(self, etag):
+        if_none_match = self.environ.get("HTTP_IF_NONE_MATCH", "")
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == etag or tag == "*":
+                return True
+        return False
+
+    # tell the client that its version of the response is current
+    def send_not_modified(self, etag):
+        self.html.append("Status: 304 Not Modified\nETag: %s\n" % etag + \
+                self.api_headers() + "Vary: Accept-Encoding\n")
+
+    # returns True if the client accepts gzip-encoded responses
+    def accepts_gzip(self):
+        accept = self.environ.get("HTTP_ACCEPT_ENCODING", "")
+        for item in accept.split(","):
+            parts = item.strip().split(";")
+            if parts[0].strip().lower() not in ["gzip", "x-gzip"]:
+                continue
+            for param in parts[1:]:
+                name, _, value = param.strip().partition("=")
+                if name == "q":
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+
     def get_user(self):
         # returns valid user name or None
         user = None
@@ -352,6 +572,233 @@ def save_file(req, file_field, upload_dir):
     msg += "File '%s' uploaded successfully!\n" % fileitem.filename
     return RSLT_OK, msg, filepath
 
+# The lab generation number changes whenever the lab configuration
+# (the boards and resources, and how they are connected) changes.
+# It is sent to clients in the X-Lab-Generation header of API responses,
+# so they can tell when cached lab data is out of date.
+#
+# The number is bumped by API operations that change boards or resources.
+# Boards and resources that are added or removed by hand are detected by
+# a change of the modification time of their directories.
+LAB_GENERATION_FILENAME = "lab-generation.json"
+
+def lab_config_mtimes(req):
+    mtimes = []
+    for obj_type in ["board", "resource"]:
+        try:
+            mtimes.append(os.stat(req.config.data_dir + os.sep + obj_type + "s").st_mtime)
+        except OSError:
+            mtimes.append(0)
+    return mtimes
+
+# increment the lab generation number, and return it
+# if only_if_changed is True, the number is only incremented if the
+# board or resource directories changed since it was last incremented
+def bump_lab_generation(req, only_if_changed=False):
+    import fcntl
+
+    path = req.config.data_dir + os.sep + LAB_GENERATION_FILENAME
+    with open(path, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            info = json.loads(f.read())
+        except ValueError:
+            info = {}
+
+        mtimes = lab_config_mtimes(req)
+        generation = info.get("generation", 0)
+        if only_if_changed and info.get("mtimes", None) == mtimes:
+            return generation
+
+        generation += 1
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps({ "generation": generation, "mtimes": mtimes }))
+    return generation
+
+def get_lab_generation(req):
+    path = req.config.data_dir + os.sep + LAB_GENERATION_FILENAME
+    try:
+        info = json.load(open(path))
+    except (IOError, ValueError):
+        info = {}
+
+    generation = info.get("generation", 0)
+    if info.get("mtimes", None) != lab_config_mtimes(req):
+        try:
+            generation = bump_lab_generation(req, only_if_changed=True)
+        except IOError:
+            log_this("Error: cannot update lab generation file %s" % path)
+    return generation
+
+# return the lab generation number
+# This is a cheap request that clients use to check that their cached
+# lab data is current.  It has an ETag, so a client that already has
+# the current generation gets a '304 Not Modified'.
+def return_api_generation(req):
+    generation = get_lab_generation(req)
+    etag = make_etag("generation", generation)
+    if req.etag_matches(etag):
+        req.send_not_modified(etag)
+        return
+    req.send_api_data(api_json({ "result": RSLT_OK,
+            "data": { "generation": generation } }), etag)
+
+# Event log
+# Changes to the state of boards and resources (assign, release, power,
+# capture and configuration operations) are recorded in an event log,
+# so that clients can learn about changes without polling each board.
+#
+# Each event is a map with a "seq" number, which increases by one for
+# each event, a "type", a "time", and other fields depending on the type
+# (e.g. "board", "resource", "user").  The log is the file
+# lc-data/data/events.log, which has one event per line, as:
+#   {seq} {json event data}
+# The last sequence number is kept in events-seq.json.  When the log gets
+# large, it is moved to events.log.1 (replacing the previous one), so
+# only recent events are kept.
+#
+# Clients read events with api/v0.2/events?since={seq}, which waits
+# for a new event (for up to 'timeout' seconds), if there are no events
+# after {seq}.
+EVENT_LOG_FILENAME = "events.log"
+EVENT_SEQ_FILENAME = "events-seq.json"
+EVENT_LOG_MAX_SIZE = 1024*1024
+# how often to check for new events, while waiting (in seconds)
+EVENT_POLL_INTERVAL = 0.02
+EVENT_WAIT_DEFAULT = 30
+EVENT_WAIT_MAX = 120
+# maximum number of events returned in one response
+EVENT_LIST_MAX = 1000
+
+# add an event to the event log, and return its sequence number
+# data is a map with fields for the event (like "board" or "resource")
+def record_event(req, event_type, data):
+    return record_events(req, event_type, [data])
+
+# add events of the same type to the event log (with a single update of
+# the sequence number), and return the sequence number of the last one
+def record_events(req, event_type, data_list):
+    import fcntl
+
+    log_path = req.config.data_dir + os.sep + EVENT_LOG_FILENAME
+    seq_path = req.config.data_dir + os.sep + EVENT_SEQ_FILENAME
+    now = time.time()
+    try:
+        with open(seq_path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                seq = json.loads(f.read())["seq"]
+            except (ValueError, KeyError):
+                seq = 0
+
+            lines = []
+            for data in data_list:
+                seq += 1
+                event = dict(data)
+                event["type"] = event_type
+                event["time"] = now
+                event["seq"] = seq
+                lines.append("%d %s\n" % (seq, json.dumps(event, sort_keys=True)))
+
+            if os.path.exists(log_path) and \
+                    os.path.getsize(log_path) > EVENT_LOG_MAX_SIZE:
+                os.rename(log_path, log_path + ".1")
+            with open(log_path, "a") as log:
+                log.write("".join(lines))
+
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps({ "seq": seq }))
+    except IOError as error:
+        log_this("Error: cannot record %s event: %s" % (event_type, error))
+        return None
+    return seq
+
+def get_last_event_seq(req):
+    seq_path = req.config.data_dir + os.sep + EVENT_SEQ_FILENAME
+    try:
+        return json.load(open(seq_path))["seq"]
+    except (IOError, ValueError, KeyError):
+        return 0
+
+# return a list of the events after sequence number 'since', and
+# whether events were missed (because they are no longer in the log)
+def read_events(req, since):
+    log_path = req.config.data_dir + os.sep + EVENT_LOG_FILENAME
+    events = []
+    first_seq = None
+    for path in [log_path + ".1", log_path]:
+        try:
+            f = open(path)
+        except IOError:
+            continue
+        with f:
+            for line in f:
+                seq_str, _, event_data = line.partition(" ")
+                try:
+                    seq = int(seq_str)
+                except ValueError:
+                    continue
+                if first_seq is None:
+                    first_seq = seq
+                if seq <= since:
+                    continue
+                try:
+                    events.append(json.loads(event_data))
+                except ValueError:
+                    continue
+                if len(events) >= EVENT_LIST_MAX:
+                    return events, False
+
+    missed = first_seq is not None and first_seq > since + 1
+    return events, missed
+
+# returns a value that changes when the event log changes
+def event_log_state(req):
+    log_path = req.config.data_dir + os.sep + EVENT_LOG_FILENAME
+    try:
+        st = os.stat(log_path)
+        return (st.st_ino, st.st_size, st.st_mtime)
+    except OSError:
+        return None
+
+# return the events after 'since', waiting for up to 'timeout' seconds
+# for an event, if there are none
+def return_api_events(req):
+    last_seq = get_last_event_seq(req)
+    try:
+        since = int(req.form.getfirst("since", "-1"))
+        timeout = float(req.form.getfirst("timeout", str(EVENT_WAIT_DEFAULT)))
+    except ValueError:
+        req.send_api_response_msg(RSLT_FAIL, "Invalid 'since' or 'timeout' value for events")
+        return
+
+    if since < 0:
+        # no events requested, just the current sequence number
+        req.send_api_response(RSLT_OK, { "data": { "events": [],
+                "last_seq": last_seq, "missed": False } })
+        return
+
+    deadline = time.time() + min(max(timeout, 0), EVENT_WAIT_MAX)
+    state = event_log_state(req)
+    events, missed = read_events(req, since)
+    while not events and since <= last_seq and time.time() < deadline:
+        time.sleep(EVENT_POLL_INTERVAL)
+        new_state = event_log_state(req)
+        if new_state != state:
+            state = new_state
+            events, missed = read_events(req, since)
+
+    if events:
+        last_seq = events[-1]["seq"]
+    else:
+        last_seq = get_last_event_seq(req)
+    req.send_api_response(RSLT_OK, { "data": { "events": events,
+            "last_seq": last_seq, "missed": missed } })
+
 # this routine is the old-style action API, and is deprecated
 def do_put_object(req, obj_type):
     data_dir = req.config.data_dir + os.sep + obj_type + "s"
@@ -380,7 +827,8 @@ def do_put_object(req, obj_type):
             break
 
         # FIXTHIS - for cross references (board, resource), check that these
-        # are registered with the server
+        # are registered with the server (as check_import_objects() does
+        # for api/v0.2/import)
         # here is an example:
         # see if a referenced board is registered with the server
         #if field.startswith("board") or field.endswith("board"):
@@ -414,6 +862,10 @@ def do_put_object(req, obj_type):
     fout.write(data+'\n')
     fout.close()
 
+    if obj_type in ["board", "resource"]:
+        bump_lab_generation(req)
+        record_event(req, "config", { obj_type: obj_name, "operation": "put" })
+
     msg += "%s accepted (filename=%s)\n" % (obj_name, filename)
 
     if obj_type == "request":
@@ -475,6 +927,10 @@ def do_update_object(req, obj_type):
     fout.write(data+'\n')
     fout.close()
 
+    if obj_type in ["board", "resource"]:
+        bump_lab_generation(req)
+        record_event(req, "config", { obj_type: obj_name, "operation": "update" })
+
     req.send_response(RSLT_OK, data)
 
 # try matching with simple wildcards (* at start or end of string)
@@ -670,9 +1126,168 @@ def do_remove_object(req, obj_type):
     # only original-submitter and resource-host are allowed to remove
     os.remove(filepath)
 
+    if obj_type in ["board", "resource"]:
+        bump_lab_generation(req)
+        record_event(req, "config", { obj_type: obj_name, "operation": "remove" })
+
     msg += "%s %s was removed" % (obj_type, obj_name)
     req.send_response(RSLT_OK, msg)
 
+#######################
+# Page templates
+#
+# The tables of the web UI are rendered from templates, which are read
+# from the pages directory (config.page_dir).  A page that has no
+# template file there uses the built-in template in default_templates,
+# so a lab can change the look of a page by copying its template to the
+# pages directory and editing it.
+#
+# Templates use %(name)s fields, like the command attributes of
+# resources (and a literal percent sign is %%).  Field values are
+# html-escaped, except for fields whose names end with "_html", which
+# have markup made by the server (like the rows of a table).  Fields
+# that are missing from the values are empty.
+#
+# A template is compiled into a format string and a list of its fields,
+# and the compiled template is cached in memory, by the modification
+# time of the template file.  So a template that is used for each row
+# of a table is read and compiled once, and a change to a template file
+# is used by the next request.
+
+TEMPLATE_FIELD_RE = re.compile(r"%\((\w+)\)s")
+html_special_re = re.compile(r"[&<>\"]")
+
+default_templates = {
+"boards.html": """<H1>Boards</h1>
+<table class="board_table" border="1" style="border-collapse: collapse; padding: 5px" >
+<tr>
+  <th>Picture</th><th>Name</th><th>Description</th><th>Data and Actions</th>
+</tr>
+%(rows_html)s</table>
+""",
+
+"board-row.html": """<tr>
+  <td valign="middle" style="padding: 5px"><i>No picture</i></td>
+  <td valign="top" align="center" style="padding: 5px"><h3>%(name)s</h3>(in %(host)s)</td>
+  <td valign="top" style="padding: 5px">%(description)s</td>
+  <td style="padding: 10px">%(info_html)s</td>
+</tr>
+""",
+
+"board-info.html": """<h3>Resources</h3>
+<ul>
+%(resources_html)s</ul>
+<h3>Status</h3>
+<ul>
+<li>Reservation: %(reservation)s</li>
+<li>Power Status: %(power_status_html)s</li>
+</ul>
+<h3>Actions</h3>
+<ul>
+%(actions_html)s</ul>
+""",
+
+"resources.html": """<H1>List of resources</h1>
+<table class="resource_table" border="1" cellpadding="2">
+  <tr>
+    <th>Resource</th>
+    <th>Type</th>
+    <th>Board</th>
+    <th>Host</th>
+  </tr>
+%(rows_html)s</table>
+""",
+
+"resource-row.html": """  <tr>
+    <td><a href="%(file_url)s">%(name)s</a></td>
+    <td>%(type)s</td>
+    <td>%(board)s</td>
+    <td>%(host)s</td>
+  </tr>
+""",
+
+"requests.html": """<table border="1" cellpadding="2">
+  <tr>
+    <th>Request</th>
+    <th>State</th>
+    <th>Requestor</th>
+    <th>Host</th>
+    <th>Board</th>
+    <th>Test</th>
+    <th>Run (results)</th>
+  </tr>
+%(rows_html)s</table>
+""",
+
+"request-row.html": """  <tr>
+    <td><a href="%(file_url)s">%(file)s</a></td>
+    <td>%(state)s</td>
+    <td>%(requestor)s</td>
+    <td>%(host)s</td>
+    <td>%(board)s</td>
+    <td>%(test_name)s</td>
+    <td>%(run_id)s</td>
+  </tr>
+""",
+}
+
+class template_class:
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.fields = TEMPLATE_FIELD_RE.findall(text)
+        self.format = TEMPLATE_FIELD_RE.sub("%s", text)
+        try:
+            self.format % (("",) * len(self.fields))
+        except (TypeError, ValueError) as error:
+            raise ValueError("Invalid template %s: %s" % (name, error))
+
+        # fields, with whether they are escaped
+        self.field_list = [(field, not field.endswith("_html"))
+                for field in self.fields]
+
+    # returns the template, with the values (a map) in its fields
+    def render(self, values):
+        args = []
+        for field, escaped in self.field_list:
+            value = values.get(field, "")
+            if escaped:
+                if not isinstance(value, basestring):
+                    value = str(value)
+                if html_special_re.search(value):
+                    value = cgi.escape(value, True)
+            args.append(value)
+        return self.format % tuple(args)
+
+# compiled templates, by name: (mtime, template)
+# mtime is None for a built-in template
+template_cache = {}
+
+def get_template(name):
+    path = config.page_dir + os.sep + name
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        mtime = None
+
+    cached = template_cache.get(name, None)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    if mtime is None:
+        if name not in default_templates:
+            raise IOError("Cannot find template %s" % path)
+        text = default_templates[name]
+    else:
+        with open(path) as f:
+            text = f.read()
+    template = template_class(name, text)
+    template_cache[name] = (mtime, template)
+    return template
+
+def render_template(name, values):
+    return get_template(name).render(values)
+
 def file_list_html(req, file_type, subdir, extension):
     if file_type == "files":
         src_dir = req.config.files_dir + os.sep + subdir
@@ -702,6 +1317,9 @@ def file_list_html(req, file_type, subdir, extension):
     html += "</ul>"
     return html
 
+# number of rows of the requests table to render before sending them
+REQUEST_TABLE_FLUSH_ROWS = 100
+
 def show_request_table(req):
     src_dir = req.config.data_dir + os.sep + "requests"
 
@@ -715,83 +1333,100 @@ def show_request_table(req):
             filelist.append(f)
 
     if not filelist:
-        return req.html_error("No request files found.")
+        req.html.append(req.html_error("No request files found."))
+        return
+
+    # the rows are sent to the browser in groups, as they are rendered,
+    # so that a large table starts to show right away
+    marker = "<!-- REQUEST-ROWS -->"
+    page = render_template("requests.html", { "rows_html": marker })
+    head, sep, tail = page.partition(marker)
+    req.html.append(head)
 
     files_url = config.files_url_base + "/data/requests/"
-    html = """<table border="1" cellpadding="2">
-  <tr>
-    <th>Request</th>
-    <th>State</th>
-    <th>Requestor</th>
-    <th>Host</th>
-    <th>Board</th>
-    <th>Test</th>
-    <th>Run (results)</th>
-  </tr>
-"""
+    row_template = get_template("request-row.html")
+    rows = []
     for item in filelist:
         request_fd = open(src_dir+os.sep + item, "r")
         req_dict = json.load(request_fd)
         request_fd.close()
 
         # add data, in case it's missing
-        try:
-            run_id = req_dict["run_id"]
-        except:
+        if "run_id" not in req_dict:
             req_dict["run_id"] = "Not available"
+        req_dict["file"] = item
+        req_dict["file_url"] = files_url + item
+        rows.append(row_template.render(req_dict))
+        if len(rows) >= REQUEST_TABLE_FLUSH_ROWS:
+            if sep:
+                req.html.append("".join(rows))
+            req.flush_html()
+            rows = []
+
+    if sep:
+        req.html.append("".join(rows))
+    req.html.append(tail)
+
+# show a table of the resources, with links to their data
+def show_resources(req):
+    resources = get_object_list(req, "resource")
+    if not resources:
+        req.html.append(req.html_error("No resources found."))
+        return
 
-        html += '  <tr>\n'
-        html += '    <td><a href="'+files_url+item+'">' + item + '</a></td>\n'
-        for attr in ["state", "requestor", "host", "board", "test_name",
-                "run_id"]:
-            html += '    <td>%s</td>\n' % req_dict[attr]
-        html += '  </tr>\n'
-    html += "</table>"
-    req.html.append(html)
-
-# NOTE: we're inside a table cell here
-def show_board_info(req, bmap):
+    files_url = config.files_url_base + "/data/resources/"
+    row_template = get_template("resource-row.html")
+    rows = []
+    for resource in resources:
+        rmap = get_object_map(req, "resource", resource)
+        values = { "name": resource, "board": rmap.get("board", ""),
+            "host": rmap.get("host", ""),
+            "file_url": files_url + "resource-%s.json" % resource }
+        res_types = rmap.get("type", [])
+        if isinstance(res_types, list):
+            res_types = ", ".join(res_types)
+        values["type"] = res_types
+        rows.append(row_template.render(values))
+
+    req.html.append(render_template("resources.html",
+            { "rows_html": "".join(rows) }))
+
+# returns the html for the info of a board (in a cell of the boards table),
+# rendered with template
+def board_info_html(req, bmap, template):
     # list of connected resources
     # FIXTHIS - what to show here:
     # status, action button for reboot
     # reservations
-    req.html.append("<h3>Resources</h3>\n<ul>")
+    values = { "reservation": bmap.get("reservation", "None") }
     pc = bmap.get("power_controller", "")
-    resource_shown = False
     if pc:
-        req.html.append("<li>Power controller: %s</li>\n" % pc)
-        resource_shown = True
-    if not resource_shown:
-        req.html.append("<li><i>No connected resources found!</i></li>\n")
-    req.html.append("</ul>\n")
-
-    req.html.append("<h3>Status</h3>\n<ul>")
-
-    reservation = bmap.get("reservation", "None")
-    req.html.append("<li>Reservation: %s</li>" % reservation)
+        values["resources_html"] = "<li>Power controller: %s</li>\n" % \
+                cgi.escape(pc, True)
+    else:
+        values["resources_html"] = "<li><i>No connected resources found!</i></li>\n"
 
     # show power status
     if pc:
        (result, msg) = get_power_status(req, bmap)
        if result == RSLT_OK:
-           power_status = msg
+           power_status = cgi.escape(msg, True)
        else:
-           power_status = req.html_error(msg)
+           power_status = req.html_error(cgi.escape(msg, True))
     else:
        power_status = "Unknown"
-    req.html.append("<li>Power Status: %s</li>\n" % power_status)
-
-    req.html.append("</ul>\n")
+    values["power_status_html"] = power_status
 
-    req.html.append("<h3>Actions</h3>\n<ul>\n")
+    values["actions_html"] = ""
     if pc:
         reboot_link = req.config.url_base + "/api/devices/%s/power/reboot" % (bmap["name"])
-        req.html.append("""
+        values["actions_html"] = """
 <form method="get" action=%s>
 <input type="submit" name="button" value="Reboot">
 </form>
-""" % reboot_link)
-    req.html.append("</ul>")
+""" % reboot_link
+
+    return template.render(values)
 
 # returns (RSLT_OK, status|RSLT_FAIL, message)
 # status can be one of: "ON", "OFF", "UNKNOWN"
@@ -801,16 +1436,28 @@ def get_power_status(req, bmap):
         msg = "Board %s has no connected power_controller resource" % bmap["name"]
         return (RSLT_FAIL, msg)
 
+    driver, msg = get_driver(req, pdu_map, "power_controller")
+    if not driver:
+        return (RSLT_FAIL, msg)
+
+    return driver.power_status(bmap)
+
+# get power status using the status_cmd of the power controller resource
+# returns (RSLT_OK, status|RSLT_FAIL, message)
+# run is the function used to execute the command (see spawn_command)
+def exec_power_status(req, bmap, pdu_map, run=None):
     # lookup command to execute in resource_map
     if "status_cmd" not in pdu_map:
         msg = "Resource '%s' does not have status_cmd attribute, cannot execute" % pdu_map["name"]
         return (RSLT_FAIL, msg)
 
     cmd_str = pdu_map["status_cmd"]
-    rcode, status = getstatusoutput(cmd_str)
+    use_shell = cmd_uses_shell(pdu_map, "status")
+    rcode, status, errors = (run or spawn_command)(cmd_str, use_shell)
+    status = status.rstrip("\n")
     if rcode:
         msg = "Result of power status operation on board %s = %d\n" % (bmap["name"], rcode)
-        msg += "command output='%s'" % status
+        msg += "command output='%s'" % (status + errors)
         return (RSLT_FAIL, msg)
 
     # FIXTHIS - translate result here, if needed
@@ -819,28 +1466,24 @@ def get_power_status(req, bmap):
 
 # show the web ui for boards on this machine
 def show_boards(req):
-    req.html.append("<H1>Boards</h1>")
     boards = get_object_list(req, "board")
 
     # show a table of attributes
-    req.html.append('<table class="board_table" border="1" style="border-collapse: collapse; padding: 5px" >\n<tr>\n')
-    req.html.append("  <th>Picture</th><th>Name</th><th>Description</th><th>Data and Actions</th>\n</tr>\n")
+    row_template = get_template("board-row.html")
+    info_template = get_template("board-info.html")
+    rows = []
     for board in boards:
-        req.html.append("<tr>\n")
         bmap = get_object_map(req, "board", board)
-        req.html.append('  <td valign="middle" style="padding: 5px"><i>No picture</i></td>\n')
-        req.html.append('  <td valign="top" align="center" style="padding: 5px"><h3>%(name)s</h3>(in %(host)s)</td>\n' % bmap)
-        req.html.append('  <td valign="top" style="padding: 5px">%(description)s</td>\n' % bmap)
         # FIXTHIS - what to show here:
         # status, action for on/off/reboot
         # list of connected resources
         # reservations
-        req.html.append('  <td style="padding: 10px">')
-        show_board_info(req, bmap)
-        req.html.append("</td>\n")
-        req.html.append("</tr>\n")
+        values = dict(bmap)
+        values["info_html"] = board_info_html(req, bmap, info_template)
+        rows.append(row_template.render(values))
 
-    req.html.append("</table>")
+    req.html.append(render_template("boards.html",
+            { "rows_html": "".join(rows) }))
     req.show_footer()
 
 def show_users(req):
@@ -881,8 +1524,7 @@ def do_show(req):
         elif req.page_name == "users":
             show_users(req)
         elif req.page_name == "resources":
-            req.html.append("<H1>List of resources</h1>")
-            req.html.append(file_list_html(req, "data", "resources", ".json"))
+            show_resources(req)
         elif req.page_name == "requests":
             req.html.append("<H1>Table of requests</H1>")
             show_request_table(req)
@@ -986,8 +1628,138 @@ def get_object_list(req, obj_type):
 # resources/{resource} = show resource data (json file data)
 
 def return_api_object_list(req, obj_type):
-    obj_list = get_object_list(req, obj_type)
-    req.send_api_list_response(obj_list)
+    data_dir = req.config.data_dir + os.sep + obj_type + "s"
+    try:
+        etag = make_etag("list-" + obj_type, file_version(data_dir))
+    except OSError:
+        etag = None
+    if etag and req.etag_matches(etag):
+        req.send_not_modified(etag)
+        return
+
+    key = "list-" + obj_type
+    chunks = cached_response_chunks(req, key, etag)
+    if chunks is None:
+        chunks = cache_response_chunks(req, key, etag,
+                json_list_chunks(get_object_list(req, obj_type)))
+    req.send_api_chunks(chunks, etag)
+
+# ETags and conditional GETs
+# API responses for objects (boards and resources) and object lists have
+# an ETag that is derived from the version of the object.  The version
+# is based on the modification time and size of the object's file
+# (or of the object directory, for a list).  If a request has an
+# If-None-Match header with the current ETag, the response is a
+# '304 Not Modified', with no body.
+#
+# The json text of these responses is cached in files in lc-data/cache,
+# so an unchanged object is not parsed and formatted again for each
+# request.  A cached response is only used if its ETag is current.
+def file_version(path):
+    st = os.stat(path)
+    return "%x-%x-%x" % (st.st_ino, int(st.st_mtime * 1000000), st.st_size)
+
+# number of list items, or bytes of a cached response, in each chunk
+# of a streamed API response
+RESPONSE_CHUNK_ITEMS = 1000
+RESPONSE_CHUNK_SIZE = 64*1024
+
+# returns the json text of a list, in chunks
+# (this is the same text as api_json(items))
+def json_list_chunks(items):
+    if not items:
+        yield "[]"
+        return
+    yield "[\n"
+    for i in range(0, len(items), RESPONSE_CHUNK_ITEMS):
+        text = []
+        for item in items[i:i+RESPONSE_CHUNK_ITEMS]:
+            text.append("    " + api_json(item).replace("\n", "\n    "))
+        yield (",\n" if i else "") + ",\n".join(text)
+    yield "\n]"
+
+def make_etag(name, version):
+    return '"%s-%s"' % (name, version)
+
+def cached_response_path(req, key):
+    return req.config.cache_dir + os.sep + "response-%s.json" % key
+
+# return the cached json text for an API response, or None if the
+# response is not cached with the indicated etag
+def get_cached_response(req, key, etag):
+    if not etag:
+        return None
+    try:
+        with open(cached_response_path(req, key)) as f:
+            if f.readline().rstrip("\n") != etag:
+                return None
+            return f.read()
+    except IOError:
+        return None
+
+# returns an iterator over the chunks of the cached json text for an API
+# response, or None if the response is not cached with the indicated etag
+def cached_response_chunks(req, key, etag):
+    if not etag:
+        return None
+    try:
+        f = open(cached_response_path(req, key))
+    except IOError:
+        return None
+    if f.readline().rstrip("\n") != etag:
+        f.close()
+        return None
+    return file_chunks(f, RESPONSE_CHUNK_SIZE)
+
+# returns the chunks of the json text for an API response, and caches
+# the response as they are produced (when they have all been produced)
+def cache_response_chunks(req, key, etag, chunks):
+    if not etag:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    path = cached_response_path(req, key)
+    f = None
+    try:
+        if not os.path.isdir(req.config.cache_dir):
+            os.makedirs(req.config.cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=req.config.cache_dir)
+        f = os.fdopen(fd, "w")
+        f.write(etag + "\n")
+    except (IOError, OSError) as error:
+        log_this("Error: cannot cache response in %s: %s" % (path, error))
+
+    done = False
+    try:
+        for chunk in chunks:
+            if f:
+                f.write(chunk)
+            yield chunk
+        done = True
+    finally:
+        if f:
+            f.close()
+            if done:
+                os.rename(tmp_path, path)
+            else:
+                os.remove(tmp_path)
+
+def put_cached_response(req, key, etag, json_data):
+    if not etag:
+        return
+    path = cached_response_path(req, key)
+    try:
+        if not os.path.isdir(req.config.cache_dir):
+            os.makedirs(req.config.cache_dir)
+        # write to a temporary file and rename it, so that other
+        # requests never read a partial response
+        fd, tmp_path = tempfile.mkstemp(dir=req.config.cache_dir)
+        with os.fdopen(fd, "w") as f:
+            f.write(etag + "\n" + json_data)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as error:
+        log_this("Error: cannot cache response in %s: %s" % (path, error))
 
 # read data from json file (from data/{obj_type}s/{obj_type}-{obj_name}.json)
 # log any errors encountered
@@ -1114,23 +1886,289 @@ def get_connected_resource(req, board_map, resource_type):
     return resource_map
 
 def return_api_object_data(req, obj_type, obj_name):
-    # do default action for an object - return json file data (as a string)
-    data = get_api_object_map(req, obj_type, obj_name)
-    if not data:
+    file_path = "%s/%ss/%s-%s.json" %  (req.config.data_dir, obj_type, obj_type, obj_name)
+    try:
+        etag = make_etag(obj_type + "-" + obj_name, file_version(file_path))
+    except OSError:
+        # get_api_object_map() reports the error
+        etag = None
+    if etag and req.etag_matches(etag):
+        req.send_not_modified(etag)
+        return
+
+    key = obj_type + "-" + obj_name
+    json_data = get_cached_response(req, key, etag)
+    if json_data is None:
+        # do default action for an object - return json file data (as a string)
+        data = get_api_object_map(req, obj_type, obj_name)
+        if not data:
+            return
+
+        # perform any data transformations required for compliance with spec
+        # FIXTHIS - should manage this schema with TimeSys
+
+        data["result"] = RSLT_OK
+        json_data = api_json(data)
+        put_cached_response(req, key, etag, json_data)
+
+    req.send_api_data(json_data, etag)
+
+# Bulk import and export
+# api/v0.2/import (POST) adds or replaces many boards and resources at
+# once, from a document like the one from api/v0.2/export:
+#   { "boards": [ {board map}, ... ], "resources": [ {resource map}, ... ] }
+# or from NDJSON, with one object per line, as:
+#   { "board": {board map} } or { "resource": {resource map} }
+#
+# All the objects are checked before any of them is saved: each must
+# have a valid name, and references from resources to boards (the
+# "board" field) and from boards to resources (IMPORT_BOARD_RESOURCE_FIELDS)
+# must be to objects that are registered, or that are in the import.
+# Then the objects are written to a staging directory, and renamed into
+# place, so that either all of them are committed, or none are.
+#
+# An object that exists is only replaced if the 'replace' parameter is 1
+# (an object with the same data is left alone).
+IMPORT_OBJECT_TYPES = ["board", "resource"]
+IMPORT_BOARD_RESOURCE_FIELDS = ["power_controller", "power-controller",
+        "power_measurement", "serial", "canbus"]
+IMPORT_LOCK_FILENAME = "import.lock"
+# maximum number of errors in the message for a failed import
+IMPORT_ERRORS_SHOWN = 20
+object_name_re = re.compile(r"^\w[\w.+@-]*$")
+
+# returns a list of (obj_type, obj_map) tuples, and a reason on failure
+def parse_import_data(text):
+    try:
+        doc = json.loads(text)
+    except ValueError:
+        doc = None
+
+    objects = []
+    if isinstance(doc, dict) and not (len(doc) == 1 and
+            list(doc.keys())[0] in IMPORT_OBJECT_TYPES):
+        for key in doc.keys():
+            if key.endswith("s") and key[:-1] in IMPORT_OBJECT_TYPES and \
+                    isinstance(doc[key], list):
+                objects.extend([(key[:-1], obj_map) for obj_map in doc[key]])
+            else:
+                return None, "Unsupported element '%s' in import data" % key
+        return objects, ""
+
+    # parse as NDJSON
+    for line_no, line in enumerate(text.split("\n"), 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None, "Invalid json on line %d of import data" % line_no
+        if not isinstance(entry, dict) or len(entry) != 1 or \
+                list(entry.keys())[0] not in IMPORT_OBJECT_TYPES:
+            return None, "Line %d of import data is not a board or resource" % line_no
+        obj_type, obj_map = list(entry.items())[0]
+        objects.append((obj_type, obj_map))
+    return objects, ""
+
+# returns a map of obj_type to a map of the registered objects
+# (by name) of that type
+def read_object_maps(req, obj_types):
+    view = {}
+    for obj_type in obj_types:
+        view[obj_type] = {}
+        for name in get_object_list(req, obj_type):
+            view[obj_type][name] = get_object_map(req, obj_type, name)
+    return view
+
+# check the objects to import, against the view of the lab with the
+# objects added
+# returns a list of error messages
+def check_import_objects(objects, view):
+    errors = []
+    for obj_type, obj_map in objects:
+        name = obj_map["name"]
+        if obj_type == "resource":
+            board = obj_map.get("board", "")
+            if board and board not in view["board"]:
+                errors.append("resource '%s' refers to unknown board '%s'" % \
+                        (name, board))
+            continue
+
+        for field in IMPORT_BOARD_RESOURCE_FIELDS:
+            resource = obj_map.get(field, "")
+            if not resource:
+                continue
+            rmap = view["resource"].get(resource, None)
+            if rmap is None:
+                errors.append("board '%s' refers to unknown resource '%s' (from field '%s')" % (name, resource, field))
+                continue
+            res_types = rmap.get("type", [])
+            if not isinstance(res_types, list):
+                res_types = [res_types]
+            res_types = [t.replace("-", "_") for t in res_types]
+            if res_types and field.replace("-", "_") not in res_types:
+                errors.append("board '%s' refers to resource '%s', which is not a %s resource" % (name, resource, field))
+    return errors
+
+# save the imported objects, so that either all of them are saved, or
+# none are (on error, the previous files are restored)
+# objects is a list of (obj_type, obj_name, obj_map) tuples
+# This must be called with the import lock held.
+def commit_import(req, objects):
+    import shutil
+
+    data_dir = req.config.data_dir
+    staging_dir = tempfile.mkdtemp(prefix=".import-", dir=data_dir)
+    done = []
+    try:
+        for i, (obj_type, obj_name, obj_map) in enumerate(objects):
+            with open("%s/%d.json" % (staging_dir, i), "w") as f:
+                f.write(json.dumps(obj_map, sort_keys=True, indent=4,
+                    separators=(',', ': ')) + "\n")
+
+        for i, (obj_type, obj_name, obj_map) in enumerate(objects):
+            path = "%s/%ss/%s-%s.json" % (data_dir, obj_type, obj_type,
+                    obj_name)
+            try:
+                with open(path) as f:
+                    old_data = f.read()
+            except IOError:
+                old_data = None
+            os.rename("%s/%d.json" % (staging_dir, i), path)
+            done.append((path, old_data))
+    except (IOError, OSError):
+        for i, (path, old_data) in enumerate(reversed(done)):
+            if old_data is None:
+                os.remove(path)
+                continue
+            tmp_path = "%s/%d.orig" % (staging_dir, i)
+            with open(tmp_path, "w") as f:
+                f.write(old_data)
+            os.rename(tmp_path, path)
+        raise
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+# check the objects to import against the lab
+# returns changed, errors - where changed is a list of (obj_type, obj_map,
+# replaced) tuples for the new and replaced objects, and errors is a
+# list of error messages
+# This must be called with the import lock held.
+def check_import(req, objects, replace):
+    view = read_object_maps(req, IMPORT_OBJECT_TYPES)
+    errors = []
+    changed = []
+    names = set()
+    for obj_type, obj_map in objects:
+        name = obj_map.get("name", "") if isinstance(obj_map, dict) else ""
+        if not isinstance(name, basestring) or not object_name_re.match(name):
+            errors.append("%s with invalid or missing name '%s'" % \
+                    (obj_type, name))
+            continue
+        if (obj_type, name) in names:
+            errors.append("%s '%s' is in the import data more than once" % \
+                    (obj_type, name))
+            continue
+        names.add((obj_type, name))
+
+        old_map = view[obj_type].get(name, None)
+        if old_map == obj_map:
+            continue
+        if old_map is not None and not replace:
+            errors.append("%s '%s' is already registered (use replace=1 to replace it)" % (obj_type, name))
+            continue
+        view[obj_type][name] = obj_map
+        changed.append((obj_type, obj_map, old_map is not None))
+
+    # registered boards that refer to a changed resource are checked
+    # too, since the type of the resource may have changed
+    checked = [(obj_type, obj_map) for obj_type, obj_map, _ in changed]
+    changed_names = set((obj_type, obj_map["name"])
+            for obj_type, obj_map in checked)
+    for name in sorted(view["board"].keys()):
+        if ("board", name) in changed_names:
+            continue
+        board_map = view["board"][name]
+        for field in IMPORT_BOARD_RESOURCE_FIELDS:
+            resource = board_map.get(field, "")
+            if isinstance(resource, basestring) and \
+                    ("resource", resource) in changed_names:
+                checked.append(("board", board_map))
+                break
+
+    errors.extend(check_import_objects(checked, view))
+    return (changed, errors)
+
+def return_api_import(req):
+    import fcntl
+    import urlparse
+
+    user = req.get_user()
+    if not user or user == "nobody":
+        req.send_api_response_msg(RSLT_FAIL, "Cannot determine user for import")
+        return
+
+    params = urlparse.parse_qs(req.environ.get("QUERY_STRING", ""))
+    replace = params.get("replace", ["0"])[0] == "1"
+
+    objects, reason = parse_import_data(req.form.value or "")
+    if not reason and not objects:
+        reason = "No boards or resources in import data"
+    if reason:
+        req.send_api_response_msg(RSLT_FAIL, reason)
         return
 
-    # perform any data transformations required for compliance with spec
-    # FIXTHIS - should manage this schema with TimeSys
+    # the lab is read and checked with the import lock held, so that two
+    # imports can not both pass the checks and then overwrite each other
+    with open(req.config.data_dir + os.sep + IMPORT_LOCK_FILENAME, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        changed, errors = check_import(req, objects, replace)
+        if errors:
+            msg = "Import failed, with %d error(s):\n  %s" % (len(errors),
+                    "\n  ".join(errors[:IMPORT_ERRORS_SHOWN]))
+            if len(errors) > IMPORT_ERRORS_SHOWN:
+                msg += "\n  (and %d more)" % (len(errors) - IMPORT_ERRORS_SHOWN)
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+
+        try:
+            commit_import(req, [(obj_type, obj_map["name"], obj_map)
+                    for obj_type, obj_map, _ in changed])
+        except (IOError, OSError) as error:
+            log_this("Error: import failed: %s" % error)
+            req.send_api_response_msg(RSLT_FAIL, "Import failed: %s" % error)
+            return
 
-    req.send_api_response(RSLT_OK, data)
+    counts = { "added": 0, "replaced": 0,
+            "unchanged": len(objects) - len(changed) }
+    if changed:
+        bump_lab_generation(req)
+    events = []
+    for obj_type, obj_map, replaced in changed:
+        counts["replaced" if replaced else "added"] += 1
+        events.append({ obj_type: obj_map["name"], "operation": "import" })
+    if events:
+        record_events(req, "config", events)
+
+    req.send_api_response(RSLT_OK, { "data": counts })
+
+# return all the boards and resources, in the format for api/v0.2/import
+def return_api_export(req):
+    view = read_object_maps(req, IMPORT_OBJECT_TYPES)
+    data = {}
+    for obj_type in IMPORT_OBJECT_TYPES:
+        data[obj_type + "s"] = [view[obj_type][name]
+                for name in sorted(view[obj_type].keys())]
+    req.send_api_response(RSLT_OK, { "data": data })
 
 # execute a resource command
 # returns a tuple of (result, string)
-def exec_command(req, board_map, resource_map, res_cmd):
+# run is the function used to execute the command (see spawn_command)
+def exec_command(req, board_map, resource_map, res_cmd, run=None):
     # lookup command to execute in resource_map
     res_cmd_str = res_cmd + "_cmd"
     if res_cmd_str not in resource_map:
-        msg = "Resource '%s' does not have %s attribute, cannot execute" % (resource["name"], res_cmd_str)
+        msg = "Resource '%s' does not have %s attribute, cannot execute" % (resource_map["name"], res_cmd_str)
         return (RSLT_FAIL, msg)
 
     cmd_str = resource_map[res_cmd_str]
@@ -1143,10 +2181,12 @@ def exec_command(req, board_map, resource_map, res_cmd):
     # This allows a command to refer to a variable defined in the board
     # or resource data
 
-    rcode, result = getstatusoutput(cmd_str)
+    use_shell = cmd_uses_shell(resource_map, res_cmd)
+    rcode, result, errors = (run or spawn_command)(cmd_str, use_shell)
+    result = result.rstrip("\n")
     if rcode:
-        msg = "Result of %s operation on resource %s = %d" % (res_cmd, resource["name"], rcode)
-        msg += "command output='%s'" % result
+        msg = "Result of %s operation on resource %s = %d" % (res_cmd, resource_map["name"], rcode)
+        msg += "command output='%s'" % (result + errors)
         return (RSLT_FAIL, msg)
 
     return (RSLT_OK, result)
@@ -1156,48 +2196,425 @@ def return_exec_command(req, board_map, resource_map, res_cmd):
     (result, msg) = exec_command(req, board_map, resource_map, res_cmd)
     req.send_api_response_msg(result, msg)
 
-# rest is a list of the rest of the path
-# supported actions are: get_resource, power, assign, release, run
-def return_api_board_action(req, board, action, rest):
-    log_this("rest=%s" % rest)
-    boards = get_object_list(req, "board")
-    if board not in boards:
-        msg = "Could not find board '%s' registered with server" % board
-        req.send_api_response_msg(RSLT_FAIL, msg)
+# Reservation wait queues
+# When a board is assigned to another user, an 'assign' request with
+# wait=1 waits for the board to be released, instead of failing.  The
+# waiting requests for a board are kept in a FIFO queue (in
+# lc-data/data/queues/queue-{board}.json), and the board is assigned to
+# the first request in the queue when it is released.  The wait is
+# limited to 'timeout' seconds (no limit if timeout is 0).
+#
+# The queue file is locked while a board is assigned, so that two
+# requests can't assign the same board.
+#
+# Each entry in the queue has the pid of the server process that is
+# waiting, and entries for processes that have exited are dropped.
+# While waiting, the server sends a space to the client periodically,
+# to detect a client that has gone away (and to keep the connection
+# open through proxies).  The json response follows the spaces.
+ASSIGN_WAIT_DEFAULT = 300
+# how often to check the board, if no events happen (in seconds)
+ASSIGN_CHECK_INTERVAL = 1.0
+ASSIGN_KEEPALIVE_INTERVAL = 5
+
+def board_queue_path(req, board):
+    return req.config.data_dir + os.sep + "queues" + os.sep + "queue-%s.json" % board
+
+def process_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        import errno
+        return error.errno == errno.EPERM
+    return True
+
+# open and lock the queue file for a board
+# returns the file, and the list of live entries in the queue
+def lock_board_queue(req, board, lock_type=None):
+    import fcntl
+
+    path = board_queue_path(req, board)
+    queue_dir = os.path.dirname(path)
+    if not os.path.isdir(queue_dir):
+        try:
+            os.makedirs(queue_dir)
+        except OSError:
+            # another request created it
+            pass
+
+    f = open(path, "a+")
+    fcntl.flock(f, lock_type or fcntl.LOCK_EX)
+    f.seek(0)
+    try:
+        queue = json.loads(f.read())
+    except ValueError:
+        queue = []
+    queue = [entry for entry in queue if process_is_alive(entry["pid"])]
+    return f, queue
+
+def save_board_queue(f, queue):
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(queue))
+
+# assign a board to a user, if it is available
+# ticket identifies a waiting request, which is added to the queue if
+# the board can not be assigned yet (if ticket is None, the request
+# does not wait)
+# If duration is specified, the assignment is a lease, which expires
+# after duration seconds (see add_lease())
+# returns result, msg - where result is RSLT_OK, RSLT_FAIL, or None if
+# the request was queued, and msg describes why the board was not assigned
+def assign_board(req, board, user, ticket=None, duration=None):
+    result, msg, expires = assign_board_locked(req, board, user, ticket, duration)
+    if expires:
+        add_lease(req, board, user, expires)
+    return result, msg
+
+def assign_board_locked(req, board, user, ticket, duration):
+    expires = None
+    f, queue = lock_board_queue(req, board)
+    try:
+        board_map = get_object_map(req, "board", board)
+        if not board_map:
+            return RSLT_FAIL, "Problem loading data for board '%s'" % board, None
+
+        tickets = [entry["ticket"] for entry in queue]
+        assigned_to = board_map.get("AssignedTo", "nobody")
+        if assigned_to == user:
+            msg = "Device is already assigned to you"
+            result = RSLT_FAIL
+        elif assigned_to != "nobody":
+            msg = "Device is already assigned to %s" % assigned_to
+            result = None
+        elif tickets and tickets[0] != ticket:
+            msg = "Device is being assigned to a waiting user (%d waiting)" % len(queue)
+            result = None
+        else:
+            board_map["AssignedTo"] = user
+            if duration:
+                expires = time.time() + duration
+                board_map["LeaseExpires"] = expires
+                board_map["LeaseDuration"] = duration
+            save_object_data(req, "board", board, board_map)
+            msg = ""
+            result = RSLT_OK
+
+        if result is None and not ticket:
+            result = RSLT_FAIL
+        if result is None:
+            if ticket not in tickets:
+                queue.append({ "ticket": ticket, "user": user,
+                        "pid": os.getpid(), "time": time.time() })
+        else:
+            queue = [entry for entry in queue if entry["ticket"] != ticket]
+        save_board_queue(f, queue)
+        return result, msg, expires
+    finally:
+        f.close()
+
+def remove_from_board_queue(req, board, ticket):
+    f, queue = lock_board_queue(req, board)
+    try:
+        queue = [entry for entry in queue if entry["ticket"] != ticket]
+        save_board_queue(f, queue)
+    finally:
+        f.close()
+
+# assign a board to the user, waiting for it to be released if it is
+# assigned to someone else
+def wait_for_assign(req, board, user, timeout, duration=None):
+    ticket = "%d-%f" % (os.getpid(), time.time())
+    result, msg = assign_board(req, board, user, ticket, duration)
+    if result is not None:
+        if result == RSLT_OK:
+            record_event(req, "assign", { "board": board, "user": user })
+            req.send_api_response(RSLT_OK)
+        else:
+            req.send_api_response_msg(RSLT_FAIL, msg)
         return
 
-    board_map = get_object_map(req, "board", board)
-    if not board_map:
-        msg = "Problem loading data for board '%s'" % board
-        req.send_api_response_msg(RSLT_FAIL, msg)
+    # start the response, so spaces can be sent while waiting
+    sys.stdout.write("Content-type: text/plain\n" + req.api_headers() + "\n")
+    sys.stdout.flush()
+
+    start = time.time()
+    last_check = start
+    last_keepalive = start
+    state = event_log_state(req)
+    try:
+        while True:
+            time.sleep(EVENT_POLL_INTERVAL)
+            now = time.time()
+
+            # a release is recorded as an event, so check the board when
+            # the event log changes
+            new_state = event_log_state(req)
+            if new_state != state or now - last_check >= ASSIGN_CHECK_INTERVAL:
+                state = new_state
+                last_check = now
+                reap_expired_leases(req)
+                result, msg = assign_board(req, board, user, ticket, duration)
+                if result is not None:
+                    break
+
+            if timeout and now - start >= timeout:
+                remove_from_board_queue(req, board, ticket)
+                result = RSLT_FAIL
+                msg = "Timed out waiting for device. %s" % msg
+                break
+
+            if now - last_keepalive >= ASSIGN_KEEPALIVE_INTERVAL:
+                sys.stdout.write(" ")
+                sys.stdout.flush()
+                last_keepalive = now
+    except IOError as error:
+        # the client closed the connection
+        remove_from_board_queue(req, board, ticket)
+        log_this("wait for assign of board %s by %s ended: %s" % (board, user, error))
         return
 
-    if action == "get_resource":
-        res_type = rest[0]
-        del(rest[0])
-        if res_type not in ["power_controller", "power_measurement", "serial",
-                "canbus"]:
-            msg = "Error: invalid resource type '%s'" % res_type
-            req.send_api_response_msg(RSLT_FAIL, msg)
-            return
+    data = { "result": result }
+    if result == RSLT_OK:
+        record_event(req, "assign", { "board": board, "user": user,
+                "waited": round(time.time() - start, 3) })
+    else:
+        data["message"] = msg
+    try:
+        sys.stdout.write(api_json(data))
+        sys.stdout.flush()
+    except IOError as error:
+        log_this("could not send assign result for board %s to %s: %s" % (board, user, error))
+
+# Reservation leases
+# An assign request with 'duration={seconds}' makes the reservation a
+# lease, which expires after that time unless it is renewed (with
+# devices/{board}/renew).  The expiry time is in the LeaseExpires field
+# of the board (and the duration in LeaseDuration).
+#
+# Expired leases are released by reap_expired_leases(), which is called
+# at the start of each API request (there is no server process that runs
+# in the background).  The leases are kept in a heap ordered by expiry
+# time, in lc-data/data/leases.json, as a list of [expires, board, user].
+# The modification time of the file is set to the earliest expiry time,
+# so the check for expired leases is a single stat(), and boards are
+# never scanned.
+#
+# A lease that is renewed or released leaves its old entry in the heap.
+# Entries are checked against the board when they expire, and entries
+# that don't match the board's current lease are dropped.
+LEASES_FILENAME = "leases.json"
+# the modification time of an empty lease heap (10 years from now)
+NO_LEASE_TIME = 10*365*24*60*60
+
+def leases_path(req):
+    return req.config.data_dir + os.sep + LEASES_FILENAME
+
+# call function with the lease heap, while the lease file is locked
+# function can modify the heap (using heapq operations)
+def update_lease_heap(req, function):
+    import fcntl
+
+    path = leases_path(req)
+    with open(path, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            heap = json.loads(f.read())
+        except ValueError:
+            heap = []
+
+        result = function(heap)
+
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(heap))
+        f.flush()
+        if heap:
+            next_expiry = heap[0][0]
+        else:
+            next_expiry = time.time() + NO_LEASE_TIME
+        os.utime(path, (time.time(), next_expiry))
+    return result
 
-        if not rest:
-            resource = board_map.get(res_type, None)
-            if not resource:
-                msg = "Error: no resource type '%s' associated with board '%s'" % \
-                         (res_type, board)
-                req.send_api_response_msg(RSLT_FAIL, msg)
-                return
+def add_lease(req, board, user, expires):
+    import heapq
 
-            req.send_api_response(RSLT_OK, { "data": resource })
-            return
+    try:
+        update_lease_heap(req,
+                lambda heap: heapq.heappush(heap, [expires, board, user]))
+    except (IOError, OSError) as error:
+        log_this("Error: cannot add lease for board %s: %s" % (board, error))
 
-        if rest:
-            feature = urllib.unquote(rest[0])
-            resource, msg = find_resource(req, board, feature)
-            if not resource:
-                req.send_api_response_msg(RSLT_FAIL, msg)
-                return
+# release boards whose leases have expired
+def reap_expired_leases(req):
+    import heapq
+
+    now = time.time()
+    try:
+        if os.stat(leases_path(req)).st_mtime > now:
+            return
+    except OSError:
+        # no leases
+        return
+
+    def pop_expired(heap):
+        expired = []
+        while heap and heap[0][0] <= now:
+            expired.append(heapq.heappop(heap))
+        return expired
+
+    try:
+        expired = update_lease_heap(req, pop_expired)
+    except (IOError, OSError) as error:
+        log_this("Error: cannot read leases: %s" % error)
+        return
+
+    for expires, board, user in expired:
+        f, queue = lock_board_queue(req, board)
+        try:
+            board_map = get_object_map(req, "board", board)
+            # skip leases that were renewed or released
+            if not board_map or board_map.get("AssignedTo", "nobody") != user \
+                    or board_map.get("LeaseExpires", None) != expires:
+                continue
+            board_map["AssignedTo"] = "nobody"
+            del board_map["LeaseExpires"]
+            board_map.pop("LeaseDuration", None)
+            save_object_data(req, "board", board, board_map)
+        finally:
+            f.close()
+
+        log_this("Lease of board %s by %s expired" % (board, user))
+        record_event(req, "expire", { "board": board, "user": user,
+                "expires": expires })
+
+# renew the lease of a board
+# returns the new expiry time, and an error message on failure
+def renew_lease(req, board, user, duration=None):
+    f, queue = lock_board_queue(req, board)
+    try:
+        board_map = get_object_map(req, "board", board)
+        if not board_map:
+            return None, "Problem loading data for board '%s'" % board
+        assigned_to = board_map.get("AssignedTo", "nobody")
+        if assigned_to != user:
+            return None, "Device is not assigned to you. It is assigned to '%s'." % assigned_to
+        duration = duration or board_map.get("LeaseDuration", None)
+        if not duration:
+            return None, "Device reservation has no lease to renew (specify a duration)"
+
+        expires = time.time() + duration
+        board_map["LeaseExpires"] = expires
+        board_map["LeaseDuration"] = duration
+        save_object_data(req, "board", board, board_map)
+    finally:
+        f.close()
+
+    add_lease(req, board, user, expires)
+    return expires, ""
+
+# returns duration, reason - for the 'duration' parameter of assign
+# and renew (in seconds), which must be a finite number greater than 0.
+# The duration is 0 if the parameter is not specified.
+def get_lease_duration(req):
+    import math
+
+    value = req.form.getfirst("duration", "")
+    if not value:
+        return 0, ""
+    try:
+        duration = float(value)
+    except ValueError:
+        duration = None
+    if duration is None or math.isnan(duration) or \
+            math.isinf(duration) or duration <= 0:
+        return None, "Invalid duration '%s' (must be a number of seconds, greater than 0)" % value
+    return duration, ""
+
+# release a board, with the board queue locked, so that an assignment
+# made at the same time (for a waiting user, or by the lease reaper) is
+# not overwritten
+# returns assigned_to, reason - where assigned_to is the user the board
+# was assigned to, or None on failure
+def release_board(req, board, user, force=False):
+    f, queue = lock_board_queue(req, board)
+    try:
+        board_map = get_object_map(req, "board", board)
+        if not board_map:
+            return None, "Problem loading data for board '%s'" % board
+        assigned_to = board_map.get("AssignedTo", "nobody")
+        if assigned_to == "nobody":
+            return None, "Device is already free and available for allocation."
+        if not force and user != assigned_to:
+            return None, "Device is not assigned to you. It is assigned to '%s'.\nCannot release it. (try using 'force' option)" % assigned_to
+
+        board_map["AssignedTo"] = "nobody"
+        board_map.pop("LeaseExpires", None)
+        board_map.pop("LeaseDuration", None)
+        save_object_data(req, "board", board, board_map)
+    finally:
+        f.close()
+    return assigned_to, ""
+
+# return the user a board is assigned to, and the users waiting for it
+def return_board_queue(req, board, board_map):
+    import fcntl
+
+    f, queue = lock_board_queue(req, board, fcntl.LOCK_SH)
+    f.close()
+
+    now = time.time()
+    waiting = []
+    for entry in queue:
+        waiting.append({ "user": entry["user"],
+                "waiting_seconds": round(now - entry["time"], 3) })
+    data = { "assigned_to": board_map.get("AssignedTo", "nobody"),
+            "waiting": waiting }
+    req.send_api_response(RSLT_OK, { "data": data })
+
+# rest is a list of the rest of the path
+# supported actions are: get_resource, power, assign, release, run
+def return_api_board_action(req, board, action, rest):
+    log_this("rest=%s" % rest)
+    boards = get_object_list(req, "board")
+    if board not in boards:
+        msg = "Could not find board '%s' registered with server" % board
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    board_map = get_object_map(req, "board", board)
+    if not board_map:
+        msg = "Problem loading data for board '%s'" % board
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    if action == "get_resource":
+        res_type = rest[0]
+        del(rest[0])
+        if res_type not in ["power_controller", "power_measurement", "serial",
+                "canbus"]:
+            msg = "Error: invalid resource type '%s'" % res_type
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+
+        if not rest:
+            resource = board_map.get(res_type, None)
+            if not resource:
+                msg = "Error: no resource type '%s' associated with board '%s'" % \
+                         (res_type, board)
+                req.send_api_response_msg(RSLT_FAIL, msg)
+                return
+
+            req.send_api_response(RSLT_OK, { "data": resource })
+            return
+
+        if rest:
+            feature = urllib.unquote(rest[0])
+            resource, msg = find_resource(req, board, feature)
+            if not resource:
+                req.send_api_response_msg(RSLT_FAIL, msg)
+                return
 
             req.send_api_response(RSLT_OK, { "data": resource })
             return
@@ -1219,7 +2636,15 @@ def return_api_board_action(req, board, action, rest):
                 req.send_api_response_msg(result, msg)
             return
         elif rest[0] in ["on", "off", "reboot"]:
-            return_exec_command(req, board_map, pdu_map, rest[0])
+            driver, msg = get_driver(req, pdu_map, "power_controller")
+            if not driver:
+                req.send_api_response_msg(RSLT_FAIL, msg)
+                return
+            (result, msg) = driver.power(board_map, rest[0])
+            if result == RSLT_OK:
+                record_event(req, "power", { "board": board,
+                        "operation": rest[0] })
+            req.send_api_response_msg(result, msg)
             return
         else:
             msg = "power action '%s' not supported" % rest[0]
@@ -1228,37 +2653,61 @@ def return_api_board_action(req, board, action, rest):
     elif action == "assign":
         # get current user, and add reservation for board to user
         user = req.get_user()
-        assigned_to = board_map.get("AssignedTo", "nobody")
-        if assigned_to != "nobody":
-            if user == assigned_to:
-                msg = "Device is already assigned to you"
-            else:
-                msg = "Device is already assigned to %s" % assigned_to
+        if not user or user == "nobody":
+            msg = "Cannot determine user for operation"
             req.send_api_response_msg(RSLT_FAIL, msg)
             return
 
-        if user and user != "nobody":
-            board_map["AssignedTo"] = user
-        else:
-            msg = "Cannot determine user for operation"
+        try:
+            timeout = float(req.form.getfirst("timeout",
+                    str(ASSIGN_WAIT_DEFAULT)))
+        except ValueError:
+            msg = "Invalid timeout for assign"
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+        duration, msg = get_lease_duration(req)
+        if duration is None:
             req.send_api_response_msg(RSLT_FAIL, msg)
             return
 
-        # save data back to json file
-        save_object_data(req, "board", board, board_map)
+        if req.form.getfirst("wait", "0") in ["1", "true", "yes"]:
+            wait_for_assign(req, board, user, timeout, duration)
+            return
+
+        result, msg = assign_board(req, board, user, None, duration)
+        if result != RSLT_OK:
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
 
+        record_event(req, "assign", { "board": board, "user": user })
         req.send_api_response(RSLT_OK)
         return
 
-    elif action == "release":
-        # get current user, and remove reservation for board
+    elif action == "renew":
         user = req.get_user()
-        assigned_to = board_map.get("AssignedTo", "nobody")
-        if assigned_to == "nobody":
-            msg = "Device is already free and available for allocation."
+        duration, msg = get_lease_duration(req)
+        if duration is None:
             req.send_api_response_msg(RSLT_FAIL, msg)
             return
 
+        expires, msg = renew_lease(req, board, user, duration)
+        if not expires:
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+
+        record_event(req, "renew", { "board": board, "user": user,
+                "expires": expires })
+        req.send_api_response(RSLT_OK, { "data": { "expires": expires,
+                "seconds": round(expires - time.time(), 3) } })
+        return
+
+    elif action == "queue":
+        return_board_queue(req, board, board_map)
+        return
+
+    elif action == "release":
+        # get current user, and remove reservation for board
+        user = req.get_user()
         if not user or user == "nobody":
             msg = "Cannot determine user for operation"
             req.send_api_response_msg(RSLT_FAIL, msg)
@@ -1269,16 +2718,13 @@ def return_api_board_action(req, board, action, rest):
         else:
             force = False
 
-        if not force:
-            if user != assigned_to:
-                msg = "Device is not assigned to you. It is assigned to '%s'.\nCannot release it. (try using 'force' option)" % assigned_to
-                req.send_api_response_msg(RSLT_FAIL, msg)
-                return
-
-        board_map["AssignedTo"] = "nobody"
+        assigned_to, msg = release_board(req, board, user, force)
+        if not assigned_to:
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
 
-        # save data back to json file
-        save_object_data(req, "board", board, board_map)
+        record_event(req, "release", { "board": board, "user": user,
+                "assigned_to": assigned_to, "force": force })
 
         req.send_api_response(RSLT_OK)
         return
@@ -1308,48 +2754,348 @@ def return_api_board_action(req, board, action, rest):
 
         log_this("About to run_command('%s')" % cmd)
 
-        lines, rcode, msg = run_command(cmd)
+        data, msg = run_command(req, cmd, { "board": board, "user": user })
         if msg:
             req.send_api_response_msg(RSLT_FAIL, msg)
             return
 
-        data = { "return_code": rcode, "data": lines }
-        jdata = json.dumps(data)
-        log_this("jdata='%s'" % jdata)
-
         req.send_api_response(RSLT_OK, { "data": data } )
         return
 
+    elif action == "run-output":
+        return_run_output(req, board, rest)
+        return
+
+    elif action in ["upload", "upld", "download", "downld", "checksum"]:
+        user = req.get_user()
+        assigned_to = board_map.get("AssignedTo", "nobody")
+
+        if user != assigned_to:
+            msg = "Device is not assigned to you. It is assigned to '%s'.\nCannot transfer files." % assigned_to
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+
+        # method is 'serial' or 'ssh'
+        # the path may be in the form data, or in the url
+        # (for download/serial/{path})
+        if action == "upld":
+            method = "ssh"
+        elif action == "downld":
+            method = "ssh"
+        elif rest:
+            method = rest[0]
+        else:
+            method = ""
+        path = req.form.getfirst("path", "")
+        if not path and len(rest) > 1:
+            path = "/" + "/".join([urllib.unquote(p) for p in rest[1:] if p])
+        if not path and action in ["upload", "upld"] and \
+                req.form.list and "file" in req.form:
+            path = req.form["file"].filename
+
+        if not path:
+            msg = "Missing path for %s operation" % action
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+
+        if action in ["upload", "upld"]:
+            return_upload_file(req, board_map, method, path)
+        elif action == "checksum":
+            return_file_checksum(req, board_map, method, path)
+        else:
+            return_download_file(req, board_map, method, path)
+        return
+
     msg = "action '%s' not supported (rest='%s')" % (action, rest)
     req.send_api_response_msg(RSLT_FAIL, msg)
 
-CAPTURE_LOG_FILENAME_FMT="/tmp/capture-log-%s.txt"
-capture_dir="/tmp"
+# return the board command to use for a file transfer operation
+# ('upload', 'download' or 'checksum') and transfer method
+# ('serial' or 'ssh').  A method-specific command
+# (e.g. upload_ssh_cmd) takes precedence over a general command
+# (e.g. upload_cmd).
+# returns cmd_str, reason
+def get_transfer_cmd(board_map, operation, method, path, offset=0):
+    cmd = ""
+    if method:
+        cmd = board_map.get("%s_%s_cmd" % (operation, method), "")
+    if not cmd:
+        cmd = board_map.get("%s_cmd" % operation, "")
+    if not cmd:
+        return ("", "Device '%s' is not configured for %s operations (missing %s_cmd)" % (board_map["name"], operation, operation))
+
+    d = copy.deepcopy(board_map)
+    d["path"] = path
+    d["offset"] = offset
+    return (cmd % d, "")
+
+# upload a file to the board, by streaming the request body to the
+# board's upload_cmd.  The response has the number of bytes and the
+# sha256 checksum of the data received, so the client can verify it.
+def return_upload_file(req, board_map, method, path):
+    import hashlib
+
+    cmd_str, reason = get_transfer_cmd(board_map, "upload", method, path)
+    if not cmd_str:
+        req.send_api_response_msg(RSLT_FAIL, reason)
+        return
+
+    log_this("upload: cmd_str='%s'" % cmd_str)
+    hasher = hashlib.sha256()
+    start = time.time()
+    use_shell = cmd_uses_shell(board_map, "upload")
+    rcode, output, reason = pipe_body_to_command(req, cmd_str, use_shell, hasher)
+    if reason:
+        req.send_api_response_msg(RSLT_FAIL, reason)
+        return
+
+    if rcode:
+        msg = "Result of upload operation on board %s = %d\n" % (board_map["name"], rcode)
+        msg += "command output (decoded)='%s'" % output.decode('utf8', errors='ignore')
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    duration = time.time() - start
+    log_metric("upload_rate", req.body_bytes / max(duration, 0.000001), "B/s",
+            "board=" + board_map["name"])
+    data = { "path": path, "bytes": req.body_bytes,
+        "sha256": hasher.hexdigest() }
+    req.send_api_response(RSLT_OK, { "data": data })
+
+# stream a file from the board, from the output of the board's
+# download_cmd.  The download can be resumed at an offset, specified
+# with the 'offset' parameter or with an HTTP Range header
+# (bytes=<offset>-).  If download_cmd uses %(offset)s, the command
+# starts at the offset; otherwise, the server skips that many bytes of
+# the command output.
+#
+# The size of the file is not known before it is sent, so a valid
+# Content-Range can't be returned.  The response is always 200, with
+# the offset of the data in X-Content-Offset (a client that resumes
+# with only a Range header, like curl -C, will refuse the response
+# rather than append the wrong data).  If the download command fails
+# after the response has started, the failure can't be reported, so
+# clients should compare the checksum of the data with the checksum of
+# the file on the board.
+def return_download_file(req, board_map, method, path):
+    try:
+        offset = int(req.form.getfirst("offset", "0"))
+    except ValueError:
+        offset = 0
+
+    http_range = req.environ.get("HTTP_RANGE", "")
+    m = re.match("bytes=([0-9]+)-$", http_range.strip())
+    if m:
+        offset = int(m.group(1))
+
+    cmd_str, reason = get_transfer_cmd(board_map, "download", method, path, offset)
+    if not cmd_str:
+        req.send_api_response_msg(RSLT_FAIL, reason)
+        return
+
+    skip = 0
+    download_cmd = board_map.get("download_%s_cmd" % method,
+            board_map.get("download_cmd", ""))
+    if offset and "%(offset)" not in download_cmd:
+        skip = offset
+
+    log_this("download: cmd_str='%s'" % cmd_str)
+    use_shell = cmd_uses_shell(board_map, "download")
+    try:
+        proc = spawn_process(cmd_str, use_shell)
+    except (OSError, ValueError) as error:
+        msg = "%s trying to execute command '%s'" % (error, cmd_str)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    errors_list = []
+    reader = threading.Thread(target=lambda: errors_list.append(proc.stderr.read()))
+    reader.start()
+    proc.stdin.close()
+
+    chunk_size = 65536
+    # read the first chunk before sending headers, so that errors can
+    # still be reported as an api response
+    chunk = proc.stdout.read(chunk_size)
+    while chunk and skip:
+        if skip >= len(chunk):
+            skip -= len(chunk)
+            chunk = proc.stdout.read(chunk_size)
+        else:
+            chunk = chunk[skip:]
+            skip = 0
+
+    if not chunk:
+        rcode = proc.wait()
+        reader.join()
+        if rcode:
+            msg = "Result of download operation on board %s = %d\n" % (board_map["name"], rcode)
+            msg += "command output (decoded)='%s'" % "".join(errors_list).decode('utf8', errors='ignore')
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+
+    start = time.time()
+    count = 0
+    # only a "bytes=<offset>-" range is supported - other ranges are
+    # ignored, and the whole file (from the offset parameter) is sent
+    sys.stdout.write("Content-type: application/octet-stream\n")
+    sys.stdout.write("X-Content-Offset: %d\n\n" % offset)
+    while chunk:
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
+        count += len(chunk)
+        chunk = proc.stdout.read(chunk_size)
+
+    rcode = proc.wait()
+    reader.join()
+    if rcode:
+        # the response has already started, so just log the problem
+        log_this("download of %s from board %s failed with rcode %d" % (path, board_map["name"], rcode))
+
+    duration = time.time() - start
+    log_metric("download_rate", count / max(duration, 0.000001), "B/s",
+            "board=" + board_map["name"])
+
+# return the sha256 checksum of a file on the board, using the board's
+# checksum_cmd (e.g. "ssh %(ip)s sha256sum %(path)s").
+# The first word of the command output is the checksum.
+def return_file_checksum(req, board_map, method, path):
+    cmd_str, reason = get_transfer_cmd(board_map, "checksum", method, path)
+    if not cmd_str:
+        req.send_api_response_msg(RSLT_FAIL, reason)
+        return
+
+    use_shell = cmd_uses_shell(board_map, "checksum")
+    rcode, output, errors = spawn_command(cmd_str, use_shell, timeout=600.0)
+    if rcode or not output.split():
+        msg = "Result of checksum operation on board %s = %d\n" % (board_map["name"], rcode)
+        msg += "command output (decoded)='%s'" % (output + errors).decode('utf8', errors='ignore')
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    data = { "path": path, "sha256": output.split()[0] }
+    req.send_api_response(RSLT_OK, { "data": data })
+
+capture_dir=config.capture_dir
+CAPTURE_LOG_FILENAME_FMT=capture_dir + "/capture-log-%s.txt"
 capture_prefix="capture-log-"
 capture_suffix=".txt"
-CAPTURE_PID_FILENAME_FMT="/tmp/capture-%s.pid"
+CAPTURE_PID_FILENAME_FMT=capture_dir + "/capture-%s.pid"
+# a finished capture log is compressed (see "Capture retention")
+CAPTURE_GZ_FILENAME_FMT=capture_dir + "/capture-log-%s.txt.gz"
+
+# captures served by lc-serial-service have an info file, instead of
+# a capture log and pid file
+CAPTURE_INFO_FILENAME_FMT=capture_dir + "/capture-info-%s.json"
+capture_info_prefix="capture-info-"
+capture_info_suffix=".json"
+
+# capture logs of captures done by a host agent are in the capture
+# directory on the lab host, which the agent reports when it polls for
+# operations (see agent_capture_dir)
+AGENT_CAPTURE_LOG_FILENAME_FMT="%s/capture-log-%s.txt"
+AGENT_CAPTURE_DIR_DEFAULT="/tmp"
+
+def make_capture_dir():
+    if not os.path.isdir(capture_dir):
+        try:
+            os.makedirs(capture_dir)
+        except OSError:
+            # another request created it
+            pass
+
+# default control socket for lc-serial-service
+# (a resource can specify a different one with "service_socket")
+SERIAL_SERVICE_SOCKET="/tmp/lc-serial-service.sock"
+
+# returns True if the object (usually a resource) has opted in to having
+# the indicated command run by a shell.  This is needed for commands that
+# use shell features, like redirection (e.g. "echo V >%(console_dev)s").
+# Commands are executed directly (without /bin/sh) by default.
+# ex: "shell_cmds": ["alternate_on", "alternate_off"]
+def cmd_uses_shell(obj_map, cmd_name):
+    return cmd_name in obj_map.get("shell_cmds", [])
+
+# convert a command string into the arguments for Popen
+def split_command(cmd, use_shell=False):
+    if use_shell:
+        return cmd
+    return shlex.split(cmd)
+
+# start a command, and return a Popen object
+# The command is executed directly (not via a shell) unless use_shell
+# is True.  Raises OSError or ValueError if the command can't be started.
+# Note that the process is started with close_fds, so it doesn't inherit
+# any open files from the server.
+def spawn_process(cmd, use_shell=False, stdin=None, stdout=None, stderr=None):
+    from subprocess import Popen, PIPE
+
+    exec_args = split_command(cmd, use_shell)
+    if not exec_args:
+        raise ValueError("empty command")
+
+    if stdin is None:
+        stdin = PIPE
+    if stdout is None:
+        stdout = PIPE
+    if stderr is None:
+        stderr = PIPE
+
+    start = time.time()
+    proc = Popen(exec_args, stdin=stdin, stdout=stdout, stderr=stderr,
+            close_fds=True, shell=use_shell)
+    if use_shell:
+        prog = "sh"
+    else:
+        prog = os.path.basename(exec_args[0])
+    log_metric("spawn_latency", time.time() - start, "s", "cmd=" + prog)
+    return proc
+
+# wait for a process started with spawn_process to finish, and return:
+#   rcode, output, errors
+# If timeout is specified (in seconds), the command is killed if it
+# runs longer than that.
+def wait_process(proc, timeout=None, input_data=None):
+    start = time.time()
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, run_timeout, [proc])
+        timer.start()
 
-data_dir="/tmp"
-data_prefix="data-file-"
-data_suffix=".data"
+    try:
+        output, errors = proc.communicate(input_data)
+    except:
+        proc.kill()
+        output, errors = proc.communicate()
 
-# return pid of command
-# only execute a single-line command, for now
-def new_exec_command(cmd):
-    from subprocess import Popen, PIPE, STDOUT
+    if timer:
+        timer.cancel()
 
+    log_metric("command_time", time.time() - start, "s")
+    return (proc.returncode, output, errors)
 
-    exec_args = shlex.split(cmd)
+# execute a command, and return:
+#   rcode, output, errors
+# where output and errors are the stdout and stderr of the command.
+# If the command can't be executed, rcode is 127 (like the shell), and
+# errors has a description of the problem.
+def spawn_command(cmd, use_shell=False, timeout=None, input_data=None):
+    try:
+        proc = spawn_process(cmd, use_shell)
+    except (OSError, ValueError) as error:
+        msg = "%s trying to execute command '%s'" % (error, cmd)
+        log_this(msg)
+        return (127, "", msg)
 
-    # FIXTHIS - add more stuff here
+    return wait_process(proc, timeout, input_data)
 
+# return pid of command
+# only execute a single-line command, for now
+def new_exec_command(cmd):
     try:
-        proc = Popen(exec_args, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True)
-    except subprocess.CalledProcessError as e:
-        msg = "Can't run command '%s' in exec_command" % cmd
-        return (0, msg)
-    except OSError as error:
-        msg = error + " trying to execute command '%s'" % cmd
+        proc = spawn_process(cmd)
+    except (OSError, ValueError) as error:
+        msg = "%s trying to execute command '%s'" % (error, cmd)
         return (0, msg)
 
     pid = proc.pid
@@ -1360,254 +3106,2761 @@ def run_timeout(proc):
     proc.kill()
 
 
+# Run output
+# The stdout and stderr of a command run on a board (with
+# devices/{board}/run) are written to files in a directory for that run,
+# in the run output directory, so the output is never held in memory.
+# The response has the output (as lines) if it is small, or the head
+# and the tail of it (config.run_output_limit bytes in all, for each
+# stream), and the id of the run, so the client can get the rest with
+# devices/{board}/run-output/{id}/{stream}?offset={offset}&length={length}.
+#
+# The output of old runs is removed when a command is run.
+RUN_TIMEOUT = 60.0
+RUN_OUTPUT_PREFIX = "run-"
+RUN_OUTPUT_STREAMS = ["stdout", "stderr"]
+RUN_OUTPUT_KEEP_TIME = 24*60*60
+RUN_OUTPUT_MAX_COUNT = 100
+RUN_OUTPUT_CHUNK_SIZE = 64*1024
+run_output_id_re = re.compile(r"^\w+$")
+
+def run_output_path(req, output_id, name=""):
+    path = req.config.run_output_dir + os.sep + RUN_OUTPUT_PREFIX + output_id
+    if name:
+        path += os.sep + name
+    return path
+
+# remove the output of old runs
+def prune_run_output(req):
+    import shutil
+
+    run_dirs = []
+    for name in os.listdir(req.config.run_output_dir):
+        if name.startswith(RUN_OUTPUT_PREFIX):
+            path = req.config.run_output_dir + os.sep + name
+            try:
+                run_dirs.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+    run_dirs.sort(reverse=True)
+
+    oldest = time.time() - RUN_OUTPUT_KEEP_TIME
+    for i, (mtime, path) in enumerate(run_dirs):
+        if i >= RUN_OUTPUT_MAX_COUNT or mtime < oldest:
+            shutil.rmtree(path, ignore_errors=True)
+
+# returns the head and tail lines of an output file, with limit
+# bytes in all (the tail is empty if the whole file fits in the limit)
+def read_output_lines(path, size, limit):
+    with open(path) as f:
+        if size <= limit:
+            return f.read().decode("utf8", "replace").splitlines(True), []
+        head = f.read(limit // 2)
+        f.seek(size - limit // 2)
+        tail = f.read()
+    return (head.decode("utf8", "replace").splitlines(True),
+            tail.decode("utf8", "replace").splitlines(True))
+
 # execute a single-line command, and return:
-# lines, return_code, reason
-# where lines is the command output, and return_code is the exit code
-# of the command.  On failure, reason is non-empty and contains
-# a description of the problem.
-def run_command(cmd):
-    from subprocess import Popen, PIPE, STDOUT
+# data, reason
+# where data is a map with the "return_code" of the command, and its
+# output (see "Run output").  On failure, reason is non-empty and
+# contains a description of the problem.
+# info is a map with information about the run (like the "board" and
+# "user"), that is saved with the output.
+def run_command(req, cmd, info):
+    if not os.path.isdir(req.config.run_output_dir):
+        os.makedirs(req.config.run_output_dir)
+    prune_run_output(req)
+    run_dir = tempfile.mkdtemp(prefix=RUN_OUTPUT_PREFIX,
+            dir=req.config.run_output_dir)
+    output_id = os.path.basename(run_dir)[len(RUN_OUTPUT_PREFIX):]
+
+    # don't allow command to run for more than RUN_TIMEOUT seconds
+    out_f = open(run_dir + "/stdout", "w")
+    err_f = open(run_dir + "/stderr", "w")
+    try:
+        proc = spawn_process(cmd, stdout=out_f, stderr=err_f)
+    except (OSError, ValueError) as error:
+        import shutil
+        shutil.rmtree(run_dir, ignore_errors=True)
+        msg = "%s trying to execute command '%s'" % (error, cmd)
+        return (None, msg)
+    finally:
+        out_f.close()
+        err_f.close()
+
+    rcode, output, errs = wait_process(proc, timeout=RUN_TIMEOUT)
+
+    data = { "return_code": rcode, "output_id": output_id }
+    limit = req.config.run_output_limit
+    for stream, name in [("stdout", "data"), ("stderr", "errors")]:
+        path = run_dir + os.sep + stream
+        size = os.path.getsize(path)
+        data[name], data[name + "_tail"] = read_output_lines(path, size, limit)
+        data[stream + "_size"] = size
+        data[stream + "_truncated"] = size > limit
+
+    info = dict(info)
+    info["return_code"] = rcode
+    info["time"] = time.time()
+    with open(run_dir + "/info.json", "w") as f:
+        json.dump(info, f)
+
+    log_this("run %s: rcode=%s, stdout=%d bytes, stderr=%d bytes" % \
+            (output_id, rcode, data["stdout_size"], data["stderr_size"]))
+    return (data, "")
+
+# send a range of the output of a run, as raw data
+# rest is [ {output_id}, {stream} ]
+def return_run_output(req, board, rest):
+    user = req.get_user()
+    if len(rest) != 2 or not run_output_id_re.match(rest[0]) or \
+            rest[1] not in RUN_OUTPUT_STREAMS:
+        msg = "Invalid run output '%s' (expected run-output/{id}/{stdout|stderr})" % "/".join(rest)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
-    exec_args = shlex.split(cmd)
+    output_id, stream = rest
+    try:
+        with open(run_output_path(req, output_id, "info.json")) as f:
+            info = json.load(f)
+    except (IOError, ValueError):
+        msg = "Cannot find output of run '%s' (it may have been removed)" % output_id
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
-    # FIXTHIS - add more stuff here
+    if info.get("board") != board or info.get("user") != user:
+        msg = "Run '%s' is not a run by user '%s' on board '%s'" % \
+                (output_id, user, board)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
+    path = run_output_path(req, output_id, stream)
+    size = os.path.getsize(path)
     try:
-        proc = Popen(exec_args, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True)
-    except subprocess.CalledProcessError as e:
-        msg = "Can't run command '%s' in exec_command" % cmd
-        return (0, msg)
-    except OSError as error:
-        msg = error + " trying to execute command '%s'" % cmd
-        return (0, msg)
+        offset = min(max(int(req.form.getfirst("offset", "0")), 0), size)
+        length = int(req.form.getfirst("length", str(size - offset)))
+    except ValueError:
+        req.send_api_response_msg(RSLT_FAIL, "Invalid offset or length for run output")
+        return
+    length = min(max(length, 0), size - offset)
+
+    f = open(path)
+    f.seek(offset)
+    req.start_stream("Content-type: application/octet-stream\n" +
+            "X-Content-Offset: %d\nX-Content-Size: %d\n" % (offset, size))
+    while length:
+        chunk = f.read(min(length, RUN_OUTPUT_CHUNK_SIZE))
+        if not chunk:
+            break
+        req.write(chunk)
+        length -= len(chunk)
+    f.close()
+    req.end_stream()
+
+# returns non-empty reason string on failure
+# run is the function used to execute the command (see spawn_command)
+def set_config(req, action, resource_map, config_map, rest, run=None):
+    resource = resource_map["name"]
+    config_cmd = resource_map.get("config_cmd", "")
+    if not config_cmd:
+        return "Could not find 'config_cmd' for resource resource %s" %  resource
 
-    # don't allow command to run for more than 60 seconds
-    timer = threading.Timer(60.0, run_timeout, [proc])
-    timer.start()
+    dlog_this("config_cmd=" + config_cmd)
 
-    # we may want to have a different interface here, that allows
-    # starting the command, and returning partial data after 10 seconds
-    # followed by periodic queries from the client to get additional data
-    # before finally yeilding the final data and return code
-    # we would need a file buffer and pid system, like for the capture code.
+    allowed_config_items=["baud_rate"]
 
-    pid = proc.pid
+    new_resource_map = copy.deepcopy(resource_map)
+    # only copy allowed items from config_map
+    for key, value in config_map.items():
+        if key in allowed_config_items:
+            new_resource_map[key] = value
+
+    cmd_str = config_cmd % new_resource_map
+    dlog_this("(interpolated) cmd_str='%s'" + cmd_str)
+    use_shell = cmd_uses_shell(resource_map, "config")
+    rcode, output, errors = (run or spawn_command)(cmd_str, use_shell)
+    result = output + errors
+    if rcode:
+        msg = "Result of set-config operation on resource %s = %d\n" % (resource, rcode)
+
+        # Apparently, 'stty' error output uses some high unicode code points,
+        # (outside the ascii range), which cause an exception if you don't
+        # decode them. (ie, they get auto-decoded as ascii)
+        # Have I told you, lately, how much I hate python unicode handling??
+        output = result.decode('utf8', errors='ignore')
+        msg += "command output (decoded)='" + output + "'"
+        return msg
+
+    # write out updated resource_map
+    save_object_data(req, "resource", resource, new_resource_map)
+
+    return None
+
+
+# returns token, reason
+# on error, token is None or empty and reason is a string with an error
+# message.  The error message should start with "Error: "
+def start_capture(req, action, resource_map, rest):
+    # look up capture_cmd in resource_map, and call it
+    resource = resource_map["name"]
+    capture_cmd = resource_map.get("capture_cmd")
+
+    log_this("capture_cmd=" + capture_cmd)
+
+    # generate the logfile path, and hand  to the capture_cmd
+    # FIXTHIS - use a hardcoded logfile and pidfile for now
+    token = "1234"
+    make_capture_dir()
+    fd, logpath = tempfile.mkstemp(capture_suffix, capture_prefix, capture_dir)
+    os.close(fd)
+    os.remove(logpath)
+    filename = os.path.basename(logpath)
+    token = filename[len(capture_prefix):-len(capture_suffix)]
+
+    pidfile = CAPTURE_PID_FILENAME_FMT % token
+
+    if os.path.exists(pidfile):
+        # FIXTHIS - in start_capture, check and see if process is still running
+        # if not, just remove pidfile, and continue
+        return ("", "Capture is already running for resource %s" % resource)
+
+    # do string interpolation from the data in the resource map
+    # (adding the 'logfile' attribute)
+    d = copy.deepcopy(resource_map)
+    d["logfile"] = logpath
+
+    cmd = capture_cmd % d
+    log_this("(interpolated) cmd=" + cmd)
+
+    # save pid in a file, named with the token used earlier
+    pid, msg = new_exec_command(cmd)
+    if not pid:
+        log_this("exec failure: reason=" + msg)
+        return ("", msg)
+
+    log_this("capture pid=%d" % pid)
+    fd = open(pidfile,"w")
+    fd.write(str(pid))
+    fd.close()
+
+    return (token, "")
+
+# sends reason on failure
+def stop_capture(req, action, resource_map, token, rest):
+    resource = resource_map["name"]
+
+    pidfile = CAPTURE_PID_FILENAME_FMT % token
+
+    if not os.path.exists(pidfile):
+        return "Cannot find executing capture for %s for resource '%s'" % (action, resource)
+
+    # Could support optional stop_cmd execution here
+    # but let's wait on that.
+    try:
+        fd = open(pidfile, "r")
+        pid = int(fd.read().strip())
+        fd.close()
+    except IOError:
+        pid = None
+
+    if not pid:
+        return "Cannot find in-progress capture for %s for resource '%s'" % (action, resource)
+
+    try:
+        while 1:
+            os.kill(pid, signal.SIGTERM)
+            time.sleep(0.1)
+            # reap the process, if it was started by this process (as
+            # in a transmit test) - otherwise it stays as a zombie
+            try:
+                os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                pass
+    except OSError as err:
+        err = str(err)
+        if err.find("No such process") > 0:
+            if os.path.exists(pidfile):
+                os.remove(pidfile)
+
+    return None
+
+# size of the chunks of a capture log that are read for get-data
+CAPTURE_CHUNK_SIZE = 64*1024
+
+# returns the data of a file, in chunks, and closes the file
+def file_chunks(f, chunk_size):
+    try:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+# returns the json text for lines of a power measurement log
+def power_lines_json(lines):
+    jdata = []
+    for line in lines:
+        if not line:
+            continue
+        parts = line.split(",")
+        try:
+            jdata.append(' { "timestamp": "%s", "voltage": "%s", "current": "%s" }\n' % (parts[0], float(parts[1])/1000.0, float(parts[2])/1000.0))
+        except:
+            log_this("Problem converting log_data line for power measurement\nline='%s'" % line)
+    return "".join(jdata)
+
+# converts chunks of a power measurement log to chunks of json text
+def power_json_chunks(chunks):
+    yield "[\n"
+    rest = ""
+    for chunk in chunks:
+        lines = (rest + chunk).split("\n")
+        rest = lines.pop()
+        yield power_lines_json(lines)
+    yield power_lines_json([rest]) + "]"
+
+# returns chunks, reason
+# chunks is None on failure, and reason is a string with error message
+# otherwise, chunks is an iterator over the data from the capture (as
+# strings).  Captured data may be transformed from its original format,
+# but in all cases should be sent as json.
+# The data is read in chunks (or ranges, for captures done by the serial
+# service or an agent), as it is sent, so that it is never all held in
+# memory.
+def get_captured_data(req, action, resource_map, token, rest):
+    import itertools
+
+    resource = resource_map["name"]
+
+    info = read_capture_info(token)
+    start_time, end_time, reason = get_time_range(req)
+    if reason:
+        return (None, reason)
+    time_range = start_time is not None or end_time is not None
+
+    if info and info.get("agent"):
+        chunks, reason = read_agent_capture_log(req, info)
+        if reason:
+            return (None, reason)
+        touch_capture(req, token)
+        if time_range:
+            chunks = filter_chunks_by_time(chunks, start_time, end_time)
+    elif info:
+        chunks, reason = read_service_capture(info, start_time, end_time)
+        if reason:
+            return (None, reason)
+    elif time_range:
+        chunks, reason = read_capture_time_range(token, start_time, end_time)
+        if reason:
+            return (None, "%s for resource '%s'" % (reason, resource))
+        touch_capture(req, token)
+    else:
+        f = open_capture_log(token)
+        if not f:
+            return (None, "Cannot find capture log for %s token %s for resource '%s'" % (action, token, resource))
+        touch_capture(req, token)
+        chunks = file_chunks(f, CAPTURE_CHUNK_SIZE)
+
+    # check the first chunk, before the response is started
+    try:
+        first = next(chunks)
+    except StopIteration:
+        first = ""
+    except IOError:
+        first = None
+    if first is None or (not first and not time_range):
+        return (None, "Cannot read capture data for %s for resource '%s'" % (action, resource))
+    chunks = itertools.chain([first], chunks)
+
+    # convert to json data
+    # FIXTHIS - should not use hardcoded re-format operation here, for sdb data
+    # should run a conversion command specified by the resource object
+    if action == "power_measurement":
+        return (power_json_chunks(chunks), "")
+
+    return (chunks, "")
+
+# returns reason on failure, "" on success
+def delete_capture(req, res_type, resource_map, token, rest):
+    resource = resource_map["name"]
+
+    infofile = CAPTURE_INFO_FILENAME_FMT % token
+    info = read_capture_info(token)
+    if info and info.get("agent"):
+        # remove the capture log on the agent's host
+        result, reason = agent_request(req, info["agent"], "remove",
+                { "path": info["logfile"] })
+        if not result:
+            return reason
+    if os.path.exists(CAPTURE_STATS_FILENAME_FMT % token):
+        os.remove(CAPTURE_STATS_FILENAME_FMT % token)
+    if os.path.exists(infofile):
+        os.remove(infofile)
+        untrack_capture(req, token)
+        return ""
+
+    found = False
+    for logfile in [CAPTURE_LOG_FILENAME_FMT % token,
+            CAPTURE_GZ_FILENAME_FMT % token]:
+        if os.path.exists(logfile):
+            os.remove(logfile)
+            found = True
+    if not found:
+        return "Cannot delete captured data for resource '%s'" % resource
+    if os.path.exists(CAPTURE_TIME_INDEX_FILENAME_FMT % token):
+        os.remove(CAPTURE_TIME_INDEX_FILENAME_FMT % token)
+    untrack_capture(req, token)
+    return ""
+
+#######################
+# Capture retention
+#
+# Capture logs in the capture directory are tracked in an index
+# (captures.json, in the capture directory), with the resource and the
+# last access time of each capture.  When a capture is finished, its log
+# is compressed with gzip (to capture-log-{token}.txt.gz), and get-data
+# and follow read the compressed log transparently.
+#
+# The captures of each resource are limited to the "capture_quota" of
+# the resource (in bytes), or CAPTURE_RESOURCE_QUOTA, and all captures
+# are limited to config.capture_quota.  When a quota is exceeded, the
+# least recently used finished captures are removed (and a capture
+# 'evict' event is recorded).  Running captures are never removed, but
+# if the running captures alone are over a quota, the largest of them
+# are stopped (and a capture 'stop' event is recorded, with "reason":
+# "quota"), so that a long capture can't fill the disk.
+#
+# The retention rules are applied when a capture is started or stopped,
+# when a capture is read (get-data, follow, expect and stats), and when
+# the capture usage is requested (api/v0.2/captures).  Logs are
+# compressed without the index locked, so that reading other captures
+# (which updates their access time) is not held up by a compression.
+#
+# Captures done by a host agent are in the capture directory of the
+# host, and are tracked in the index too (with the "agent" host).  Their
+# sizes are read with an agent 'stat' operation, and they are removed
+# and stopped with 'remove' and 'kill' operations.  The captures on each
+# host are limited to config.capture_quota, separately from the server's
+# capture directory.  The logs of agent captures are not compressed, and
+# are not managed while the agent is not connected.
+#
+# Captures done by lc-serial-service are not in the capture directory,
+# and are not managed.  lc-serial-service should be run with its spill
+# files in the capture directory (with '-o'), where they count against
+# config.capture_quota.  The spill files are bounded by the service, so
+# they are never removed.
+
+CAPTURE_INDEX_FILENAME = "captures.json"
+CAPTURE_RESOURCE_QUOTA = 256*1024*1024
+SERIAL_SPILL_FILENAME_GLOB = capture_dir + "/serial-spill-*.data"
+
+# a compressed capture log, opened for reading
+# Seeking backwards in a gzip file requires decompressing from the start,
+# so the file is kept open by open_capture_log(), and reused while the
+# capture is read sequentially (as when following a capture).
+class compressed_log_class:
+    def __init__(self, path):
+        import gzip
+        self.path = path
+        self.f = gzip.open(path, "rb")
+
+    def seek(self, offset):
+        self.f.seek(offset)
+
+    def tell(self):
+        return self.f.tell()
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+    def close(self):
+        self.f.close()
+
+# the compressed log that was read last, in this request
+last_compressed_log = None
+
+# open the log of a capture (compressed or not)
+# If offset is specified, a compressed log that is already open at or
+# before offset is reused.
+# returns a file object, or None if there is no log for the capture
+def open_capture_log(token, offset=None):
+    global last_compressed_log
+
+    try:
+        return open(CAPTURE_LOG_FILENAME_FMT % token, "rb")
+    except IOError:
+        pass
+
+    gz_path = CAPTURE_GZ_FILENAME_FMT % token
+    f = last_compressed_log
+    if f and f.path == gz_path and offset is not None and \
+            f.tell() <= offset:
+        return f
+    if f:
+        f.close()
+        last_compressed_log = None
+    try:
+        f = compressed_log_class(gz_path)
+    except IOError:
+        return None
+    if offset is not None:
+        last_compressed_log = f
+    return f
+
+# open and lock the capture index
+# returns the file, and the index (a map of tokens to capture data)
+def lock_capture_index(req):
+    import fcntl
+
+    make_capture_dir()
+    f = open(capture_dir + os.sep + CAPTURE_INDEX_FILENAME, "a+")
+    fcntl.flock(f, fcntl.LOCK_EX)
+    f.seek(0)
+    try:
+        index = json.loads(f.read())
+    except ValueError:
+        index = {}
+    return f, index
+
+def save_capture_index(f, index):
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(index))
+
+def capture_is_running(token):
+    try:
+        with open(CAPTURE_PID_FILENAME_FMT % token) as f:
+            pid = int(f.read().strip())
+    except (IOError, ValueError):
+        return False
+    return process_is_alive(pid)
+
+# returns the size of the log of a capture, and whether it is compressed
+# (the size is None if the capture has no log)
+def capture_log_size(token):
+    for path, compressed in [(CAPTURE_LOG_FILENAME_FMT % token, False),
+            (CAPTURE_GZ_FILENAME_FMT % token, True)]:
+        try:
+            return (os.path.getsize(path), compressed)
+        except OSError:
+            pass
+    return (None, False)
+
+# compress the log of a finished capture
+# The log is compressed as a series of gzip members, and the offsets of
+# the members are saved in the time index of the capture, so that parts
+# of the log can be read without decompressing all of it (see "Capture
+# time index").
+# returns reason on failure, "" on success
+# If another request is already compressing the log, this does nothing.
+def compress_capture_log(token):
+    import fcntl
+
+    logfile = CAPTURE_LOG_FILENAME_FMT % token
+    gz_path = CAPTURE_GZ_FILENAME_FMT % token
+    tmp_path = gz_path + ".tmp"
+    start = time.time()
+    try:
+        # the lock on the temporary file keeps two requests from
+        # compressing the same log
+        dest = os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT, 0o644),
+                "wb")
+        try:
+            fcntl.flock(dest, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            dest.close()
+            return ""
+    except (IOError, OSError) as error:
+        return "Cannot compress capture log %s: %s" % (logfile, error)
+    try:
+        if not os.path.exists(logfile) or os.path.exists(gz_path):
+            # the log was compressed by another request
+            os.remove(tmp_path)
+            return ""
+        dest.truncate(0)
+
+        # finish the time index, before the log is compressed
+        reader = capture_log_reader_class(token, {})
+        index = update_time_index(token, reader, True)
+        reader.close()
+
+        blocks = []
+        raw_offset = 0
+        with open(logfile, "rb") as src:
+            while True:
+                chunk = src.read(CAPTURE_GZ_BLOCK_SIZE)
+                if not chunk:
+                    break
+                blocks.append([raw_offset, dest.tell()])
+                dest.write(gzip_data(chunk))
+                raw_offset += len(chunk)
+        dest.flush()
+        index["blocks"] = blocks
+        index["size"] = raw_offset
+        save_time_index(token, index)
+        os.rename(tmp_path, gz_path)
+        os.remove(logfile)
+    except (IOError, OSError) as error:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return "Cannot compress capture log %s: %s" % (logfile, error)
+    finally:
+        dest.close()
+    log_metric("capture_compress_time", time.time() - start, "s",
+            "token=" + token)
+    return ""
+
+# returns the total size of the lc-serial-service spill files in the
+# capture directory
+def serial_spill_size():
+    import glob
+
+    size = 0
+    for path in glob.glob(SERIAL_SPILL_FILENAME_GLOB):
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+# returns a map of token: (size, running) for the captures in the index
+# that were done by host agents, read with a 'stat' operation for each
+# connected agent.  The size is None if the capture has no log.
+def agent_capture_stats(req, index):
+    by_agent = {}
+    for token, entry in index.items():
+        if entry.get("agent"):
+            by_agent.setdefault(entry["agent"], []).append(token)
+
+    stats = {}
+    for host, tokens in by_agent.items():
+        if not agent_is_connected(req, host):
+            continue
+        captures = []
+        for token in tokens:
+            info = read_capture_info(token)
+            if info:
+                captures.append((token, info))
+            else:
+                # the capture was deleted
+                stats[token] = (None, False)
+        if not captures:
+            continue
+        files = [{ "path": info["logfile"], "pid": info.get("pid", None) }
+                for token, info in captures]
+        result, reason = agent_request(req, host, "stat", { "files": files })
+        if not result:
+            log_this(reason)
+            continue
+        for (token, info), item in zip(captures, result["files"]):
+            stats[token] = (item["size"], item["running"])
+    return stats
+
+# remove the files of a capture that is evicted
+# returns reason on failure, "" on success
+def remove_capture_files(req, token, entry):
+    if entry.get("agent"):
+        info = read_capture_info(token)
+        if info:
+            result, reason = agent_request(req, entry["agent"], "remove",
+                    { "path": info["logfile"] })
+            if not result:
+                return reason
+        paths = [CAPTURE_INFO_FILENAME_FMT % token]
+    else:
+        paths = [CAPTURE_LOG_FILENAME_FMT % token,
+                CAPTURE_GZ_FILENAME_FMT % token,
+                CAPTURE_TIME_INDEX_FILENAME_FMT % token]
+    for path in paths + [CAPTURE_STATS_FILENAME_FMT % token]:
+        if os.path.exists(path):
+            os.remove(path)
+    return ""
+
+# stop a running capture that is over quota
+# returns reason on failure, None on success
+def stop_tracked_capture(req, token, entry):
+    if entry.get("agent"):
+        info = read_capture_info(token)
+        if not info:
+            return "Cannot find capture info for capture %s" % token
+        result, reason = agent_request(req, entry["agent"], "kill",
+                { "pid": info["pid"] })
+        if not result:
+            return reason
+        return None
+    return stop_capture(req, "capture", { "name": entry["resource"] },
+            token, [])
+
+# compress finished captures, and remove the least recently used
+# captures that exceed the quotas
+# returns the index (with the current "size", "compressed" and
+# "running" state of each capture)
+def apply_capture_retention(req):
+    # find the logs to compress, and compress them with the index
+    # unlocked.  The sizes of agent captures are also read unlocked,
+    # since that waits for the agents.
+    f, index = lock_capture_index(req)
+    f.close()
+    for token, entry in index.items():
+        if entry.get("agent"):
+            continue
+        size, compressed = capture_log_size(token)
+        if size is not None and not compressed and \
+                not capture_is_running(token):
+            reason = compress_capture_log(token)
+            if reason:
+                log_this(reason)
+    agent_stats = agent_capture_stats(req, index)
+
+    f, index = lock_capture_index(req)
+    try:
+        evicted = []
+        for token, entry in index.items():
+            if entry.get("agent"):
+                if token not in agent_stats:
+                    # the agent is not connected - keep the last state
+                    entry.setdefault("size", 0)
+                    entry["running"] = entry.get("running", True)
+                    entry["compressed"] = False
+                    continue
+                size, entry["running"] = agent_stats[token]
+                compressed = False
+            else:
+                entry["running"] = capture_is_running(token)
+                size, compressed = capture_log_size(token)
+            if size is None and not entry["running"]:
+                # the log was removed
+                del index[token]
+                continue
+            entry["size"] = size or 0
+            entry["compressed"] = compressed
+
+        # remove captures for resources that are over their quota,
+        # and then for the total quota of the server and of each host
+        by_resource = {}
+        by_agent = {}
+        for token, entry in index.items():
+            by_resource.setdefault(entry["resource"], []).append(token)
+            by_agent.setdefault(entry.get("agent", ""), []).append(token)
+        quotas = []
+        for resource, tokens in by_resource.items():
+            resource_map = get_object_map(req, "resource", resource) or {}
+            try:
+                quota = int(resource_map.get("capture_quota",
+                        CAPTURE_RESOURCE_QUOTA))
+            except ValueError:
+                quota = CAPTURE_RESOURCE_QUOTA
+            quotas.append((tokens, quota))
+        for host, tokens in by_agent.items():
+            quota = config.capture_quota
+            if not host:
+                # the serial service spill files use part of the total
+                # quota of the server
+                quota -= serial_spill_size()
+            quotas.append((tokens, quota))
+
+        # captures of agents that are not connected can't be removed
+        # or stopped
+        managed = [token for token, entry in index.items()
+                if not entry.get("agent") or token in agent_stats]
+
+        stopped = []
+        for tokens, quota in quotas:
+            tokens = [token for token in tokens if token in index and \
+                    token not in stopped]
+            total = sum([index[token]["size"] for token in tokens])
+            candidates = sorted([(index[token]["last_access"], token)
+                for token in tokens if not index[token]["running"] and \
+                    token in managed])
+            while total > quota and candidates:
+                last_access, token = candidates.pop(0)
+                total -= index[token]["size"]
+                evicted.append((token, index.pop(token)))
+
+            # the running captures are over the quota by themselves
+            running = sorted([(index[token]["size"], token)
+                for token in tokens if token in index and \
+                    index[token]["running"] and token in managed],
+                reverse=True)
+            while total > quota and running:
+                size, token = running.pop(0)
+                stopped.append(token)
+                total -= size
+
+        save_capture_index(f, index)
+    finally:
+        f.close()
+
+    # remove and stop the captures with the index unlocked, since that
+    # waits for agents, and for capture processes to exit
+    for token, entry in evicted:
+        reason = remove_capture_files(req, token, entry)
+        if reason:
+            log_this(reason)
+        log_this("removed capture %s of resource %s (%d bytes), to stay within quota" % (token, entry["resource"], entry["size"]))
+        record_event(req, "capture", { "resource": entry["resource"],
+                "operation": "evict", "token": token })
+
+    for token in stopped:
+        entry = index[token]
+        reason = stop_tracked_capture(req, token, entry)
+        if reason:
+            log_this(reason)
+            continue
+        entry["running"] = False
+        log_this("stopped capture %s of resource %s (%d bytes), because it is over quota" % (token, entry["resource"], entry["size"]))
+        record_event(req, "capture", { "resource": entry["resource"],
+                "operation": "stop", "token": token, "reason": "quota" })
+    return index
+
+# add a capture to the index (for a capture that was just started)
+# agent is the host of the agent that does the capture, if any
+def track_capture(req, token, resource, agent=None):
+    f, index = lock_capture_index(req)
     try:
-        output, errs = proc.communicate()
+        now = time.time()
+        index[token] = { "resource": resource, "start": now,
+            "last_access": now, "size": 0, "compressed": False }
+        if agent:
+            index[token]["agent"] = agent
+        save_capture_index(f, index)
+    finally:
+        f.close()
+
+# record an access of a capture, for least-recently-used eviction
+# This also applies the retention rules, so that running captures that
+# have grown past a quota are stopped.
+def touch_capture(req, token):
+    f, index = lock_capture_index(req)
+    try:
+        if token in index:
+            index[token]["last_access"] = time.time()
+            save_capture_index(f, index)
+    finally:
+        f.close()
+    apply_capture_retention(req)
+
+def untrack_capture(req, token):
+    f, index = lock_capture_index(req)
+    try:
+        if token in index:
+            del index[token]
+            save_capture_index(f, index)
+    finally:
+        f.close()
+
+# return the size of the captures in the capture directory, for all
+# resources and for each resource (or only for the resource in the
+# 'resource' parameter)
+def return_api_capture_usage(req):
+    only_resource = req.form.getfirst("resource", "")
+    index = apply_capture_retention(req)
+
+    captures = []
+    resources = {}
+    for token, entry in sorted(index.items(),
+            key=lambda item: item[1]["start"]):
+        resource = entry["resource"]
+        if only_resource and resource != only_resource:
+            continue
+        captures.append({ "token": token, "resource": resource,
+            "agent": entry.get("agent", ""),
+            "size": entry["size"], "compressed": entry["compressed"],
+            "running": entry["running"], "start": entry["start"],
+            "last_access": entry["last_access"] })
+        usage = resources.setdefault(resource, { "size": 0, "count": 0 })
+        usage["size"] += entry["size"]
+        usage["count"] += 1
+
+    for resource, usage in resources.items():
+        resource_map = get_object_map(req, "resource", resource) or {}
+        usage["quota"] = resource_map.get("capture_quota",
+                CAPTURE_RESOURCE_QUOTA)
+
+    data = { "capture_dir": capture_dir,
+        "size": sum([entry["size"] for entry in index.values()]),
+        "spill_size": serial_spill_size(),
+        "quota": config.capture_quota,
+        "resources": resources,
+        "captures": captures }
+    req.send_api_response(RSLT_OK, { "data": data })
+
+#######################
+# Capture time index
+#
+# The lines of power measurement logs (and of serial logs, from capture
+# commands that stamp their output, or from lc-serial-service) start
+# with a timestamp.  get-data accepts 'start_time' and 'end_time'
+# parameters, to return only the lines with timestamps in that range.
+# The lines of a log must be in timestamp order, and lines without a
+# timestamp belong to the line before them.
+#
+# To find the range without reading the whole log, each capture log has
+# a sparse index (capture-index-{token}.json in the capture directory),
+# with the timestamp and offset of a line about every
+# CAPTURE_INDEX_INTERVAL bytes.  The index is extended when the log is
+# queried, by looking at a single line in each interval of new data
+# (the log is memory-mapped, so the rest of the data is not read).  A
+# query uses a binary search of the index, and then reads at most one
+# interval of the log before the requested data.
+#
+# A compressed log is a series of gzip members (each with
+# CAPTURE_GZ_BLOCK_SIZE bytes of log data), and the index has the
+# offsets of the members ("blocks"), so that only the members with the
+# requested data are decompressed.
+
+CAPTURE_INDEX_INTERVAL = 64*1024
+CAPTURE_GZ_BLOCK_SIZE = 256*1024
+CAPTURE_TIME_INDEX_FILENAME_FMT = capture_dir + "/capture-index-%s.json"
+
+line_timestamp_re = re.compile(r"\s*\[?\s*(\d+(?:\.\d*)?)[\s,\]]")
+
+# returns the timestamp at the start of a line, or None
+def line_timestamp(line):
+    m = line_timestamp_re.match(line)
+    if not m:
+        return None
+    return float(m.group(1))
+
+# reads ranges of the data of a capture log (compressed or not)
+class capture_log_reader_class:
+    def __init__(self, token, index):
+        import mmap
+
+        self.data = None
+        self.blocks = None
+        try:
+            self.f = open(CAPTURE_LOG_FILENAME_FMT % token, "rb")
+        except IOError:
+            self.f = open(CAPTURE_GZ_FILENAME_FMT % token, "rb")
+            self.blocks = index.get("blocks", [])
+            self.size = index.get("size", None)
+            if self.size is None:
+                # an old log, without blocks - decompress all of it
+                import gzip
+                self.data = gzip.GzipFile(fileobj=self.f).read()
+                self.size = len(self.data)
+            return
+
+        self.size = os.fstat(self.f.fileno()).st_size
+        if self.size:
+            self.data = mmap.mmap(self.f.fileno(), self.size,
+                    access=mmap.ACCESS_READ)
+        else:
+            self.data = ""
+
+    # returns the log data from start to end (offsets in the log)
+    def read(self, start, end):
+        import gzip
+        import bisect
+
+        end = min(end, self.size)
+        if start >= end:
+            return ""
+        if self.data is not None:
+            return self.data[start:end]
+
+        # decompress from the start of the member that has offset start
+        i = bisect.bisect_right([block[0] for block in self.blocks], start) - 1
+        raw_offset, file_offset = self.blocks[max(i, 0)]
+        self.f.seek(file_offset)
+        gz = gzip.GzipFile(fileobj=self.f)
+        gz.read(start - raw_offset)
+        return gz.read(end - start)
+
+    # returns an iterator over the log data from start to end, in chunks
+    # of at most chunk_size bytes
+    # A compressed log is decompressed once, from the member that has
+    # offset start.
+    def read_chunks(self, start, end, chunk_size):
+        import gzip
+        import bisect
+
+        end = min(end, self.size)
+        if self.data is not None:
+            for pos in range(start, end, chunk_size):
+                yield self.data[pos:min(pos + chunk_size, end)]
+            return
+
+        if start >= end:
+            return
+        i = bisect.bisect_right([block[0] for block in self.blocks], start) - 1
+        raw_offset, file_offset = self.blocks[max(i, 0)]
+        self.f.seek(file_offset)
+        gz = gzip.GzipFile(fileobj=self.f)
+        gz.read(start - raw_offset)
+        pos = start
+        while pos < end:
+            data = gz.read(min(chunk_size, end - pos))
+            if not data:
+                break
+            pos += len(data)
+            yield data
+
+    def close(self):
+        if self.data is not None and not isinstance(self.data, str):
+            self.data.close()
+        self.f.close()
+
+def read_time_index(token):
+    try:
+        with open(CAPTURE_TIME_INDEX_FILENAME_FMT % token) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return { "indexed": 0, "entries": [] }
+
+def save_time_index(token, index):
+    path = CAPTURE_TIME_INDEX_FILENAME_FMT % token
+    tmp_path = "%s.%d" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.rename(tmp_path, path)
+
+# extend the time index of a log, for the data that was added since it
+# was last updated, and return the index
+# For a log that is still being written, an interval is only indexed
+# once it has a complete line.  If finished is True, the end of the log
+# is indexed too.
+def update_time_index(token, reader, finished=False):
+    index = read_time_index(token)
+    if index.get("blocks", None) is not None or reader.data is None:
+        # the log is compressed, so the index is complete
+        return index
+
+    data = reader.data
+    size = reader.size
+    pos = index["indexed"]
+    changed = False
+    while pos < size:
+        block_end = pos + CAPTURE_INDEX_INTERVAL
+        if block_end > size and not finished:
+            break
+
+        # find the first line with a timestamp that starts in this interval
+        line_start = pos
+        if line_start > 0 and data[line_start-1] != "\n":
+            line_start = data.find("\n", pos, block_end) + 1
+            if not line_start:
+                line_start = block_end
+        incomplete = False
+        while line_start < min(block_end, size):
+            line_end = data.find("\n", line_start)
+            if line_end < 0 and not finished:
+                incomplete = True
+                break
+            ts = line_timestamp(data[line_start:line_start+64])
+            if ts is not None:
+                index["entries"].append([ts, line_start])
+                break
+            if line_end < 0:
+                break
+            line_start = line_end + 1
+        if incomplete:
+            break
+
+        pos = min(block_end, size)
+        changed = True
+
+    if changed:
+        index["indexed"] = pos
+        save_time_index(token, index)
+    return index
+
+# returns the offset of the first line in a log (after the line at
+# offset 'start') for which the timestamp matches the condition, or
+# 'end' if there is none
+def scan_for_time(reader, start, end, condition):
+    data = reader.read(start, end)
+    line_start = 0
+    while line_start < len(data):
+        ts = line_timestamp(data[line_start:line_start+64])
+        if ts is not None and condition(ts):
+            return start + line_start
+        line_end = data.find("\n", line_start)
+        if line_end < 0:
+            break
+        line_start = line_end + 1
+    return end
+
+# returns the offset of the first line of a log for which the timestamp
+# matches the condition, using the index to find where to look
+# condition must be False for the lines before that line, and True for
+# the lines after it.
+def find_time_offset(reader, index, condition):
+    entries = index["entries"]
+    lo = 0
+    hi = len(entries)
+    # binary search for the first entry matching the condition
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if condition(entries[mid][0]):
+            hi = mid
+        else:
+            lo = mid + 1
+
+    if lo > 0:
+        start = entries[lo-1][1]
+    else:
+        start = 0
+    if lo < len(entries):
+        end = entries[lo][1]
+    else:
+        end = reader.size
+    return scan_for_time(reader, start, end, condition)
+
+# returns the lines of a capture log with timestamps from start_time to
+# end_time (either of which can be None)
+# returns data, reason
+# returns chunks, reason - where chunks is an iterator over the data
+# (in chunks of CAPTURE_CHUNK_SIZE)
+def read_capture_time_range(token, start_time, end_time):
+    try:
+        reader = capture_log_reader_class(token, read_time_index(token))
+    except IOError:
+        return (None, "Cannot find capture log for token %s" % token)
+
+    try:
+        index = update_time_index(token, reader)
+        start = 0
+        end = reader.size
+        if start_time is not None:
+            start = find_time_offset(reader, index,
+                    lambda ts: ts >= start_time)
+        if end_time is not None:
+            end = find_time_offset(reader, index,
+                    lambda ts: ts > end_time)
     except:
-        proc.kill()
-        output, errs = proc.communicate()
+        reader.close()
+        raise
+
+    def chunks():
+        try:
+            for data in reader.read_chunks(start, end, CAPTURE_CHUNK_SIZE):
+                yield data
+        finally:
+            reader.close()
+    return (chunks(), "")
+
+# returns an iterator over the lines of log data (from an iterator over
+# chunks of the data) with timestamps from start_time to end_time
+# This is for data that is not in a capture log file.  The lines are
+# returned in chunks, as they are found.
+def filter_chunks_by_time(chunks, start_time, end_time):
+    import itertools
+
+    ts = None
+    rest = ""
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            # the end of the data - the last line may not have a newline
+            lines = [rest] if rest else []
+        else:
+            lines = (rest + chunk).split("\n")
+            rest = lines.pop()
+            lines = [line + "\n" for line in lines]
+        selected = []
+        for line in lines:
+            ts = line_timestamp(line) or ts
+            if ts is None:
+                continue
+            if start_time is not None and ts < start_time:
+                continue
+            if end_time is not None and ts > end_time:
+                if selected:
+                    yield "".join(selected)
+                return
+            selected.append(line)
+        if selected:
+            yield "".join(selected)
+
+# returns start_time, end_time, reason from the parameters of a request
+def get_time_range(req):
+    times = []
+    for name in ["start_time", "end_time"]:
+        value = req.form.getfirst(name, "")
+        try:
+            times.append(float(value) if value else None)
+        except ValueError:
+            return (None, None, "Invalid %s '%s'" % (name, value))
+    return (times[0], times[1], "")
+
+#######################
+# Power measurement statistics
+#
+# The lines of a power measurement log are:
+#   {timestamp},{millivolts},{milliamps}
+# The statistics of a capture (energy, mean, peak and percentiles of the
+# power) are kept in capture-stats-{token}.json in the capture directory,
+# with the offset of the log data they cover.  A stats request only reads
+# the data that was added to the log since the previous one, so the stats
+# of a running capture are available without reading the whole log.  The
+# stats are also updated when a capture is stopped (before the log is
+# compressed), and then don't change.
+#
+# The energy (in joules) is the trapezoidal integral of the power over
+# time, and the mean power is the energy divided by the duration.
+# Percentiles are estimated from a histogram of the power values, with
+# buckets that are POWER_BUCKET_RATIO apart (so they are within 1% of
+# the actual values).
+
+CAPTURE_STATS_FILENAME_FMT = capture_dir + "/capture-stats-%s.json"
+CAPTURE_STATS_READ_SIZE = 1024*1024
+POWER_BUCKET_RATIO = 1.01
+# bucket for power values of 0 (or less)
+POWER_ZERO_BUCKET = "zero"
+POWER_PERCENTILES = [50, 90, 95, 99]
+
+def read_power_stats(token):
+    try:
+        with open(CAPTURE_STATS_FILENAME_FMT % token) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return { "offset": 0, "samples": 0, "energy": 0.0, "sum": 0.0,
+            "peak": None, "min": None, "first_time": None,
+            "last_time": None, "last_power": None, "buckets": {},
+            "finished": False }
+
+def save_power_stats(token, stats):
+    path = CAPTURE_STATS_FILENAME_FMT % token
+    tmp_path = "%s.%d" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(stats, f)
+    os.rename(tmp_path, path)
+
+def power_bucket(power):
+    import math
+
+    if power <= 0:
+        return POWER_ZERO_BUCKET
+    return str(int(math.floor(math.log(power) / math.log(POWER_BUCKET_RATIO))))
+
+# add the samples in data (complete lines of a power measurement log)
+# to stats
+def add_power_samples(stats, data):
+    buckets = stats["buckets"]
+    for line in data.split("\n"):
+        parts = line.split(",")
+        try:
+            timestamp = float(parts[0])
+            power = float(parts[1]) / 1000.0 * float(parts[2]) / 1000.0
+        except (IndexError, ValueError):
+            continue
+
+        stats["samples"] += 1
+        stats["sum"] += power
+        if stats["peak"] is None or power > stats["peak"]:
+            stats["peak"] = power
+        if stats["min"] is None or power < stats["min"]:
+            stats["min"] = power
+        bucket = power_bucket(power)
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+
+        if stats["first_time"] is None:
+            stats["first_time"] = timestamp
+        elif timestamp > stats["last_time"]:
+            stats["energy"] += (stats["last_power"] + power) / 2.0 * \
+                    (timestamp - stats["last_time"])
+        stats["last_time"] = timestamp
+        stats["last_power"] = power
+
+# add the data that was captured since the stats were last updated,
+# and return stats, reason
+def update_power_stats(req, token):
+    stats = read_power_stats(token)
+    if stats["finished"]:
+        return (stats, "")
+
+    offset = stats["offset"]
+    while True:
+        data, running, reason = read_capture_range(req, token, offset,
+                CAPTURE_STATS_READ_SIZE)
+        if reason:
+            return (None, reason)
+        if not data:
+            break
+
+        # only use complete lines, unless the capture is finished
+        end = data.rfind("\n") + 1
+        if not running and len(data) < CAPTURE_STATS_READ_SIZE:
+            end = len(data)
+        elif not end:
+            if len(data) < CAPTURE_STATS_READ_SIZE:
+                break
+            # a line this long is not a sample
+            end = len(data)
+        add_power_samples(stats, data[:end])
+        offset += end
+
+    if offset != stats["offset"] or not running:
+        stats["offset"] = offset
+        stats["finished"] = not running
+        save_power_stats(token, stats)
+    return (stats, "")
+
+# returns the power value at percentile (0 to 100) of the samples
+def power_percentile(stats, percentile):
+    import math
+
+    if percentile <= 0:
+        return stats["min"]
+    if percentile >= 100:
+        return stats["peak"]
+    rank = max(1, int(math.ceil(percentile / 100.0 * stats["samples"])))
+    buckets = stats["buckets"]
+    count = buckets.get(POWER_ZERO_BUCKET, 0)
+    if count >= rank:
+        return 0.0
+    for bucket in sorted([int(b) for b in buckets if b != POWER_ZERO_BUCKET]):
+        count += buckets[str(bucket)]
+        if count >= rank:
+            # use the middle of the bucket, within the actual range
+            value = POWER_BUCKET_RATIO ** (bucket + 0.5)
+            return min(max(value, stats["min"]), stats["peak"])
+    return stats["peak"]
+
+# returns the power measurement stats for a capture, with the energy
+# (joules), duration (seconds), number of samples, mean, peak and
+# minimum power (watts), the requested percentiles of the power, and
+# whether the capture is still running
+def return_api_power_stats(req, token):
+    try:
+        percentiles = [float(p) for p in req.form.getfirst("percentiles",
+                ",".join([str(p) for p in POWER_PERCENTILES])).split(",")]
+    except ValueError:
+        percentiles = None
+    if not percentiles or not all(0 <= p <= 100 for p in percentiles):
+        req.send_api_response_msg(RSLT_FAIL, "Invalid percentiles for stats operation")
+        return
+
+    stats, reason = update_power_stats(req, token)
+    if not stats:
+        req.send_api_response_msg(RSLT_FAIL, reason)
+        return
+    touch_capture(req, token)
+
+    data = { "samples": stats["samples"], "energy": stats["energy"],
+        "duration": 0.0, "mean_power": None, "peak_power": stats["peak"],
+        "min_power": stats["min"], "percentiles": {},
+        "running": not stats["finished"] }
+    if stats["samples"]:
+        data["duration"] = stats["last_time"] - stats["first_time"]
+        if data["duration"] > 0:
+            data["mean_power"] = stats["energy"] / data["duration"]
+        else:
+            data["mean_power"] = stats["sum"] / stats["samples"]
+        for p in percentiles:
+            data["percentiles"]["%g" % p] = power_percentile(stats, p)
+    req.send_api_response(RSLT_OK, { "data": data })
+
+# how often to check for new data when following a capture (in seconds)
+FOLLOW_POLL_INTERVAL = 0.1
+# default time between heartbeat events when following a capture
+FOLLOW_HEARTBEAT_INTERVAL = 15
+
+# read captured data starting at offset (relative to the start of the
+# capture), for following a capture
+# returns data, running, reason
+# where running indicates whether the capture is still in progress.
+# On failure, data is None and reason is a string with an error message
+def read_capture_range(req, token, offset, max_size=65536):
+    info = read_capture_info(token)
+    if info and info.get("agent"):
+        return read_agent_capture(req, info, offset, max_size)
+    if info:
+        start = info["start"] + offset
+        stop = info.get("stop", None)
+        end = start + max_size
+        if stop is not None:
+            end = min(stop, end)
+        if end <= start:
+            return ("", stop is None, "")
+        request = { "cmd": "read", "dev": info["serial_dev"],
+                "stream": info.get("stream", None),
+                "start": start, "end": end }
+        response, data, reason = serial_service_request(info["socket"], request)
+        if not response:
+            return (None, False, reason)
+        return (data, stop is None, "")
+
+    # check if the capture is running before reading, so that data
+    # written just before the capture stopped is not missed
+    # (the pidfile is left behind if the capture command exits by itself,
+    # so check the process)
+    running = capture_is_running(token)
+    f = open_capture_log(token, offset)
+    if not f:
+        if running:
+            # the capture command has not created the log yet
+            return ("", True, "")
+        return (None, False, "Cannot find capture log for token %s" % token)
+
+    try:
+        f.seek(offset)
+        data = f.read(max_size)
+    except IOError as error:
+        return (None, False, "Cannot read capture log for token %s: %s" % (token, error))
+    if not isinstance(f, compressed_log_class):
+        f.close()
+    return (data, running, "")
+
+def send_event(event, data, event_id=None):
+    if event_id is not None:
+        sys.stdout.write("id: %s\n" % event_id)
+    sys.stdout.write("event: %s\ndata: %s\n\n" % (event, data))
+    sys.stdout.flush()
+
+# follow a capture, sending the captured data to the client as it
+# arrives, as a stream of server-sent events (Content-type
+# text/event-stream).  The events are:
+#   data      - data is the newly captured bytes (base64 encoded), and
+#               the event id is the offset in the capture after the data
+#   heartbeat - sent when no data has been captured for a while
+#   end       - the capture was stopped, and all of its data was sent
+#   error     - the capture could not be read
+# The heartbeat, end and error events have json data with the current
+# "offset" (and a "message", for an error).
+#
+# The client can resume following at an offset, with the 'offset'
+# parameter or the standard Last-Event-ID header.  The 'heartbeat'
+# parameter sets the time between heartbeat events, in seconds.
+def follow_capture(req, res_type, resource_map, token):
+    import base64
+
+    try:
+        offset = int(req.environ.get("HTTP_LAST_EVENT_ID", "") or \
+                req.form.getfirst("offset", "0"))
+        heartbeat = float(req.form.getfirst("heartbeat",
+                str(FOLLOW_HEARTBEAT_INTERVAL)))
+    except ValueError:
+        req.send_api_response_msg(RSLT_FAIL, "Invalid offset or heartbeat for follow operation")
+        return
+
+    # check that the capture can be read, before starting the stream
+    data, running, reason = read_capture_range(req, token, offset)
+    if reason:
+        req.send_api_response_msg(RSLT_FAIL, reason)
+        return
+    touch_capture(req, token)
+
+    sys.stdout.write("Content-type: text/event-stream\n")
+    sys.stdout.write("Cache-Control: no-cache\n\n")
+    sys.stdout.flush()
+
+    last_send = time.time()
+    try:
+        while True:
+            if data:
+                offset += len(data)
+                send_event("data", base64.b64encode(data), offset)
+                last_send = time.time()
+            elif not running:
+                send_event("end", json.dumps({ "offset": offset }), offset)
+                break
+            else:
+                if time.time() - last_send >= heartbeat:
+                    send_event("heartbeat", json.dumps({ "offset": offset }))
+                    last_send = time.time()
+                time.sleep(FOLLOW_POLL_INTERVAL)
+
+            data, running, reason = read_capture_range(req, token, offset)
+            if reason:
+                send_event("error", json.dumps({ "offset": offset,
+                        "message": reason }))
+                break
+    except IOError as error:
+        # the client closed the connection
+        log_this("follow of capture %s for resource %s ended: %s" % \
+                (token, resource_map["name"], error))
+
+# default and maximum time to wait for an expect operation (in seconds)
+EXPECT_TIMEOUT_DEFAULT = 30
+EXPECT_TIMEOUT_MAX = 3600
+# how often to send a keepalive space while waiting for a match
+EXPECT_KEEPALIVE_INTERVAL = 5
+# amount of already-scanned data that is kept for matching, so that a
+# match can span data that was read in different polls.  Matches that
+# are longer than this may be missed.
+EXPECT_WINDOW = 64*1024
+
+# wait for a regular expression to match the data of a capture, or for
+# a timeout.  The capture is scanned from 'offset' (default 0), and
+# each poll only reads the data that was captured since the previous
+# one.  The regular expression is matched with re.MULTILINE, so ^ and $
+# match at line boundaries.
+#
+# Like waiting for an assign, the response is started right away, and
+# spaces are sent while waiting, so that a closed connection is noticed.
+#
+# The response data has "matched" (true or false) and "offset", which is
+# the offset where the scan can be resumed (after the match, or the end
+# of the scanned data if there was no match).  For a match, there is
+# also "match" (the matched text), "start" and "end" (the offsets of the
+# match in the capture), "groups", and "time" (when the match was
+# found).  If the matched line starts with a timestamp, it is also
+# returned, as "line_time".
+def expect_capture(req, res_type, resource_map, token):
+    pattern_str = req.form.getfirst("pattern", "")
+    if not pattern_str:
+        req.send_api_response_msg(RSLT_FAIL, "Missing pattern for expect operation")
+        return
+    try:
+        pattern = re.compile(pattern_str, re.MULTILINE)
+    except re.error as error:
+        req.send_api_response_msg(RSLT_FAIL, "Invalid pattern '%s': %s" % (pattern_str, error))
+        return
+
+    try:
+        offset = int(req.form.getfirst("offset", "0"))
+        timeout = float(req.form.getfirst("timeout", str(EXPECT_TIMEOUT_DEFAULT)))
+    except ValueError:
+        req.send_api_response_msg(RSLT_FAIL, "Invalid offset or timeout for expect operation")
+        return
+    if offset < 0 or timeout < 0:
+        req.send_api_response_msg(RSLT_FAIL, "Invalid offset or timeout for expect operation")
+        return
+    timeout = min(timeout, EXPECT_TIMEOUT_MAX)
+
+    # check that the capture can be read, before starting the response
+    data, running, reason = read_capture_range(req, token, offset)
+    if reason:
+        req.send_api_response_msg(RSLT_FAIL, reason)
+        return
+    touch_capture(req, token)
+
+    sys.stdout.write("Content-type: text/plain\n" + req.api_headers() + "\n")
+    sys.stdout.flush()
+
+    # window holds the end of the scanned data, starting at window_start
+    window = ""
+    window_start = offset
+    m = None
+    start = time.time()
+    last_keepalive = start
+    try:
+        while True:
+            if data:
+                window += data
+                m = pattern.search(window)
+                if m:
+                    break
+                if len(window) > EXPECT_WINDOW:
+                    window_start += len(window) - EXPECT_WINDOW
+                    window = window[-EXPECT_WINDOW:]
+            elif not running:
+                break
+
+            # check the timeout even while data is arriving, since a
+            # capture with continuous output might never match
+            now = time.time()
+            if now - start >= timeout:
+                break
+            if now - last_keepalive >= EXPECT_KEEPALIVE_INTERVAL:
+                sys.stdout.write(" ")
+                sys.stdout.flush()
+                last_keepalive = now
+            if not data:
+                time.sleep(FOLLOW_POLL_INTERVAL)
+
+            data, running, reason = read_capture_range(req, token,
+                    window_start + len(window))
+            if reason:
+                break
+    except IOError as error:
+        # the client closed the connection
+        log_this("expect on capture %s for resource %s ended: %s" % \
+                (token, resource_map["name"], error))
+        return
+
+    if m:
+        # the start of the matched line may not be in the window
+        line_time = None
+        line_start = window.rfind("\n", 0, m.start()) + 1
+        if line_start or window_start == 0:
+            line_end = window.find("\n", line_start)
+            if line_end < 0:
+                line_end = len(window)
+            line_time = line_timestamp(window[line_start:line_end])
+
+        # serial data may not be valid utf-8
+        def text(s):
+            if s is None:
+                return None
+            return s.decode("utf8", "replace")
+        result = { "result": RSLT_OK, "data": { "matched": True,
+            "match": text(m.group(0)), "groups": map(text, m.groups()),
+            "start": window_start + m.start(), "end": window_start + m.end(),
+            "offset": window_start + m.end(), "time": time.time(),
+            "line_time": line_time } }
+    elif reason:
+        result = { "result": RSLT_FAIL, "message": reason }
+    else:
+        if running:
+            msg = "Timed out waiting for pattern '%s'" % pattern_str
+        else:
+            msg = "Capture %s ended without a match for pattern '%s'" % \
+                    (token, pattern_str)
+        result = { "result": RSLT_OK, "data": { "matched": False,
+            "offset": window_start + len(window), "message": msg } }
+    try:
+        sys.stdout.write(api_json(result))
+        sys.stdout.flush()
+    except IOError as error:
+        log_this("could not send expect result for capture %s: %s" % (token, error))
+
+# put data from the request body to a resource, using the resource's
+# put_cmd.  The data is streamed to the standard input of the command,
+# in chunks, so it is never held in memory or written to a file.
+# For commands that expect a filename, %(datafile)s is "/dev/stdin".
+#
+# Commands that need a real file (one they can seek in, or stat, like
+# scp or sz) can't use /dev/stdin.  A resource with "put_stdin": false
+# has the data written to a temporary file first, and %(datafile)s is
+# the path of that file.
+#
+# returns reason on failure, None on success
+# If pipe is specified, it is used (instead of pipe_body_to_command) to
+# send the request body to the put command.  If spool is specified, it
+# is used (instead of spool_body_to_command) for "put_stdin": false.
+def put_data(req, action, resource_map, rest, pipe=None, spool=None):
+    resource = resource_map["name"]
+    put_cmd = resource_map.get("put_cmd", "")
+    if not put_cmd:
+        return "Could not find 'put_cmd' for resource resource %s" %  resource
+    dlog_this("put_cmd=" + put_cmd)
+
+    d = copy.deepcopy(resource_map)
+    use_shell = cmd_uses_shell(resource_map, "put")
+    if resource_map.get("put_stdin", True) is False:
+        def make_cmd(path):
+            d["datafile"] = path
+            cmd_str = put_cmd % d
+            dlog_this("(interpolated) cmd_str='%s'" % cmd_str)
+            return cmd_str
+        spool = spool or spool_body_to_command
+        rcode, result, reason = spool(req, make_cmd, use_shell)
+    else:
+        d["datafile"] = "/dev/stdin"
+        cmd_str = put_cmd % d
+        dlog_this("(interpolated) cmd_str='%s'" % cmd_str)
+        pipe = pipe or pipe_body_to_command
+        rcode, result, reason = pipe(req, cmd_str, use_shell)
+    if reason:
+        return reason
+
+    if rcode:
+        msg = "Result of put operation on resource %s = %d\n" % (resource, rcode)
+        output = result.decode('utf8', errors='ignore')
+        msg += "command output (decoded)='" + output + "'"
+        return msg
+
+    return None
+
+# stream the request body to the standard input of a command, in chunks
+# If hasher is specified (e.g. a hashlib object), it is updated with
+# the data as it is sent.
+# returns rcode, output, reason - where output has the stdout and stderr
+# of the command, and reason is non-empty if the command couldn't be run
+def pipe_body_to_command(req, cmd_str, use_shell, hasher=None):
+    try:
+        from subprocess import STDOUT
+        proc = spawn_process(cmd_str, use_shell, stderr=STDOUT)
+    except (OSError, ValueError) as error:
+        return (None, "", "%s trying to execute command '%s'" % (error, cmd_str))
 
-    timer.cancel()
+    # collect command output in the background, so the command can't
+    # block on a full output pipe while we are writing data to it
+    output_list = []
+    reader = threading.Thread(target=lambda: output_list.append(proc.stdout.read()))
+    reader.start()
 
-    # FIXTHIS - run_command discards error output
+    try:
+        for chunk in req.body_chunks():
+            if hasher:
+                hasher.update(chunk)
+            proc.stdin.write(chunk)
+        proc.stdin.close()
+    except IOError as error:
+        # the command exited without reading all the data
+        log_this("error writing data to command '%s': %s" % (cmd_str, error))
+
+    rcode = proc.wait()
+    reader.join()
+    return (rcode, "".join(output_list), "")
+
+# write the request body to a temporary file, in chunks, and run the
+# command returned by make_cmd(path) for that file
+# returns rcode, output, reason - like pipe_body_to_command
+def spool_body_to_command(req, make_cmd, use_shell):
+    fd, path = tempfile.mkstemp(".bin", "lc-put-data-")
+    try:
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in req.body_chunks():
+                    f.write(chunk)
+        except IOError as error:
+            return (None, "", "Cannot write data to %s: %s" % (path, error))
+        rcode, output, errors = spawn_command(make_cmd(path), use_shell)
+    finally:
+        os.remove(path)
+    return (rcode, output + errors, "")
+
+# a request with data from the server as its body, so that a driver's
+# put_data can send data that was not in the request (see transmit_test)
+class data_req_class:
+    def __init__(self, req, data):
+        self.req = req
+        self.data = data
+
+    def __getattr__(self, name):
+        return getattr(self.req, name)
+
+    def body_chunks(self, chunk_size=65536):
+        self.body_bytes = len(self.data)
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i+chunk_size]
 
-    rcode = proc.returncode
-    log_this("rcode=%s" % rcode)
+#######################
+# Serial transmit tests
+#
+# A transmit test sends data from one serial resource (the sender) and
+# checks that it is captured by another one (or by the same resource,
+# for a port with a loopback connection), at each of a list of baud
+# rates.  This does the same steps as serial-transmit-test.sh
+# (set-config, start, put-data, get-data, stop and delete), on the
+# server, so that a sweep of baud rates costs a single request.
+#
+# After the test, the resources are left configured for the last rate.
+
+TRANSMIT_TEST_DATA = "This is an ASCII test string, transmitted over the serial line"
+# maximum amount of test data, for the 'size' parameter
+TRANSMIT_TEST_MAX_SIZE = 1024*1024
+# time to let the capture settle, before sending data (in seconds)
+TRANSMIT_SETTLE_TIME = 0.5
+# minimum time to wait for the data, after sending it (in seconds)
+TRANSMIT_TIMEOUT_MIN = 2.0
+TRANSMIT_POLL_INTERVAL = 0.02
+
+# run a transmit test at one baud rate, and return a map with the result
+# sender and receiver are resource names
+def transmit_test_rate(req, sender, receiver, rate, data):
+    result = { "baud_rate": rate, "result": "error", "sent": len(data) }
+
+    for resource in set([sender, receiver]):
+        resource_map = get_object_map(req, "resource", resource)
+        driver, reason = get_driver(req, resource_map, "serial")
+        if driver:
+            reason = driver.set_config("serial", { "baud_rate": rate })
+        if reason:
+            result["message"] = reason
+            return result
+
+    receiver_map = get_object_map(req, "resource", receiver)
+    receiver_driver, reason = get_driver(req, receiver_map, "serial")
+    if not receiver_driver:
+        result["message"] = reason
+        return result
+    token, reason = receiver_driver.start_capture("serial")
+    if not token:
+        result["message"] = reason
+        return result
+    if not read_capture_info(token):
+        track_capture(req, token, receiver)
 
-    log_this("output='%s'" % output)
-    # keep the newlines on the lines
-    lines = output.splitlines(True)
-    #lines = output.split("\n")
-    return (lines, rcode, None)
+    try:
+        time.sleep(TRANSMIT_SETTLE_TIME)
+
+        sender_map = get_object_map(req, "resource", sender)
+        sender_driver, reason = get_driver(data_req_class(req, data),
+                sender_map, "serial")
+        start = time.time()
+        if sender_driver:
+            reason = sender_driver.put_data("serial")
+        if reason:
+            result["message"] = reason
+            return result
+
+        # wait for the data, allowing twice the transmission time (with
+        # 10 bits per byte)
+        timeout = TRANSMIT_TIMEOUT_MIN + 2 * len(data) * 10.0 / int(rate)
+        received = ""
+        last_data = start
+        while len(received) < len(data) and time.time() - start < timeout:
+            chunk, running, reason = read_capture_range(req, token,
+                    len(received))
+            if reason:
+                result["message"] = reason
+                return result
+            if chunk:
+                received += chunk
+                last_data = time.time()
+            elif not running:
+                break
+            else:
+                time.sleep(TRANSMIT_POLL_INTERVAL)
+    finally:
+        receiver_driver.stop_capture("serial", token)
+        delete_capture(req, "serial", receiver_map, token, [])
+
+    errors = abs(len(received) - len(data))
+    for sent_byte, received_byte in zip(data, received):
+        if sent_byte != received_byte:
+            errors += 1
+    seconds = last_data - start
+    result["result"] = "pass" if errors == 0 else "fail"
+    result["received"] = len(received)
+    result["byte_errors"] = errors
+    result["seconds"] = round(seconds, 3)
+    if received and seconds > 0:
+        result["bytes_per_second"] = int(len(received) / seconds)
+    return result
+
+# perform a transmit test on a serial resource (the receiver), for the
+# baud rates in the 'rates' parameter (a comma-separated list).  The
+# 'sender' parameter is the resource that sends the data (default: the
+# same resource), and 'size' is the number of bytes of test data to send
+# (default: the length of TRANSMIT_TEST_DATA).
+#
+# The response data is a list with a map for each rate, with the
+# "baud_rate", the "result" ("pass", "fail" or "error"), the number of
+# bytes "sent" and "received", the number of "byte_errors", and the
+# "seconds" and "bytes_per_second" for receiving the data (or a
+# "message", for an error).
+def transmit_test(req, resource_map):
+    receiver = resource_map["name"]
+    sender = req.form.getfirst("sender", receiver)
+    if sender != receiver and not get_object_map(req, "resource", sender):
+        req.send_api_response_msg(RSLT_FAIL, "Could not find resource '%s' registered with server" % sender)
+        return
 
-# returns non-empty reason string on failure
-def set_config(req, action, resource_map, config_map, rest):
-    resource = resource_map["name"]
-    config_cmd = resource_map.get("config_cmd", "")
-    if not config_cmd:
-        return "Could not find 'config_cmd' for resource resource %s" %  resource
+    rates = [rate.strip() for rate in req.form.getfirst("rates", "").split(",")
+            if rate.strip()]
+    if not rates or not all(rate.isdigit() and int(rate) > 0 for rate in rates):
+        req.send_api_response_msg(RSLT_FAIL, "Missing or invalid baud rates for transmit-test operation")
+        return
 
-    dlog_this("config_cmd=" + config_cmd)
+    data = TRANSMIT_TEST_DATA
+    size = req.form.getfirst("size", "")
+    if size:
+        if not size.isdigit() or not 0 < int(size) <= TRANSMIT_TEST_MAX_SIZE:
+            req.send_api_response_msg(RSLT_FAIL, "Invalid size '%s' for transmit-test operation" % size)
+            return
+        count = int(size) // len(TRANSMIT_TEST_DATA) + 1
+        data = ((TRANSMIT_TEST_DATA + "\n") * count)[:int(size)]
 
-    allowed_config_items=["baud_rate"]
+    results = []
+    for rate in rates:
+        results.append(transmit_test_rate(req, sender, receiver, rate, data))
+        log_this("transmit test from %s to %s at %s: %s" % (sender,
+                receiver, rate, results[-1]["result"]))
 
-    new_resource_map = copy.deepcopy(resource_map)
-    # only copy allowed items from config_map
-    for key, value in config_map.items():
-        if key in allowed_config_items:
-            new_resource_map[key] = value
+    record_event(req, "config", { "resource": receiver, "res_type": "serial",
+            "operation": "transmit-test", "sender": sender,
+            "rates": ",".join(rates) })
+    req.send_api_response(RSLT_OK, { "data": results })
 
-    cmd_str = config_cmd % new_resource_map
-    dlog_this("(interpolated) cmd_str='%s'" + cmd_str)
-    rcode, result = getstatusoutput(cmd_str)
-    if rcode:
-        msg = "Result of set-config operation on resource %s = %d\n" % (resource, rcode)
+#######################
+# resource drivers
+#
+# A driver is a python class that performs the operations for a resource.
+# Each driver class is registered by name, along with the resource types
+# it supports.  The driver used for a resource is selected by the
+# "driver" attribute of the resource, which can be either a driver name,
+# or a map of resource types to driver names.  For example:
+#   "driver": "termios"
+#   "driver": { "serial": "termios" }
+# If a resource has no "driver" attribute, the default driver for the
+# resource type is used (see default_drivers), or the 'cmd' driver,
+# which executes the {action}_cmd attributes of the resource.
+#
+# Additional drivers can be provided by python files in the 'drivers'
+# directory of lc-data.  Each file must define a function:
+#   register_drivers(lcserver)
+# which is called with this module when drivers are loaded, and which
+# should call lcserver.register_driver() for each driver class.
+# Driver classes should be derived from lcserver.cmd_driver_class, so
+# that operations that they don't implement use the default behavior.
+#
+# Driver methods return the same values as the corresponding
+# functions they replace:
+#   power(board_map, operation) -> (result, msg)
+#   power_status(board_map) -> (result, status_or_msg)
+#   set_config(res_type, config_map) -> reason (None on success)
+#   start_capture(res_type) -> (token, reason)
+#   stop_capture(res_type, token) -> reason (None on success)
+#   put_data(res_type) -> reason (None on success)
+
+# the default driver, which executes commands from the resource object
+class cmd_driver_class:
+    # list of supported resource types - empty means all types
+    res_types = []
+
+    def __init__(self, req, resource_map):
+        self.req = req
+        self.resource_map = resource_map
+
+    def power(self, board_map, operation):
+        return exec_command(self.req, board_map, self.resource_map, operation)
+
+    def power_status(self, board_map):
+        return exec_power_status(self.req, board_map, self.resource_map)
+
+    def set_config(self, res_type, config_map):
+        return set_config(self.req, res_type, self.resource_map, config_map, [])
+
+    def start_capture(self, res_type):
+        return start_capture(self.req, res_type, self.resource_map, [])
+
+    def stop_capture(self, res_type, token):
+        return stop_capture(self.req, res_type, self.resource_map, token, [])
+
+    def put_data(self, res_type):
+        return put_data(self.req, res_type, self.resource_map, [])
+
+# a native driver for serial resources
+# This configures the serial device and writes data to it directly,
+# using termios, instead of running stty or other commands.
+class termios_serial_driver_class(cmd_driver_class):
+    res_types = ["serial"]
+
+    # open the serial device for the resource
+    # returns fd, reason - fd is None on failure
+    def open_dev(self):
+        dev = self.resource_map.get("serial_dev", "")
+        if not dev:
+            return (None, "Could not find 'serial_dev' for resource %s" % self.resource_map["name"])
+        try:
+            fd = os.open(dev, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        except OSError as error:
+            return (None, "Could not open serial device %s: %s" % (dev, error))
+        return (fd, "")
+
+    def set_config(self, res_type, config_map):
+        import termios
+
+        resource = self.resource_map["name"]
+        new_resource_map = copy.deepcopy(self.resource_map)
+        # only copy allowed items from config_map
+        if "baud_rate" in config_map:
+            new_resource_map["baud_rate"] = config_map["baud_rate"]
+
+        baud_rate = str(new_resource_map.get("baud_rate", ""))
+        speed = getattr(termios, "B" + baud_rate, None)
+        if not baud_rate or speed is None:
+            return "Unsupported baud_rate '%s' for resource %s" % (baud_rate, resource)
+
+        fd, reason = self.open_dev()
+        if fd is None:
+            return reason
+
+        # configure the same as 'stty <rate> raw -echo -echoe -echok'
+        try:
+            try:
+                attrs = termios.tcgetattr(fd)
+                iflag, oflag, cflag, lflag, ispeed, ospeed, cc = attrs
+                iflag &= ~(termios.BRKINT | termios.ICRNL | termios.INPCK |
+                        termios.ISTRIP | termios.IXON | termios.INLCR |
+                        termios.IGNCR | termios.PARMRK)
+                oflag &= ~termios.OPOST
+                cflag &= ~(termios.CSIZE | termios.PARENB)
+                cflag |= termios.CS8 | termios.CREAD
+                lflag &= ~(termios.ECHO | termios.ECHOE | termios.ECHOK |
+                        termios.ECHONL | termios.ICANON | termios.ISIG |
+                        termios.IEXTEN)
+                cc[termios.VMIN] = 1
+                cc[termios.VTIME] = 0
+                termios.tcsetattr(fd, termios.TCSANOW,
+                    [iflag, oflag, cflag, lflag, speed, speed, cc])
+            except termios.error as error:
+                return "Could not configure serial device for resource %s: %s" % (resource, error)
+        finally:
+            os.close(fd)
+
+        # write out updated resource_map
+        save_object_data(self.req, "resource", resource, new_resource_map)
+        return None
 
-        # Apparently, 'stty' error output uses some high unicode code points,
-        # (outside the ascii range), which cause an exception if you don't
-        # decode them. (ie, they get auto-decoded as ascii)
-        # Have I told you, lately, how much I hate python unicode handling??
-        output = result.decode('utf8', errors='ignore')
-        msg += "command output (decoded)='" + output + "'"
-        return msg
+    def put_data(self, res_type):
+        fd, reason = self.open_dev()
+        if fd is None:
+            return reason
 
-    # write out updated resource_map
-    save_object_data(req, "resource", resource, new_resource_map)
+        try:
+            # switch to blocking writes, so the data is not dropped
+            import fcntl
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+            for data in self.req.body_chunks():
+                while data:
+                    count = os.write(fd, data)
+                    data = data[count:]
+        except OSError as error:
+            os.close(fd)
+            return "Could not write data to resource %s: %s" % (self.resource_map["name"], error)
+
+        os.close(fd)
+        return None
 
-    return None
+# send a request to lc-serial-service, and return:
+#   response, data, reason
+# where response is a map with the json response from the service, and
+# data has any data that followed the response.  On failure, response is
+# None and reason is a string with an error message.
+def serial_service_request(sock_path, request):
+    import socket
 
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(10.0)
+        sock.connect(sock_path)
+        sock.sendall(json.dumps(request) + "\n")
+        sfd = sock.makefile("rb")
+        response = json.loads(sfd.readline())
+        data = sfd.read(response.get("length", 0))
+        sfd.close()
+        sock.close()
+    except (socket.error, ValueError) as error:
+        msg = "Could not communicate with serial service at %s: %s" % (sock_path, error)
+        log_this(msg)
+        return (None, "", msg)
 
-# returns token, reason
-# on error, token is None or empty and reason is a string with an error
-# message.  The error message should start with "Error: "
-def start_capture(req, action, resource_map, rest):
-    # look up capture_cmd in resource_map, and call it
-    resource = resource_map["name"]
-    capture_cmd = resource_map.get("capture_cmd")
+    if response.get("result", RSLT_FAIL) != RSLT_OK:
+        msg = "Serial service error: %s" % response.get("message", "unknown error")
+        return (None, "", msg)
 
-    log_this("capture_cmd=" + capture_cmd)
+    return (response, data, "")
 
-    # generate the logfile path, and hand  to the capture_cmd
-    # FIXTHIS - use a hardcoded logfile and pidfile for now
-    token = "1234"
-    fd, logpath = tempfile.mkstemp(capture_suffix, capture_prefix, capture_dir)
-    os.close(fd)
-    os.remove(logpath)
-    filename = os.path.basename(logpath)
-    token = filename[len(capture_prefix):-len(capture_suffix)]
+# returns map with capture information, or None if the capture
+# with the indicated token is not a serial service capture
+def read_capture_info(token):
+    infofile = CAPTURE_INFO_FILENAME_FMT % token
+    if not os.path.exists(infofile):
+        return None
 
-    pidfile = CAPTURE_PID_FILENAME_FMT % token
+    try:
+        with open(infofile) as ifd:
+            return json.load(ifd)
+    except (IOError, ValueError):
+        log_this("Error reading capture info file %s" % infofile)
+        return None
 
-    if os.path.exists(pidfile):
-        # FIXTHIS - in start_capture, check and see if process is still running
-        # if not, just remove pidfile, and continue
-        return ("", "Capture is already running for resource %s" % resource)
+def save_capture_info(token, info):
+    infofile = CAPTURE_INFO_FILENAME_FMT % token
+    with open(infofile, "w") as ifd:
+        json.dump(info, ifd)
+
+# size of each range of data read from lc-serial-service, for get-data
+SERIAL_SERVICE_READ_SIZE = 1024*1024
+
+# read the data between offsets start and end of a serial service capture
+# returns data, offset, reason - where offset is the current offset of
+# the stream, and data is None on failure
+def read_service_range(info, start, end):
+    request = { "cmd": "read", "dev": info["serial_dev"],
+            "stream": info.get("stream", None),
+            "start": start, "end": end }
+    response, data, reason = serial_service_request(info["socket"], request)
+    if not response:
+        return (None, None, reason)
+    return (data, response["offset"], "")
+
+# returns chunks, reason for a serial service capture
+# where chunks is an iterator over the data, which is read from the
+# service in ranges of SERIAL_SERVICE_READ_SIZE bytes
+# if the capture is still running, data up to the current offset is returned
+# If start_time or end_time are specified, only the data received
+# between those times is returned (the service records the time that
+# data was received).
+def read_service_capture(info, start_time=None, end_time=None):
+    start = info["start"]
+    end = info.get("stop", None)
+    if start_time is not None or end_time is not None:
+        request = { "cmd": "time_offsets", "dev": info["serial_dev"],
+                "stream": info.get("stream", None),
+                "times": [start_time, end_time] }
+        response, data, reason = serial_service_request(info["socket"], request)
+        if not response:
+            return (None, reason)
+        start_offset, end_offset = response["offsets"]
+        if start_offset is not None:
+            start = max(start, start_offset)
+        if end_offset is not None:
+            end = end_offset if end is None else min(end, end_offset)
+        if end is not None and end <= start:
+            return (iter([]), "")
+
+    # read the first range here, so that an error can be reported
+    # before the response is started
+    first_end = start + SERIAL_SERVICE_READ_SIZE
+    if end is not None:
+        first_end = min(end, first_end)
+    data, offset, reason = read_service_range(info, start, first_end)
+    if data is None:
+        return (None, reason)
+    if end is None:
+        end = offset
+
+    def chunks(data):
+        pos = start + len(data)
+        yield data
+        while data and pos < end:
+            data, offset, reason = read_service_range(info, pos,
+                    min(end, pos + SERIAL_SERVICE_READ_SIZE))
+            if data is None:
+                log_this(reason)
+                raise IOError(reason)
+            pos += len(data)
+            yield data
+    return (chunks(data), "")
+
+# a driver for serial resources, which uses lc-serial-service to
+# read from the serial device.  The service keeps the serial device open
+# all the time, so a capture is just a range of the data received.
+#
+# Starting a capture accepts an optional 'backlog' parameter, which is
+# the number of bytes, received before the capture was started, to
+# include in the capture.
+class service_serial_driver_class(cmd_driver_class):
+    res_types = ["serial"]
+
+    def service_socket(self):
+        return self.resource_map.get("service_socket", SERIAL_SERVICE_SOCKET)
+
+    # returns offset, stream, reason
+    # If stream is specified, this fails if the device's stream has
+    # changed (because the service was restarted).
+    def current_offset(self, stream=None):
+        request = { "cmd": "offset", "dev": self.resource_map["serial_dev"],
+                "stream": stream }
+        response, data, reason = serial_service_request(self.service_socket(),
+                request)
+        if not response:
+            return (None, None, reason)
+        return (response["offset"], response.get("stream", None), "")
+
+    def start_capture(self, res_type):
+        resource = self.resource_map["name"]
+        if "serial_dev" not in self.resource_map:
+            return ("", "Could not find 'serial_dev' for resource %s" % resource)
+
+        offset, stream, reason = self.current_offset()
+        if offset is None:
+            return ("", reason)
 
-    # do string interpolation from the data in the resource map
-    # (adding the 'logfile' attribute)
-    d = copy.deepcopy(resource_map)
-    d["logfile"] = logpath
+        try:
+            backlog = int(self.req.form.getfirst("backlog", "0"))
+        except (TypeError, ValueError):
+            backlog = 0
+        start = max(0, offset - backlog)
+
+        make_capture_dir()
+        fd, infopath = tempfile.mkstemp(capture_info_suffix,
+                capture_info_prefix, capture_dir)
+        os.close(fd)
+        filename = os.path.basename(infopath)
+        token = filename[len(capture_info_prefix):-len(capture_info_suffix)]
+
+        info = { "resource": resource,
+            "serial_dev": self.resource_map["serial_dev"],
+            "socket": self.service_socket(),
+            "stream": stream,
+            "start": start,
+            "stop": None }
+        save_capture_info(token, info)
+
+        log_this("started service capture %s at offset %d" % (token, start))
+        return (token, "")
+
+    def stop_capture(self, res_type, token):
+        info = read_capture_info(token)
+        if not info:
+            return "Cannot find executing capture for %s for resource '%s'" % (res_type, self.resource_map["name"])
+
+        if info.get("stop", None) is None:
+            offset, stream, reason = self.current_offset(info.get("stream", None))
+            if offset is None:
+                return reason
+            info["stop"] = offset
+            save_capture_info(token, info)
 
-    cmd = capture_cmd % d
-    log_this("(interpolated) cmd=" + cmd)
+        return None
 
-    # save pid in a file, named with the token used earlier
-    pid, msg = new_exec_command(cmd)
-    if not pid:
-        log_this("exec failure: reason=" + msg)
-        return ("", msg)
+#######################
+# host agents
+#
+# Boards and resources are attached to lab hosts (with their "host"
+# attribute).  An agent (lc-agent) running on a lab host performs the
+# resource operations for that host, so that the server does not have
+# to run on the machine with the lab hardware.
+#
+# The server is a CGI script, so the agent keeps a long-poll request
+# open to api/v0.2/agents/{host}/ops, which returns the operations that
+# are waiting for the host.  A request that needs the agent puts an
+# operation file in lc-data/data/agents/{host}/ops, and waits for the
+# agent to post the result to api/v0.2/agents/{host}/result/{op_id}.
+# The agent performs each operation in its own thread, so many
+# operations can be in progress on a host at the same time.  When it
+# polls, the agent reports its capture directory ("capture_dir"), where
+# the logs of captures on the host are written.
+#
+# The operations are:
+#   { "op": "exec", "cmd": <cmd>, "shell": <bool>, "timeout": <seconds>,
+#     "input": <base64 data>, "input_path": <path> }
+#     - run a command, and return its "rcode", "output" and "errors"
+#       (base64 encoded).  The command reads its standard input from
+#       "input", or from the file at "input_path".
+#   { "op": "write", "data": <base64 data>, "path": <path> }
+#     - append data to a file, and return its "path".  If no path is
+#       specified, a new temporary file is created.
+#   { "op": "spawn", "cmd": <cmd>, "shell": <bool> }
+#     - start a command in the background, and return its "pid"
+#   { "op": "kill", "pid": <pid> }
+#     - stop a command started with spawn
+#   { "op": "read", "path": <path>, "offset": <offset>, "size": <size>,
+#     "pid": <pid> }
+#     - read part of a file, and return the "data" (base64 encoded), and
+#       whether the process with the pid is "running".  The agent
+#       returns at most 16MB for each read (less at the end of the file).
+#   { "op": "remove", "path": <path> }
+#     - remove a file
+#   { "op": "stat", "files": [ { "path": <path>, "pid": <pid> }, ... ] }
+#     - return "files", with the "size" of each file (null if it does
+#       not exist), and whether the process with its pid is "running"
+# Each result has "result": "success" or "fail" (with a "message").
+#
+# Only a user that is allowed to be the agent for a host can get the
+# operations for the host, or post their results.  The hosts are listed
+# in the "agent_for" attribute of the user (in data/users/user-{name}.json).
+#
+# While the agent is waiting for operations, the server sends it a space
+# every second, so that the request notices when the agent has gone
+# away.  An agent is connected if it has been waiting for operations
+# recently.  Resources that use the 'cmd' driver, on a host with a connected agent,
+# use the 'agent' driver instead.
+
+# how often to check for operations and results (in seconds)
+AGENT_POLL_INTERVAL = 0.02
+AGENT_WAIT_DEFAULT = 20
+AGENT_WAIT_MAX = 60
+AGENT_KEEPALIVE_INTERVAL = 1.0
+# an agent is no longer connected if it has not polled for this long
+AGENT_ALIVE_TIMEOUT = 5
+# default time to wait for the result of an operation
+AGENT_OP_TIMEOUT = 60
+# size of the data sent to the agent in each write operation
+AGENT_WRITE_CHUNK_SIZE = 1024*1024
+# maximum size of the data read from the agent in each read operation
+# (this must not be more than READ_MAX_SIZE in lc-agent)
+AGENT_READ_CHUNK_SIZE = 1024*1024
+
+def agent_dir(req, host):
+    return req.config.data_dir + os.sep + "agents" + os.sep + host
+
+def is_valid_agent_name(name):
+    return bool(name) and re.match(r"^[\w.-]+$", name) is not None and \
+            not name.startswith(".")
+
+def agent_is_connected(req, host):
+    if not is_valid_agent_name(host):
+        return False
+    try:
+        mtime = os.stat(agent_dir(req, host) + os.sep + "alive").st_mtime
+    except OSError:
+        return False
+    return time.time() - mtime < AGENT_ALIVE_TIMEOUT
+
+# returns the directory for capture logs on the host of an agent
+# (older agents don't report it, and write them in /tmp)
+def agent_capture_dir(req, host):
+    try:
+        with open(agent_dir(req, host) + os.sep + "capture_dir") as f:
+            return f.read().strip() or AGENT_CAPTURE_DIR_DEFAULT
+    except IOError:
+        return AGENT_CAPTURE_DIR_DEFAULT
+
+# returns True if user is allowed to be the agent for host
+def user_is_agent_for(req, user, host):
+    agent_for = get_object_map(req, "user", user).get("agent_for", [])
+    if not isinstance(agent_for, list):
+        agent_for = [agent_for]
+    return host in agent_for
+
+# create the directories for an agent's operations, and return
+# ops_dir, claimed_dir, results_dir
+def make_agent_dirs(req, host):
+    dirs = [agent_dir(req, host) + os.sep + name
+            for name in ["ops", "claimed", "results"]]
+    for path in dirs:
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # another request created it
+                pass
+    return dirs
+
+# send an operation to the agent for a host, and wait for its result
+# returns result, reason - where result is a map with the result of
+# the operation, or None on failure (with reason)
+def agent_request(req, host, op, args, timeout=AGENT_OP_TIMEOUT):
+    ops_dir, claimed_dir, results_dir = make_agent_dirs(req, host)
+
+    start = time.time()
+    fd, tmp_path = tempfile.mkstemp(".tmp", "op-", ops_dir)
+    op_id = os.path.basename(tmp_path)[:-len(".tmp")]
+    op_map = dict(args)
+    op_map["op"] = op
+    op_map["id"] = op_id
+    os.write(fd, json.dumps(op_map))
+    os.close(fd)
+    filename = op_id + ".json"
+    os.rename(tmp_path, ops_dir + os.sep + filename)
+
+    result_path = results_dir + os.sep + filename
+    deadline = start + timeout
+    last_check = start
+    while not os.path.exists(result_path):
+        now = time.time()
+        msg = ""
+        if now > deadline:
+            msg = "No response from agent for host %s for %s operation" % (host, op)
+        elif now - last_check >= AGENT_KEEPALIVE_INTERVAL:
+            # don't wait for an agent that has gone away (a running
+            # agent keeps polling while it performs the operation)
+            last_check = now
+            if not agent_is_connected(req, host):
+                msg = "Agent for host %s is not connected" % host
+        if msg:
+            # cancel the operation
+            for path in [ops_dir + os.sep + filename,
+                    claimed_dir + os.sep + filename]:
+                if os.path.exists(path):
+                    os.remove(path)
+            log_this(msg)
+            return (None, msg)
+        time.sleep(AGENT_POLL_INTERVAL)
 
-    log_this("capture pid=%d" % pid)
-    fd = open(pidfile,"w")
-    fd.write(str(pid))
-    fd.close()
+    try:
+        with open(result_path) as f:
+            result = json.load(f)
+    except (IOError, ValueError):
+        result = { "result": RSLT_FAIL, "message": "Invalid result data" }
+    os.remove(result_path)
+    log_metric("agent_op_time", time.time() - start, "s",
+            "host=%s op=%s" % (host, op))
+
+    if result.get("result", RSLT_FAIL) != RSLT_OK:
+        msg = "Agent for host %s could not do %s operation: %s" % \
+                (host, op, result.get("message", "unknown error"))
+        return (None, msg)
+    return (result, "")
+
+# move the waiting operations for an agent to the claimed directory,
+# and return them (in the order they were requested)
+def claim_agent_ops(ops_dir, claimed_dir):
+    ops = []
+    try:
+        filenames = os.listdir(ops_dir)
+    except OSError:
+        return ops
 
-    return (token, "")
+    op_files = []
+    for filename in filenames:
+        if not filename.endswith(".json"):
+            continue
+        try:
+            op_files.append((os.path.getmtime(ops_dir + os.sep + filename), filename))
+        except OSError:
+            continue
 
-# sends reason on failure
-def stop_capture(req, action, resource_map, token, rest):
-    resource = resource_map["name"]
+    for mtime, filename in sorted(op_files):
+        claimed_path = claimed_dir + os.sep + filename
+        try:
+            os.rename(ops_dir + os.sep + filename, claimed_path)
+        except OSError:
+            # claimed by another poll, or cancelled
+            continue
+        try:
+            with open(claimed_path) as f:
+                ops.append(json.load(f))
+        except (IOError, ValueError):
+            log_this("Error: could not read agent operation %s" % claimed_path)
+    return ops
+
+# return the operations for the agent of a host, waiting for up to
+# 'timeout' seconds for an operation, if there are none
+def return_agent_ops(req, host):
+    try:
+        timeout = float(req.form.getfirst("timeout", str(AGENT_WAIT_DEFAULT)))
+    except ValueError:
+        req.send_api_response_msg(RSLT_FAIL, "Invalid 'timeout' value for agent operations")
+        return
 
-    pidfile = CAPTURE_PID_FILENAME_FMT % token
+    ops_dir, claimed_dir, results_dir = make_agent_dirs(req, host)
+    alive_path = agent_dir(req, host) + os.sep + "alive"
 
-    if not os.path.exists(pidfile):
-        return "Cannot find executing capture for %s for resource '%s'" % (action, resource)
+    capture_dir = req.form.getfirst("capture_dir", "")
+    if capture_dir.startswith("/") and \
+            capture_dir != agent_capture_dir(req, host):
+        with open(agent_dir(req, host) + os.sep + "capture_dir", "w") as f:
+            f.write(capture_dir)
 
-    # Could support optional stop_cmd execution here
-    # but let's wait on that.
-    try:
-        fd = open(pidfile, "r")
-        pid = int(fd.read().strip())
-        fd.close()
-    except IOError:
-        pid = None
+    # start the response, so spaces can be sent while waiting
+    sys.stdout.write("Content-type: text/plain\n" + req.api_headers() + "\n")
+    sys.stdout.flush()
 
-    if not pid:
-        return "Cannot find in-progress capture for %s for resource '%s'" % (action, resource)
+    deadline = time.time() + min(max(timeout, 0), AGENT_WAIT_MAX)
+    last_keepalive = 0
+    ops = []
+    try:
+        while True:
+            # mark the agent as connected, while it is waiting
+            now = time.time()
+            if now - last_keepalive >= AGENT_KEEPALIVE_INTERVAL:
+                sys.stdout.write(" ")
+                sys.stdout.flush()
+                with open(alive_path, "a"):
+                    os.utime(alive_path, None)
+                last_keepalive = now
+
+            ops = claim_agent_ops(ops_dir, claimed_dir)
+            if ops or now >= deadline:
+                break
+            time.sleep(AGENT_POLL_INTERVAL)
+
+        os.utime(alive_path, None)
+        sys.stdout.write(api_json({ "result": RSLT_OK, "data": ops }))
+        sys.stdout.flush()
+    except IOError as error:
+        # the agent has gone away - put the operations back, for the
+        # next poll
+        for op in ops:
+            filename = op["id"] + ".json"
+            try:
+                os.rename(claimed_dir + os.sep + filename,
+                        ops_dir + os.sep + filename)
+            except OSError:
+                # the operation was cancelled
+                pass
+        log_this("wait for operations by agent %s ended: %s" % (host, error))
+
+# save the result of an operation, posted by an agent
+def save_agent_result(req, host, op_id):
+    ops_dir, claimed_dir, results_dir = make_agent_dirs(req, host)
+    filename = op_id + ".json"
+    claimed_path = claimed_dir + os.sep + filename
+    if not os.path.exists(claimed_path):
+        msg = "Unknown or cancelled operation '%s' for agent %s" % (op_id, host)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
     try:
-        while 1:
-            os.kill(pid, signal.SIGTERM)
-            time.sleep(0.1)
-    except OSError as err:
-        err = str(err)
-        if err.find("No such process") > 0:
-            if os.path.exists(pidfile):
-                os.remove(pidfile)
+        result = json.loads(req.form.value)
+    except (TypeError, ValueError):
+        msg = "Could not parse result data for operation '%s'" % op_id
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
-    return None
+    # write to a temp file and rename it, so the waiting request never
+    # sees a partial result
+    tmp_path = results_dir + os.sep + op_id + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(result, f)
+    os.rename(tmp_path, results_dir + os.sep + filename)
+    os.remove(claimed_path)
+    req.send_api_response(RSLT_OK)
+
+# handle api/v0.2/agents/{host}/ops and
+# api/v0.2/agents/{host}/result/{op_id}
+def return_api_agent_action(req, rest):
+    user = req.get_user()
+    if not user or user == "nobody":
+        msg = "Cannot determine user for agent operation"
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
-# returns data, reason
-# data is empty on failure, and reason is a string with error message
-# otherwise, sends data from capture.  Captured data may be transformed
-# from its original format, but in all cases should be sent as json.
-def get_captured_data(req, action, resource_map, token, rest):
-    resource = resource_map["name"]
+    if len(rest) < 2 or not is_valid_agent_name(rest[0]):
+        msg = "Invalid path '%s' after /api/agents" % "/".join(rest)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
-    logfile = CAPTURE_LOG_FILENAME_FMT % token
+    host = rest[0]
+    if not user_is_agent_for(req, user, host):
+        msg = "User '%s' is not allowed to be the agent for host %s" % \
+                (user, host)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
-    if not os.path.exists(logfile):
-        return (None, "Cannot find capture log for %s token %s for resource '%s'" % (action, token, resource))
+    if rest[1] == "ops" and len(rest) == 2:
+        return_agent_ops(req, host)
+        return
+    if rest[1] == "result" and len(rest) == 3 and \
+            is_valid_agent_name(rest[2]):
+        save_agent_result(req, host, rest[2])
+        return
 
-    try:
-        fd = open(logfile, "r")
-        log_data = fd.read()
-        fd.close()
-    except IOError:
-        log_data = None
+    msg = "Unsupported agent operation '%s'" % "/".join(rest[1:])
+    req.send_api_response_msg(RSLT_FAIL, msg)
 
-    if not log_data:
-        return (None, "Cannot read capture data for %s for resource '%s'" % (action, resource))
+# read part of the log of a capture done by an agent
+# At most AGENT_READ_CHUNK_SIZE bytes are read, since the agent limits
+# the size of a read.
+# returns data, running, reason
+def read_agent_capture(req, info, offset, size):
+    import base64
+
+    args = { "path": info["logfile"], "offset": offset,
+        "size": min(size, AGENT_READ_CHUNK_SIZE), "pid": info.get("pid", None) }
+    result, reason = agent_request(req, info["agent"], "read", args)
+    if not result:
+        return (None, False, reason)
+    return (base64.b64decode(result["data"]), result["running"], "")
+
+# returns chunks, reason for a capture done by an agent
+# where chunks is an iterator over the whole log, which is read from the
+# agent in ranges of AGENT_READ_CHUNK_SIZE bytes
+def read_agent_capture_log(req, info):
+    # read the first range here, so that an error can be reported
+    # before the response is started
+    data, running, reason = read_agent_capture(req, info, 0,
+            AGENT_READ_CHUNK_SIZE)
+    if data is None:
+        return (None, reason)
+
+    def chunks(data):
+        offset = len(data)
+        yield data
+        while len(data) == AGENT_READ_CHUNK_SIZE:
+            data, running, reason = read_agent_capture(req, info, offset,
+                    AGENT_READ_CHUNK_SIZE)
+            if data is None:
+                log_this(reason)
+                raise IOError(reason)
+            offset += len(data)
+            yield data
+    return (chunks(data), "")
+
+# a driver that performs the commands of a resource on its host, using
+# the agent for the host
+# The commands are the same as for the 'cmd' driver.
+class agent_driver_class(cmd_driver_class):
+    def host(self):
+        return self.resource_map.get("host", "")
+
+    # execute a command on the host
+    # This has the same arguments and return values as spawn_command.
+    # If input_path is specified, the command reads its input from that
+    # file on the host.
+    def run(self, cmd, use_shell=False, timeout=None, input_data=None,
+            input_path=None):
+        import base64
+
+        args = { "cmd": cmd, "shell": use_shell, "timeout": timeout }
+        if input_data:
+            args["input"] = base64.b64encode(input_data)
+        if input_path:
+            args["input_path"] = input_path
+        op_timeout = AGENT_OP_TIMEOUT
+        if timeout:
+            op_timeout += timeout
+        result, reason = agent_request(self.req, self.host(), "exec", args,
+                op_timeout)
+        if not result:
+            return (127, "", reason)
+        return (result["rcode"], base64.b64decode(result["output"]),
+                base64.b64decode(result["errors"]))
+
+    def power(self, board_map, operation):
+        return exec_command(self.req, board_map, self.resource_map,
+                operation, self.run)
+
+    def power_status(self, board_map):
+        return exec_power_status(self.req, board_map, self.resource_map,
+                self.run)
+
+    def set_config(self, res_type, config_map):
+        return set_config(self.req, res_type, self.resource_map, config_map,
+                [], self.run)
+
+    # append data to a file on the host
+    # If path is None, a new temporary file is created.
+    # returns path, reason
+    def write_file(self, req, path, data):
+        import base64
+
+        args = { "data": base64.b64encode(data) }
+        if path:
+            args["path"] = path
+        result, reason = agent_request(req, self.host(), "write", args)
+        if not result:
+            return (path, reason)
+        return (result["path"], "")
+
+    # send the request body to a command on the host
+    # The body is written to a temporary file on the host in chunks (so
+    # that it is never all in memory), and the command reads that file.
+    # This has the same arguments and return values as pipe_body_to_command.
+    def pipe_body(self, req, cmd_str, use_shell):
+        return self.spool_body(req, lambda path: cmd_str, use_shell, True)
+
+    # run the command returned by make_cmd(path), for the request body
+    # written to a temporary file (at path) on the host
+    # If use_input is True, the command also reads the file as its
+    # standard input.
+    # This has the same arguments and return values as
+    # spool_body_to_command.
+    def spool_body(self, req, make_cmd, use_shell, use_input=False):
+        path = None
+        try:
+            for chunk in req.body_chunks(AGENT_WRITE_CHUNK_SIZE):
+                path, reason = self.write_file(req, path, chunk)
+                if reason:
+                    return (None, "", reason)
+            if not path:
+                # the body was empty - the command still needs an input file
+                path, reason = self.write_file(req, path, "")
+                if reason:
+                    return (None, "", reason)
+            rcode, output, errors = self.run(make_cmd(path), use_shell,
+                    input_path=path if use_input else None)
+        finally:
+            if path:
+                agent_request(req, self.host(), "remove", { "path": path })
+        return (rcode, output + errors, "")
+
+    def put_data(self, res_type):
+        return put_data(self.req, res_type, self.resource_map, [],
+                self.pipe_body, self.spool_body)
+
+    # the capture command is started by the agent, and writes the
+    # capture log on the host.  The capture has an info file on the
+    # server, with the host, pid and log path.
+    def start_capture(self, res_type):
+        resource = self.resource_map["name"]
+        capture_cmd = self.resource_map.get("capture_cmd", "")
+        if not capture_cmd:
+            return ("", "Could not find 'capture_cmd' for resource %s" % resource)
+
+        make_capture_dir()
+        fd, infopath = tempfile.mkstemp(capture_info_suffix,
+                capture_info_prefix, capture_dir)
+        os.close(fd)
+        filename = os.path.basename(infopath)
+        token = filename[len(capture_info_prefix):-len(capture_info_suffix)]
+
+        d = copy.deepcopy(self.resource_map)
+        d["logfile"] = AGENT_CAPTURE_LOG_FILENAME_FMT % \
+                (agent_capture_dir(self.req, self.host()), token)
+        args = { "cmd": capture_cmd % d,
+            "shell": cmd_uses_shell(self.resource_map, "capture") }
+        result, reason = agent_request(self.req, self.host(), "spawn", args)
+        if not result:
+            os.remove(infopath)
+            return ("", reason)
+
+        info = { "resource": resource,
+            "agent": self.host(),
+            "pid": result["pid"],
+            "logfile": d["logfile"] }
+        save_capture_info(token, info)
+
+        log_this("started capture %s on host %s, pid=%d" % (token, self.host(), result["pid"]))
+        return (token, "")
+
+    def stop_capture(self, res_type, token):
+        info = read_capture_info(token)
+        if not info or not info.get("agent"):
+            return "Cannot find executing capture for %s for resource '%s'" % (res_type, self.resource_map["name"])
+
+        result, reason = agent_request(self.req, info["agent"], "kill",
+                { "pid": info["pid"] })
+        if not result:
+            return reason
+        return None
 
-    # convert to json data
-    # FIXTHIS - should not use hardcoded re-format operation here, for sdb data
-    # should run a conversion command specified by the resource object
-    if action == "power_measurement":
-        jdata = "[\n"
-        for line in log_data.split("\n"):
-            if not line:
-                continue
-            parts = line.split(",")
-            try:
-                jdata += ' { "timestamp": "%s", "voltage": "%s", "current": "%s" }\n' % (parts[0], float(parts[1])/1000.0, float(parts[2])/1000.0)
-            except:
-                log_this("Problem converting log_data line for power measurement\nline='%s'" % line)
-        jdata += "]"
-        return (jdata, "")
+# map of driver names to driver classes
+driver_classes = {}
 
-    return (log_data, "")
+# map of resource types to default driver names
+default_drivers = {}
 
-# returns reason on failure, "" on success
-def delete_capture(req, res_type, resource_map, token, rest):
-    resource = resource_map["name"]
+# register a driver class
+# if default_for is specified, the driver is made the default driver for
+# the resource types in that list
+def register_driver(name, driver_class, default_for=[]):
+    driver_classes[name] = driver_class
+    for res_type in default_for:
+        default_drivers[res_type] = name
 
-    logfile = CAPTURE_LOG_FILENAME_FMT % token
-    if not os.path.exists(logfile):
-        return "Cannot delete captured data for resource '%s'" % resource
-    os.remove(logfile)
-    return ""
+# load driver plugins from the drivers directory
+def load_drivers():
+    import imp
 
-def put_data(req, action, resource_map, rest):
-    resource = resource_map["name"]
-    put_cmd = resource_map.get("put_cmd", "")
-    if not put_cmd:
-        return "Could not find 'put_cmd' for resource resource %s" %  resource
-    dlog_this("put_cmd=" + put_cmd)
+    register_driver("cmd", cmd_driver_class)
+    register_driver("termios", termios_serial_driver_class)
+    register_driver("service", service_serial_driver_class)
+    register_driver("agent", agent_driver_class)
 
-    # put data into a file
-    data = req.form.value
-    log_this("data=%s" % data)
+    driver_dir = base_dir + "/drivers"
+    if not os.path.isdir(driver_dir):
+        return
 
-    fd, datapath = tempfile.mkstemp(data_suffix, data_prefix, data_dir)
-    os.write(fd, data)
-    os.close(fd)
+    this_module = sys.modules[__name__]
+    for filename in sorted(os.listdir(driver_dir)):
+        if not filename.endswith(".py"):
+            continue
+        path = driver_dir + os.sep + filename
+        try:
+            plugin = imp.load_source("lc_driver_" + filename[:-3], path)
+            plugin.register_drivers(this_module)
+        except:
+            import traceback
+            log_this("Error: could not load driver plugin %s" % path)
+            log_this("traceback=%s" % traceback.format_exc())
+
+# return a driver instance for performing operations of the indicated
+# type on a resource
+# returns driver, reason - where driver is None on failure
+# If token is specified, the driver is for an operation on that capture.
+def get_driver(req, resource_map, res_type, token=None):
+    driver_name = resource_map.get("driver", "")
+    if type(driver_name) == type({}):
+        driver_name = driver_name.get(res_type, "")
+    if not driver_name:
+        driver_name = default_drivers.get(res_type, "cmd")
+
+    # commands for a resource on a host with a connected agent are
+    # performed by the agent.  An existing capture is handled by the
+    # driver that started it, whether or not the agent is connected now:
+    # an agent capture has an info file with the agent's host, and a
+    # capture started by the server does not.
+    if driver_name in ["cmd", "agent"] and token:
+        info = read_capture_info(token)
+        if info and info.get("agent"):
+            driver_name = "agent"
+        else:
+            driver_name = "cmd"
+    elif driver_name == "cmd" and \
+            agent_is_connected(req, resource_map.get("host", "")):
+        driver_name = "agent"
 
-    d = copy.deepcopy(resource_map)
-    d["datafile"] = datapath
+    try:
+        driver_class = driver_classes[driver_name]
+    except KeyError:
+        msg = "Unknown driver '%s' for resource %s" % (driver_name, resource_map["name"])
+        return (None, msg)
 
-    cmd_str = put_cmd % d
-    dlog_this("(interpolated) cmd_str='%s'" + cmd_str)
-    rcode, result = getstatusoutput(cmd_str)
-    os.remove(datapath)
-    if rcode:
-        msg = "Result of put operation on resource %s = %d\n" % (resource, rcode)
-        output = result.decode('utf8', errors='ignore')
-        msg += "command output (decoded)='" + output + "'"
-        return msg
+    if driver_class.res_types and res_type not in driver_class.res_types:
+        msg = "Driver '%s' does not support %s operations (resource %s)" % \
+                (driver_name, res_type, resource_map["name"])
+        return (None, msg)
 
-    return None
+    return (driver_class(req, resource_map), "")
 
+load_drivers()
 
 # rest is a list of the rest of the path
 # support actions are: get_resource, power
@@ -1627,6 +5880,22 @@ def return_api_resource_action(req, resource, res_type, rest):
     operation = rest[0]
     del(rest[0])
 
+    token = None
+    if res_type in ["power_measurement", "serial"] and \
+            operation in ["stop_capture", "get-data", "delete", "follow",
+                "expect", "stats"]:
+        try:
+            token = rest[0]
+        except IndexError:
+            msg = "Missing token for %s operation" % res_type
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+
+    driver, msg = get_driver(req, resource_map, res_type, token)
+    if not driver:
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
     if res_type == "serial" and operation == "set-config":
         config_data = req.form.value
         log_this("config_data=%s" % config_data)
@@ -1634,56 +5903,89 @@ def return_api_resource_action(req, resource, res_type, rest):
         config_map = json.loads(config_data)
         dlog_this("config_map=%s" % config_map)
 
-        msg = set_config(req, res_type, resource_map, config_map, rest)
+        msg = driver.set_config(res_type, config_map)
         if msg:
             req.send_api_response_msg(RSLT_FAIL, msg)
         else:
+            record_event(req, "config", { "resource": resource,
+                    "res_type": res_type, "operation": "set-config" })
             req.send_api_response(RSLT_OK)
         return
 
-    if res_type in ["power_measurement", "serial"]:
-        if operation in ["stop_capture", "get-data", "delete"]:
-            try:
-                token = rest[0]
-            except IndexError:
-                msg = "Missing token for %s operation" % res_type
-                req.send_api_response_msg(RSLT_FAIL, msg)
-                return
+    if res_type == "serial" and operation == "transmit-test":
+        transmit_test(req, resource_map)
+        return
 
+    if res_type in ["power_measurement", "serial"]:
         if operation == "start_capture":
-            token, reason = start_capture(req, res_type, resource_map, rest[1:])
+            token, reason = driver.start_capture(res_type)
             if not token:
                 req.send_api_response_msg(RSLT_FAIL, reason)
                 return
+            info = read_capture_info(token)
+            if not info or info.get("agent"):
+                # the capture has a log in the capture directory (of
+                # the server, or of the agent's host)
+                track_capture(req, token, resource,
+                        (info or {}).get("agent", None))
+                apply_capture_retention(req)
+            record_event(req, "capture", { "resource": resource,
+                    "res_type": res_type, "operation": "start", "token": token })
             req.send_api_response(RSLT_OK, { "data": token } )
             return
         elif operation == "stop_capture":
-            reason = stop_capture(req, res_type, resource_map, token, rest[2:])
+            reason = driver.stop_capture(res_type, token)
             if reason:
                 req.send_api_response_msg(RSLT_FAIL, reason)
                 return
+            if res_type == "power_measurement":
+                # finish the stats while the log is not compressed
+                update_power_stats(req, token)
+            info = read_capture_info(token)
+            if not info or info.get("agent"):
+                # compress the log
+                apply_capture_retention(req)
+            record_event(req, "capture", { "resource": resource,
+                    "res_type": res_type, "operation": "stop", "token": token })
             req.send_api_response(RSLT_OK)
             return
         elif operation == "get-data":
-            data, reason = get_captured_data(req, res_type, resource_map, token, rest[2:])
+            chunks, reason = get_captured_data(req, res_type, resource_map, token, rest[2:])
             if reason:
                 req.send_api_response_msg(RSLT_FAIL, reason)
                 return
-            req.send_api_response(RSLT_OK, { "data": data } )
+            req.send_api_string_response(RSLT_OK, "data", chunks)
+            return
+        elif operation == "follow" and res_type == "serial":
+            follow_capture(req, res_type, resource_map, token)
+            return
+        elif operation == "expect" and res_type == "serial":
+            expect_capture(req, res_type, resource_map, token)
+            return
+        elif operation == "stats" and res_type == "power_measurement":
+            return_api_power_stats(req, token)
             return
         elif operation == "delete":
             reason = delete_capture(req, res_type, resource_map, token, rest[2:])
             if reason:
                 req.send_api_response_msg(RSLT_FAIL, reason)
                 return
+            record_event(req, "capture", { "resource": resource,
+                    "res_type": res_type, "operation": "delete", "token": token })
             req.send_api_response(RSLT_OK)
             return
         elif operation == "put-data":
-            reason = put_data(req, res_type, resource_map, rest)
+            start = time.time()
+            reason = driver.put_data(res_type)
             if reason:
                 req.send_api_response_msg(RSLT_FAIL, reason)
                 return
-            req.send_api_response(RSLT_OK)
+            duration = time.time() - start
+            rate = req.body_bytes / max(duration, 0.000001)
+            log_metric("put_data_rate", rate, "B/s", "resource=" + resource)
+            stats = { "bytes": req.body_bytes, "seconds": round(duration, 6),
+                "bytes_per_second": int(rate) }
+            req.send_api_response(RSLT_OK, { "data": stats })
             return
         else:
             msg = "operation '%s' not supported for %s resource" % (operation, res_type)
@@ -1804,10 +6106,16 @@ def find_resource(req, board, feature):
 # list boards, list devices -> api/v0.2/devices/"
 # mydevices -> api/v0.2/devices/mine"
 # {board} allocate -> api/v0.2/devices/{board}/assign
+# {board} reserve --wait -> api/v0.2/devices/{board}/assign?wait=1&timeout={seconds}
+# {board} reserve --duration -> api/v0.2/devices/{board}/assign?duration={seconds}
+# {board} renew -> api/v0.2/devices/{board}/renew?duration={seconds}
+# {board} queue -> api/v0.2/devices/{board}/queue
 # {board} release -> api/v0.2/devices/{board}/release"
 # {board} release force -> api/v0.2/devices/{board}/release"
 # {board} status -> api/v0.2/devices/{board}
 # {board} get_resource -> api/v0.2/devices/{board}/get_resource/{resource_type}
+# {board} run -> POST api/v0.2/devices/{board}/run
+# {board} run (rest of output) -> api/v0.2/devices/{board}/run-output/{id}/{stream}?offset={offset}&length={length}
 # {resource} pm start -> api/v0.2/resources/{resource}/power_measurement/start
 # {resource} pm stop -> api/v0.2/resources/{resource}/power_measurement/stop/token
 # {resource} pm get-data -> api/v0.2/resources/{resource}/power_measurement/get-data/token
@@ -1816,7 +6124,17 @@ def find_resource(req, board, feature):
 # {resource} serial stop -> api/v0.2/resources/{resource}/serial/stop/token
 # {resource} serial get-data -> api/v0.2/resources/{resource}/serial/get-data/token
 # {resource} serial delete -> api/v0.2/resources/{resource}/serial/delete/token
+# {resource} serial follow -> api/v0.2/resources/{resource}/serial/follow/token?offset={offset}
+# events -> api/v0.2/events?since={seq}&timeout={seconds}
+# generation -> api/v0.2/generation
+# import -> POST api/v0.2/import?replace={0|1}
+# export -> api/v0.2/export
 # {resource} serial put-data -> POST api/v0.2/resources/{resource}/serial/put-data
+# {board} upload -> POST api/v0.2/devices/{board}/upload/serial?path={path}
+#                or POST api/v0.2/devices/{board}/upld/ssh?path={path}
+# {board} download -> api/v0.2/devices/{board}/download/serial/{path}
+#                or api/v0.2/devices/{board}/downld/ssh?path={path}
+# {board} download checksum -> api/v0.2/devices/{board}/checksum/{method}?path={path}
 
 def do_api(req):
     #log_this("in do_api")
@@ -1842,6 +6160,8 @@ def do_api(req):
         req.send_api_response_msg(RSLT_FAIL, msg)
         return
 
+    reap_expired_leases(req)
+
     if parts[0] == "token":
         # return auth token for user (on successful authentication)
         #log_this("form.value=%s" % req.form.value)
@@ -1908,6 +6228,30 @@ def do_api(req):
                 msg = "Unsupported elements '%s/%s' after /api/resources" % (res_type, "/".join(rest))
                 req.send_api_response_msg(RSLT_FAIL, msg)
                 return
+    elif parts[0] == "generation":
+        # handle api/generation - the lab generation number
+        return_api_generation(req)
+        return
+    elif parts[0] == "events":
+        # handle api/events?since={seq} - wait for events
+        return_api_events(req)
+        return
+    elif parts[0] == "import":
+        # handle api/import - add or replace many boards and resources
+        return_api_import(req)
+        return
+    elif parts[0] == "export":
+        # handle api/export - all boards and resources
+        return_api_export(req)
+        return
+    elif parts[0] == "captures":
+        # handle api/captures - capture usage
+        return_api_capture_usage(req)
+        return
+    elif parts[0] == "agents":
+        # handle api/agents/{host}/... - operations for host agents
+        return_api_agent_action(req, parts[1:])
+        return
     elif parts[0] == "requests":
         if len(parts) == 1:
             # handle /api/requests - list requests
@@ -2004,33 +6348,115 @@ def handle_request(environ, req):
     req.html.append(req.html_error("Unknown action '%s'" % action))
 
 
+# return the json text for an API response
+def api_json(data):
+    return json.dumps(data, sort_keys=True, indent=4, separators=(',', ': '))
+
+# return data compressed in gzip format
+def gzip_data(data):
+    import zlib
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+# returns the content encoding of the request body ("gzip" or ""), or
+# None if the encoding is not supported
+def request_body_encoding(environ):
+    encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+    if encoding in ["", "identity"]:
+        return ""
+    if encoding in ["gzip", "x-gzip"]:
+        return "gzip"
+    return None
+
+# returns True if the body of the request should be streamed to the
+# request handler, instead of being read and parsed by cgi.FieldStorage
+# (which holds the data in memory or in a temporary file)
+def is_streaming_request(environ):
+    if environ.get("REQUEST_METHOD", "GET") != "POST":
+        return False
+
+    # multipart forms need to be parsed
+    if environ.get("CONTENT_TYPE", "").startswith("multipart/form-data"):
+        return False
+
+    parts = environ.get("PATH_INFO", "").rstrip("/").split("/")
+    if parts[-1] == "put-data":
+        return True
+    if len(parts) > 2 and parts[-2] in ["upload", "upld"]:
+        return True
+    return False
+
 def cgi_main():
-    form = cgi.FieldStorage()
+    streaming = is_streaming_request(os.environ)
+    body_encoding = request_body_encoding(os.environ)
+    body_error = ""
+    if streaming or body_encoding is None:
+        # only parse the query string, and leave the body on stdin
+        form = cgi.FieldStorage(environ={"REQUEST_METHOD": "GET",
+            "QUERY_STRING": os.environ.get("QUERY_STRING", "")})
+        if body_encoding is None:
+            body_error = "Unsupported Content-Encoding '%s' for request body" % \
+                    os.environ.get("HTTP_CONTENT_ENCODING", "")
+    elif body_encoding == "gzip":
+        # decompress the body, and parse the decompressed data
+        import zlib
+        import StringIO
+        try:
+            length = int(os.environ.get("CONTENT_LENGTH", "0"))
+            body = zlib.decompress(sys.stdin.read(length), 16 + zlib.MAX_WBITS)
+        except (ValueError, zlib.error) as error:
+            body = ""
+            body_error = "Could not decompress gzip request body: %s" % error
+        environ = dict(os.environ)
+        environ["CONTENT_LENGTH"] = str(len(body))
+        form = cgi.FieldStorage(fp=StringIO.StringIO(body), environ=environ)
+    else:
+        form = cgi.FieldStorage()
 
     req = req_class(config, form)
+    if streaming:
+        req.body_stream = sys.stdin
+        req.body_encoding = body_encoding
+        try:
+            req.body_length = int(os.environ.get("CONTENT_LENGTH", "0"))
+        except ValueError:
+            req.body_length = 0
 
     try:
-        handle_request(os.environ, req)
+        if body_error:
+            req.environ = os.environ
+            req.send_api_response_msg(RSLT_FAIL, body_error)
+        else:
+            handle_request(os.environ, req)
     except SystemExit:
         pass
     except:
+        import traceback
+        (etype, evalue, etb) = sys.exc_info()
+        tb_msg = traceback.format_exc()
+        log_this("LabControl Server Error")
+        log_this("traceback=%s" % tb_msg)
+
+        # once a streamed API response has started, the error can only
+        # be logged (and the client gets a truncated response)
+        if req.streamed and not req.header_shown:
+            return
+
         req.show_header("LabControl Server Error")
         req.html.append('<font color="red">Execution raised by software</font>')
 
         # show traceback information here:
         req.html.append("<pre>")
-        import traceback
-        (etype, evalue, etb) = sys.exc_info()
-        tb_msg = traceback.format_exc()
         req.html.append("traceback=%s" % tb_msg)
         req.html.append("</pre>")
-        log_this("LabControl Server Error")
-        log_this("traceback=%s" % tb_msg)
 
     # output html to stdout
     for line in req.html:
         print(line)
 
+    if req.raw_body is not None:
+        sys.stdout.write(req.raw_body)
+
     sys.stdout.flush()
 
 if __name__=="__main__":
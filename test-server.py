@@ -20,9 +20,10 @@ __version__ = "0.4"
 
 __all__ = ["CGIHTTPRequestHandler"]
 
-import os, sys, urllib, select
+import os, sys, urllib, select, socket
 import re
 import BaseHTTPServer
+import SocketServer
 import SimpleHTTPServer
 import CGIHTTPServer
 from urlparse import urlparse
@@ -43,6 +44,45 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
             if f:
                 self.copyfile(f, self.wfile)
                 f.close()
+    def copy_cgi_output(self, fd):
+        """Copy the output of a CGI script to the client.
+
+        The headers are read first, to send the status from a 'Status:'
+        header (e.g. 'Status: 304 Not Modified'), instead of 200.
+        The rest of the output is sent as it arrives, so streamed
+        responses are not delayed.
+        """
+        data = ""
+        while "\n\n" not in data and "\r\n\r\n" not in data:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            data += chunk
+
+        code, message = 200, "Script output follows"
+        lines = data.split("\n")
+        for i, line in enumerate(lines):
+            if not line.strip():
+                break
+            if line.lower().startswith("status:"):
+                status = line.split(":", 1)[1].strip().split(" ", 1)
+                try:
+                    code = int(status[0])
+                    message = status[1] if len(status) > 1 else None
+                except ValueError:
+                    pass
+                del lines[i]
+                break
+        self.send_response(code, message)
+        self.wfile.write("\n".join(lines))
+
+        while True:
+            self.wfile.flush()
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+
     def is_cgi(self):
         cgi_directories = ['/cgi-bin', '/htbin']
 
@@ -62,7 +102,7 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         full_url = self.path
 	# escape embedded '%'s to avoid annoying exceptions
 	path = re.sub("%","%%", full_url)
-        self.log_message("path=%s" % path)
+        self.log_message("path=%s", path)
 
         for x in self.cgi_directories:
             i = len(x)
@@ -74,13 +114,13 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         # parse path into parts: dirname, scriptname, query
         parts = urlparse(self.path)
 
-        self.log_message("parts=%s" % str(parts))
+        self.log_message("parts=%s", str(parts))
         if parts.path.endswith(".py"):
             self.cgi_info = os.path.dirname(parts.path), os.path.basename(parts.path) + "?" + parts.query
-            self.log_message("cgi_info=%s" % str(self.cgi_info))
+            self.log_message("cgi_info=%s", str(self.cgi_info))
             return True
 
-        self.log_message("os.path.dirname(parts.path)=%s" % os.path.dirname(parts.path))
+        self.log_message("os.path.dirname(parts.path)=%s", os.path.dirname(parts.path))
         # allow foo.py/PageName?query_name=query_value
         # that is, one level of path past the script name
         path_dir = os.path.dirname(parts.path)
@@ -88,11 +128,11 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
             dirpart = os.path.dirname(path_dir)
             rest = parts.path[len(dirpart):]
             self.cgi_info = dirpart, rest + "?" + parts.query
-            self.log_message("cgi_info=%s" % str(self.cgi_info))
+            self.log_message("cgi_info=%s", str(self.cgi_info))
             return True
 
         # interpret any path element ending in .py to be a script
-        #self.log_message("os.path.dirname(parts.path)=%s" % os.path.dirname(parts.path))
+        #self.log_message("os.path.dirname(parts.path)=%s", os.path.dirname(parts.path))
         # allow foo.py/item1/item2?name=value
         path_dir = os.path.dirname(parts.path)
         dirpart = ""
@@ -102,7 +142,7 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
             if element.endswith(".py"):
                 rest = "/".join(elements[index:])
                 self.cgi_info = dirpart, rest + "?" + parts.query
-                self.log_message("cgi_info=%s" % str(self.cgi_info))
+                self.log_message("cgi_info=%s", str(self.cgi_info))
                 return True
             else:
                 dirpart += "/" + element
@@ -112,7 +152,7 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
     def is_python(self, path):
         """Test whether argument path is a Python script."""
         head, tail = os.path.splitext(path)
-        #self.log_message("extension=%s" % tail.lower())
+        #self.log_message("extension=%s", tail.lower())
         return tail.lower() in (".py", ".pyw")
 
     def run_cgi(self):
@@ -133,7 +173,7 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         scriptname = script
         scriptfile = self.translate_path(scriptname)
         parts = urlparse(self.path)
-        self.log_message("scriptfile=%s" % scriptfile)
+        self.log_message("scriptfile=%s", scriptfile)
         if not os.path.exists(scriptfile):
             self.send_error(404, "No such CGI script (%s)" % `scriptname`)
             return
@@ -142,7 +182,7 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
                             `scriptname`)
             return
         ispy = self.is_python(scriptname)
-        self.log_message("ispy=%s" % ispy)
+        self.log_message("ispy=%s", ispy)
 
         if not ispy:
             if not (self.have_fork or self.have_popen2 or self.have_popen3):
@@ -198,6 +238,21 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         ua = self.headers.getheader('user-agent')
         if ua:
             env['HTTP_USER_AGENT'] = ua
+        rng = self.headers.getheader('range')
+        if rng:
+            env['HTTP_RANGE'] = rng
+        last_event_id = self.headers.getheader('last-event-id')
+        if last_event_id:
+            env['HTTP_LAST_EVENT_ID'] = last_event_id
+        accept_encoding = self.headers.getheader('accept-encoding')
+        if accept_encoding:
+            env['HTTP_ACCEPT_ENCODING'] = accept_encoding
+        content_encoding = self.headers.getheader('content-encoding')
+        if content_encoding:
+            env['HTTP_CONTENT_ENCODING'] = content_encoding
+        if_none_match = self.headers.getheader('if-none-match')
+        if if_none_match:
+            env['HTTP_IF_NONE_MATCH'] = if_none_match
         co = filter(None, self.headers.getheaders('cookie'))
         if co:
             env['HTTP_COOKIE'] = ', '.join(co)
@@ -205,11 +260,16 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         # Since we're setting the env in the parent, provide empty
         # values to override previously set values
         for k in ('QUERY_STRING', 'REMOTE_HOST', 'CONTENT_LENGTH',
-                  'HTTP_USER_AGENT', 'HTTP_COOKIE'):
+                  'HTTP_USER_AGENT', 'HTTP_COOKIE', 'HTTP_RANGE',
+                  'HTTP_LAST_EVENT_ID', 'HTTP_ACCEPT_ENCODING',
+                  'HTTP_CONTENT_ENCODING', 'HTTP_IF_NONE_MATCH'):
             env.setdefault(k, "")
         os.environ.update(env)
 
-        self.send_response(200, "Script output follows")
+        # with fork, the status is sent by copy_cgi_output(), so that
+        # the script can set it with a 'Status:' header
+        if not self.have_fork:
+            self.send_response(200, "Script output follows")
 
         decoded_query = query.replace('+', ' ')
 
@@ -221,9 +281,16 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
 	    # FIXTHIS - should setuid to reduce security risk!!
             #nobody = nobody_uid()
             self.wfile.flush() # Always flush before forking
+            rfd, wfd = os.pipe()
             pid = os.fork()
             if pid != 0:
                 # Parent
+                os.close(wfd)
+                try:
+                    self.copy_cgi_output(rfd)
+                except socket.error:
+                    self.log_error("client closed the connection")
+                os.close(rfd)
                 pid, sts = os.waitpid(pid, 0)
                 # throw away additional data [see bug #427345]
                 while select.select([self.rfile], [], [], 0)[0]:
@@ -239,8 +306,9 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
                 #    os.setuid(nobody)
                 #except os.error:
                 #    pass
+                os.close(rfd)
                 os.dup2(self.rfile.fileno(), 0)
-                os.dup2(self.wfile.fileno(), 1)
+                os.dup2(wfd, 1)
                 self.log_message("scriptfile: %s", scriptfile)
                 os.execve(scriptfile, args, os.environ)
             except:
@@ -317,8 +385,15 @@ class fServerRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
             else:
                 self.log_message("CGI script exited OK")
 
+# handle each request in a separate process, so that long requests (like
+# waiting for events, or following a capture) don't block other requests
+# (a process is used instead of a thread, since run_cgi() sets the
+# environment of the server process)
+class ForkingHTTPServer(SocketServer.ForkingMixIn, BaseHTTPServer.HTTPServer):
+    pass
+
 def test(HandlerClass = fServerRequestHandler,
-         ServerClass = BaseHTTPServer.HTTPServer):
+         ServerClass = ForkingHTTPServer):
     SimpleHTTPServer.test(HandlerClass, ServerClass)
 
 